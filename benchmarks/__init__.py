@@ -0,0 +1 @@
+""" Benchmarks for pcfmqtt, run with `python3 -m benchmarks` """
@@ -0,0 +1,129 @@
+"""
+Benchmark the bridge against simulated cloud and MQTT client, results are printed as JSON.
+
+    python3 -m benchmarks --devices 10 100 1000 --output bench.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+from concurrent.futures import wait
+
+from pcfmqtt import metrics
+from pcfmqtt.mqtt import Mqtt
+from pcfmqtt.service import Service
+from benchmarks.simulated import FakeClient, SimulatedCloud
+
+
+def run(devices: int, latency_ms: float, error_rate: float, workers: int, cycles: int) -> typing.Dict[str, typing.Any]:
+    """ Run all the scenarios for the given device count """
+    result: typing.Dict[str, typing.Any] = {"devices": devices}
+    cloud = SimulatedCloud(devices, latency_ms, error_rate=error_rate)
+
+    # Startup and memory
+    tracemalloc.start()
+    mqtt = Mqtt("localhost", 1883, "homeassistant", FakeClient)
+    service = Service("username", "password", mqtt, 60, cloud.session, poll_workers=workers,
+                      requests_per_minute=10**9)
+    with contextlib.redirect_stdout(sys.stderr):
+        mqtt.connect(service.handle_message)
+    start = time.perf_counter()
+    # With simulated errors the service would retry on next loop
+    for attempt in range(1, 11):
+        if service.connect_to_cc():
+            break
+    result["connect_seconds"] = time.perf_counter() - start
+    result["connect_attempts"] = attempt
+    result["connected"] = bool(service._devices)
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["memory_bytes"] = memory
+    result["memory_peak_bytes"] = peak
+    result["memory_bytes_per_device"] = memory / devices
+    client: FakeClient = mqtt._client # type: ignore
+    result["subscribe_packets"] = client.subscribe_packets
+
+    # Poll cycle with all the devices due
+    durations = []
+    for _ in range(cycles):
+        for device in service._devices.values():
+            device._target_refresh = 0
+            service._scheduler.schedule(device.get_id(), 0)
+        start = time.perf_counter()
+        try:
+            service._update_devices()
+        except Exception: # Simulated errors, the cycle is still measured
+            pass
+        mqtt.flush(60)
+        durations.append(time.perf_counter() - start)
+    cycle = statistics.median(durations)
+    result["poll_cycle_seconds"] = cycle
+    result["poll_devices_per_second"] = devices / cycle if cycle else None
+
+    # Discovery burst
+    published, published_bytes = client.published, client.published_bytes
+    start = time.perf_counter()
+    mqtt.send_discovery_events(list(service._devices.values()), force=True)
+    mqtt.flush(60)
+    result["discovery_seconds"] = time.perf_counter() - start
+    result["discovery_messages"] = client.published - published
+    result["discovery_bytes"] = client.published_bytes - published_bytes
+
+    # Command latency, one command per device
+    count, total = metrics.COMMAND_SECONDS.count(), metrics.COMMAND_SECONDS.total()
+    start = time.perf_counter()
+    for device in service._devices.values():
+        client.deliver(f"homeassistant/climate/{device.get_id()}/temp_cmd", "23.5")
+    # Mailboxes run in order so the commands are done once a no-op queued after them completes
+    wait([service._actors.submit(device.get_id(), lambda: None) for device in service._devices.values()],
+         timeout=60)
+    result["command_burst_seconds"] = time.perf_counter() - start
+    completed = metrics.COMMAND_SECONDS.count() - count
+    result["commands_completed"] = completed
+    result["command_latency_avg_seconds"] = (metrics.COMMAND_SECONDS.total() - total) / completed if completed else None
+
+    result["cloud_requests"] = dict(cloud.requests)
+    service._actors.shutdown()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pcfmqtt against simulated cloud and MQTT")
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Device counts to benchmark, default 10 100 1000")
+    parser.add_argument("--latency-ms", type=float, default=2,
+                        help="Median simulated cloud latency in milliseconds, default 2")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Probability of simulated cloud request failing, default 0")
+    parser.add_argument("--workers", type=int, default=8, help="Poll workers, default 8")
+    parser.add_argument("--cycles", type=int, default=3, help="Poll cycles per device count, default 3")
+    parser.add_argument("--output", type=str, help="Write results to file instead of stdout")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "latency_ms": args.latency_ms,
+        "error_rate": args.error_rate,
+        "workers": args.workers,
+        "results": [run(devices, args.latency_ms, args.error_rate, args.workers, args.cycles)
+                    for devices in args.devices],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
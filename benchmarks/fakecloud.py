@@ -0,0 +1,295 @@
+"""
+Local stand-in for the Panasonic Comfort Cloud HTTP API, for load testing the bridge end-to-end.
+
+    python3 -m benchmarks.fakecloud --devices 1000 --latency-ms 200 --burst-every 300 --burst-length 20
+    python3 -m pcfmqtt -u user -P pass --cloud-url http://localhost:8080
+
+Implements the endpoints `pcomfortcloud.session.Session` calls for login, token refresh, logout,
+listing devices, reading and controlling them and their daily energy history. Authentication and API are served from the same
+address. Requests get log-normal latency, random 502 errors and periodic bursts of 429 or 502
+responses. Access tokens expire after their lifetime and can be revoked early to exercise the
+401 handling.
+"""
+import argparse
+import base64
+import datetime
+import json
+import logging
+import random
+import re
+import threading
+import time
+import typing
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlencode
+from pcomfortcloud import constants
+
+log = logging.getLogger(__name__)
+
+Response = typing.Tuple[int, typing.Dict[str, str], typing.Any]
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+class FakeCloud:
+    """
+    State of the fake cloud: virtual devices and issued tokens. Handles requests independent of the
+    HTTP server so it can be driven directly.
+
+    Bursts of `burst_status` responses last `burst_length` seconds at the end of every `burst_every`
+    seconds. Commands take effect after `apply_delay` seconds like they do with the real units.
+    """
+
+    def __init__(self, devices: int = 10, latency_ms: float = 0, latency_sigma: float = 0.5,
+                 error_rate: float = 0, burst_every: float = 0, burst_length: float = 0,
+                 burst_status: int = 429, token_ttl: float = 3600, expire_every: float = 0,
+                 apply_delay: float = 0, seed: int = 1) -> None:
+        self._random = random.Random(seed)
+        self._latency = latency_ms / 1000
+        self._sigma = latency_sigma
+        self._error_rate = error_rate
+        self._burst_every = burst_every
+        self._burst_length = burst_length
+        self._burst_status = burst_status
+        self._token_ttl = token_ttl
+        self._expire_every = expire_every
+        self._apply_delay = apply_delay
+        self._started = time.time()
+        self._last_expire = self._started
+        self._lock = threading.Lock()
+        self._access: typing.Dict[str, float] = {}  # Access token to its expiry
+        self._refresh: typing.Set[str] = set()
+        self._pending: typing.Dict[str, typing.List[typing.Tuple[float, typing.Dict[str, typing.Any]]]] = {}
+        self.requests: typing.Dict[str, int] = {}
+        self.devices: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for i in range(devices):
+            guid = f"CS-SIM{i:05d}+{uuid.UUID(int=self._random.getrandbits(128)).hex[:12]}"
+            self.devices[guid] = {
+                "deviceGuid": guid,
+                "deviceName": f"Device {i}",
+                "deviceModuleNumber": "CS-SIM",
+                "group": f"Group {i // 20}",
+                "parameters": {
+                    "operate": constants.Power.On.value, "operationMode": constants.OperationMode.Heat.value,
+                    "temperatureSet": 21.0, "insideTemperature": 20 + i % 5, "outTemperature": 5,
+                    "fanSpeed": constants.FanSpeed.Auto.value, "fanAutoMode": constants.AirSwingAutoMode.Both.value,
+                    "airSwingLR": constants.AirSwingLR.Mid.value, "airSwingUD": constants.AirSwingUD.Mid.value,
+                    "ecoMode": constants.EcoMode.Auto.value, "nanoe": constants.NanoeMode.On.value,
+                },
+            }
+
+    def expire_tokens(self) -> None:
+        """ Revoke all access tokens, clients find out on their next request """
+        with self._lock:
+            self._access.clear()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _in_burst(self, now: float) -> bool:
+        if not self._burst_every or not self._burst_length:
+            return False
+        return (now - self._started) % self._burst_every >= self._burst_every - self._burst_length
+
+    def _issue_token(self) -> typing.Dict[str, typing.Any]:
+        # Client compares the expiry in whole seconds
+        expires = int(time.time() + self._token_ttl)
+        access = ".".join([_b64(b'{"alg":"none"}'), _b64(json.dumps({"exp": expires}).encode()), uuid.uuid4().hex])
+        refresh = uuid.uuid4().hex
+        with self._lock:
+            self._access[access] = expires + 1
+            self._refresh.add(refresh)
+        return {"access_token": access, "refresh_token": refresh, "id_token": uuid.uuid4().hex,
+                "expires_in": int(self._token_ttl), "scope": "openid offline_access comfortcloud.control"}
+
+    def _authorized(self, headers: typing.Mapping[str, str]) -> bool:
+        token = headers.get("x-user-authorization-v2", "").replace("Bearer ", "", 1)
+        now = time.time()
+        with self._lock:
+            if self._expire_every and now - self._last_expire >= self._expire_every:
+                self._access.clear()
+                self._last_expire = now
+            return self._access.get(token, 0) > now
+
+    def _parameters(self, guid: str) -> typing.Dict[str, typing.Any]:
+        """ Current parameters of the device, applying the commands that have taken effect """
+        now = time.time()
+        with self._lock:
+            device = self.devices[guid]
+            pending = self._pending.get(guid, [])
+            while pending and pending[0][0] <= now:
+                device["parameters"].update(pending.pop(0)[1])
+            return dict(device["parameters"])
+
+    def _history(self, guid: str, date: str) -> typing.Dict[str, typing.Any]:
+        """ Hourly consumption of the day, hours that have not started yet have no data (-255) """
+        start = datetime.datetime.strptime(date, "%Y%m%d").timestamp()
+        now = time.time()
+        index = list(self.devices).index(guid)
+        buckets = []
+        for hour in range(24):
+            elapsed = min(max(now - start - hour * 3600, 0), 3600) / 3600
+            consumption = round((0.2 + 0.1 * (index % 5)) * elapsed, 3) if elapsed else -255
+            buckets.append({"dataNumber": hour, "consumption": consumption, "cost": -255,
+                            "averageSettingTemp": 21.0, "averageInsideTemp": 20.0, "averageOutsideTemp": 5.0})
+        return {"energyConsumption": round(sum(b["consumption"] for b in buckets if b["consumption"] >= 0), 3),
+                "estimatedCost": -255, "currencyUnit": "", "historyDataList": buckets}
+
+    def handle(self, method: str, path: str, headers: typing.Mapping[str, str], body: typing.Any) -> Response:
+        """ Handle single request, returns status code, headers and JSON body """
+        path = path.split("?", 1)[0]
+        if path == "/_stats":
+            with self._lock:
+                return 200, {}, dict(self.requests)
+        if self._latency:
+            with self._lock:
+                latency = self._random.lognormvariate(0, self._sigma) * self._latency
+            time.sleep(latency)
+        with self._lock:
+            fail = self._random.random() < self._error_rate
+        if self._in_burst(time.time()):
+            self._count(f"burst_{self._burst_status}")
+            return self._burst_status, {"Retry-After": str(int(self._burst_length))}, {"message": "Burst"}
+        if fail:
+            self._count("error_502")
+            return 502, {}, {"message": "Bad Gateway"}
+
+        if method == "GET" and path == "/authorize":
+            # Redirect straight back to the app, this skips the username and password forms
+            self._count("authorize")
+            query = urlencode({"code": uuid.uuid4().hex, "state": "fake"})
+            return 302, {"Location": f"{constants.REDIRECT_URI}?{query}"}, {}
+        if method == "POST" and path == "/oauth/token":
+            self._count("token")
+            if body.get("grant_type") == "refresh_token":
+                with self._lock:
+                    if body.get("refresh_token") not in self._refresh:
+                        return 403, {}, {"error": "invalid_grant"}
+                    self._refresh.discard(body["refresh_token"])
+            return 200, {}, self._issue_token()
+
+        if not self._authorized(headers):
+            self._count("unauthorized")
+            return 401, {}, {"code": 4100, "message": "Token expires"}
+        if method == "POST" and path == "/auth/v2/login":
+            self._count("login")
+            return 200, {}, {"clientId": "fake-client"}
+        if method == "POST" and path == "/auth/v2/logout":
+            self._count("logout")
+            return 200, {}, {"result": 0}
+        if method == "GET" and path == "/device/group":
+            self._count("get_groups")
+            groups: typing.Dict[str, typing.List[typing.Dict[str, typing.Any]]] = {}
+            for guid, device in self.devices.items():
+                groups.setdefault(device["group"], []).append({
+                    "deviceGuid": guid, "deviceName": device["deviceName"],
+                    "deviceModuleNumber": device["deviceModuleNumber"], "parameters": self._parameters(guid)})
+            return 200, {}, {"groupList": [{"groupName": name, "deviceList": devices}
+                                           for name, devices in groups.items()]}
+        if method == "POST" and path == "/deviceStatus/control":
+            self._count("set_device")
+            guid = body.get("deviceGuid")
+            if guid not in self.devices:
+                return 404, {}, {"message": "Unknown device"}
+            with self._lock:
+                self._pending.setdefault(guid, []).append((time.time() + self._apply_delay, body["parameters"]))
+            return 200, {}, {"result": 0}
+        if method == "POST" and path == "/deviceHistoryData":
+            self._count("history")
+            guid = body.get("deviceGuid")
+            if guid not in self.devices:
+                return 404, {}, {"message": "Unknown device"}
+            if body.get("dataMode") != constants.DataMode.Day.value:
+                return 400, {}, {"message": "Only daily history is simulated"}
+            return 200, {}, self._history(guid, body["date"])
+        match = re.fullmatch(r"/deviceStatus/(?:now/)?(.+)", path)
+        if method == "GET" and match:
+            self._count("get_device")
+            # Client replaces %2F with f in the guid, none of the generated guids contain slashes
+            guid = unquote(match.group(1))
+            if guid not in self.devices:
+                return 404, {}, {"message": "Unknown device"}
+            return 200, {}, {"parameters": self._parameters(guid)}
+        self._count("not_found")
+        return 404, {}, {"message": "Not found"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    cloud: FakeCloud
+    protocol_version = "HTTP/1.1"
+
+    def _serve(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        status, response_headers, response = self.cloud.handle(method, self.path, headers, body)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in response_headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        log.debug(format, *args)
+
+
+def start_server(cloud: FakeCloud, port: int = 8080, address: str = "") -> ThreadingHTTPServer:
+    """ Serve the fake cloud from a daemon thread, port 0 picks a free one """
+    handler = type("Handler", (_Handler,), {"cloud": cloud})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fakecloud", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Panasonic Comfort Cloud API")
+    parser.add_argument("--address", type=str, default="", help="Address to bind to, default all")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on, default 8080")
+    parser.add_argument("--devices", type=int, default=10, help="Number of virtual devices, default 10")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Median response latency in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Probability of a random 502 response")
+    parser.add_argument("--burst-every", type=float, default=0, help="Seconds between error bursts, 0 disables")
+    parser.add_argument("--burst-length", type=float, default=0, help="Length of the error bursts in seconds")
+    parser.add_argument("--burst-status", type=int, default=429, choices=[429, 502],
+                        help="Status code returned during the bursts, default 429")
+    parser.add_argument("--token-ttl", type=float, default=3600, help="Access token lifetime, default 3600 s")
+    parser.add_argument("--expire-every", type=float, default=0,
+                        help="Revoke all access tokens every given seconds before they expire, 0 disables")
+    parser.add_argument("--apply-delay-ms", type=float, default=0,
+                        help="Milliseconds before commands show up in the device state")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cloud = FakeCloud(args.devices, args.latency_ms, error_rate=args.error_rate, burst_every=args.burst_every,
+                      burst_length=args.burst_length, burst_status=args.burst_status, token_ttl=args.token_ttl,
+                      expire_every=args.expire_every, apply_delay=args.apply_delay_ms / 1000)
+    server = start_server(cloud, args.port, args.address)
+    log.info("Fake Comfort Cloud with %i devices at http://%s:%i", args.devices,
+             args.address or "localhost", server.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        log.info("Requests: %s", json.dumps(cloud.requests))
+
+
+if __name__ == "__main__":
+    main()
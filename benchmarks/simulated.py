@@ -0,0 +1,162 @@
+"""
+Simulated Panasonic Comfort Cloud session and MQTT client for running the bridge without network.
+"""
+import random
+import threading
+import time
+import typing
+from paho.mqtt.client import MQTTMessage, MQTTMessageInfo, MQTT_ERR_SUCCESS
+from pcomfortcloud import constants
+from pcomfortcloud.exceptions import ResponseError
+
+
+class SimulatedCloud:
+    """
+    In-memory cloud with the given number of devices. Each request sleeps for a latency drawn from
+    log-normal distribution with the given median and fails with the given probability.
+    """
+
+    def __init__(self, devices: int, latency_ms: float = 2, latency_sigma: float = 0.5,
+                 error_rate: float = 0, seed: int = 1) -> None:
+        self._random = random.Random(seed)
+        self._latency = latency_ms / 1000
+        self._sigma = latency_sigma
+        self._error_rate = error_rate
+        self._lock = threading.Lock()
+        self.requests: typing.Dict[str, int] = {}
+        self.devices = [{"id": f"device-{i}", "name": f"Device {i}", "group": f"group-{i // 20}",
+                         "model": "CS-SIM"} for i in range(devices)]
+        self.parameters: typing.Dict[str, typing.Dict[str, typing.Any]] = {
+            device["id"]: {
+                "temperature": 21.0, "temperatureInside": 20 + i % 5, "temperatureOutside": 5,
+                "power": constants.Power.On, "mode": constants.OperationMode.Heat,
+                "fanSpeed": constants.FanSpeed.Auto, "airSwingHorizontal": constants.AirSwingLR.Auto,
+                "airSwingVertical": constants.AirSwingUD.Auto, "eco": constants.EcoMode.Auto,
+                "nanoe": constants.NanoeMode.On,
+            } for i, device in enumerate(self.devices)}
+
+    def request(self, name: str) -> None:
+        """ Simulate a single request """
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            latency = self._random.lognormvariate(0, self._sigma) * self._latency if self._latency else 0
+            fail = self._random.random() < self._error_rate
+        if latency:
+            time.sleep(latency)
+        if fail:
+            raise ResponseError(f"({name}: Expected status code 200, received: 502: Bad Gateway")
+
+    def session(self, username: str, password: str, **_kwargs: typing.Any) -> "SimulatedSession":
+        """ Session factory, usable as `session_wrapper` for the services """
+        return SimulatedSession(self)
+
+
+class SimulatedSession:
+    """ Implements the parts of `Session` used by the bridge """
+
+    def __init__(self, cloud: SimulatedCloud) -> None:
+        self._cloud = cloud
+        self._logged_in = False
+
+    def login(self) -> None:
+        self._cloud.request("login")
+        self._logged_in = True
+
+    def logout(self) -> None:
+        self._logged_in = False
+
+    def is_token_valid(self) -> bool:
+        return self._logged_in
+
+    def get_devices(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        self._cloud.request("get_devices")
+        return list(self._cloud.devices)
+
+    def get_device(self, device_id: str) -> typing.Dict[str, typing.Any]:
+        self._cloud.request("get_device")
+        return {"id": device_id, "parameters": dict(self._cloud.parameters[device_id])}
+
+    def set_device(self, device_id: str, **kwargs: typing.Any) -> bool:
+        self._cloud.request("set_device")
+        fields = {"airSwingHorizontal", "airSwingVertical", "fanSpeed", "mode", "power", "temperature",
+                  "eco", "nanoe"}
+        self._cloud.parameters[device_id].update({k: v for k, v in kwargs.items() if k in fields})
+        return True
+
+
+class FakeClient:
+    """
+    In-process stand-in for paho `Client`. Published messages are counted, incoming ones are
+    delivered with `deliver`.
+    """
+
+    def __init__(self, *_args: typing.Any, **_kwargs: typing.Any) -> None:
+        self.on_connect: typing.Any = None
+        self.on_message: typing.Any = None
+        self.on_publish: typing.Any = None
+        self.connected = False
+        self.subscriptions: typing.List[str] = []
+        self.subscribe_packets = 0
+        self.published = 0
+        self.published_bytes = 0
+        self._mid = 0
+        self._lock = threading.Lock()
+
+    def connect(self, *_args: typing.Any, **_kwargs: typing.Any) -> int:
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return MQTT_ERR_SUCCESS
+
+    def loop_start(self) -> int:
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, *_args: typing.Any) -> int:
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self, *_args: typing.Any) -> int:
+        self.connected = False
+        return MQTT_ERR_SUCCESS
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def subscribe(self, topic: typing.Any, qos: int = 0) -> typing.Tuple[int, int]:
+        # Single topic or list of (topic, qos) tuples sent in one packet, like paho
+        topics = [topic] if isinstance(topic, str) else [each[0] for each in topic]
+        with self._lock:
+            self.subscriptions.extend(topics)
+            self.subscribe_packets += 1
+            self._mid += 1
+            return MQTT_ERR_SUCCESS, self._mid
+
+    def unsubscribe(self, topic: typing.Any) -> typing.Tuple[int, int]:
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        with self._lock:
+            for each in topics:
+                if each in self.subscriptions:
+                    self.subscriptions.remove(each)
+            self._mid += 1
+            return MQTT_ERR_SUCCESS, self._mid
+
+    def will_set(self, *_args: typing.Any, **_kwargs: typing.Any) -> None:
+        pass
+
+    def publish(self, topic: str, payload: typing.Any = None, qos: int = 0,
+                retain: bool = False) -> MQTTMessageInfo:
+        with self._lock:
+            self._mid += 1
+            self.published += 1
+            self.published_bytes += len(payload.encode("utf-8") if isinstance(payload, str) else payload or b"")
+            info = MQTTMessageInfo(self._mid)
+        info.rc = MQTT_ERR_SUCCESS
+        info._set_as_published()
+        if self.on_publish:
+            self.on_publish(self, None, info.mid)
+        return info
+
+    def deliver(self, topic: str, payload: str) -> None:
+        """ Deliver incoming message as if it was received from the broker """
+        message = MQTTMessage(topic=topic.encode("utf-8"))
+        message.payload = payload.encode("utf-8")
+        self.on_message(self, None, message)
@@ -2,9 +2,16 @@
 import argparse
 import os
 import logging
+import socket
+import typing
+from pcomfortcloud import constants
 
+from pcfmqtt.accounts import Account, load_accounts
+from pcfmqtt.cluster import Cluster
 from pcfmqtt.mqtt import Mqtt
 from pcfmqtt.service import Service
+from pcfmqtt.aio import AsyncMqtt, AsyncService
+from pcfmqtt import hooks, metrics
 
 logger_mapping = {
     "DEBUG": logging.DEBUG,
@@ -22,6 +29,9 @@ def main():
                         help="Panasonic Comfort Cloud username, usually email address. Environment variable `USERNAME`")
     parser.add_argument('-P', '--password', type=str, default=os.environ.get('PASSWORD'),
                         help="Panasonic Comfort Cloud password. Environment variable `PASSWORD`")
+    parser.add_argument('-a', '--accounts', type=str, default=os.environ.get('ACCOUNTS_FILE'),
+                        help="JSON file with several Panasonic Comfort Cloud accounts to serve instead of " \
+                        "`--username` and `--password`. Thread engine only. Environment variable `ACCOUNTS_FILE`.")
     parser.add_argument('-s', '--server', type=str, default=os.environ.get('MQTT') or "localhost",
                         help="MQTT server address, default `localhost`. Environment variable: `MQTT`")
     parser.add_argument('-p', '--port', type=int, default=os.environ.get('MQTT_PORT') or 1883,
@@ -31,6 +41,101 @@ def main():
                         "as this might cause too many request error from the API. Environment variable `UPDATE_INTERVAL`.")
     parser.add_argument('-t', '--topic', type=str, default=os.environ.get('TOPIC_PREFIX') or "homeassistant",
                         help="MQTT discovery topic prefix, default `homeassistant`. Environment variable TOPIC_PREFIX.")
+    parser.add_argument('-w', '--workers', type=int, default=os.environ.get('POLL_WORKERS') or 1,
+                        help="Number of devices polled and commanded in parallel, default 1. Environment variable " \
+                        "`POLL_WORKERS`.")
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        default=os.environ.get('BULK_REFRESH', '').lower() in ('1', 'true', 'yes'),
+                        help="Refresh device states from a single group listing instead of one request per " \
+                        "device. Thread engine only. Environment variable `BULK_REFRESH`.")
+    parser.add_argument('--state-max-age', type=float, default=os.environ.get('STATE_MAX_AGE') or 300,
+                        help="Seconds after which unchanged device state is published again, 0 publishes every " \
+                        "update. Default 300. Environment variable `STATE_MAX_AGE`.")
+    parser.add_argument('--retain', action='store_true',
+                        default=os.environ.get('RETAIN_STATE', '').lower() in ('1', 'true', 'yes'),
+                        help="Publish device state as retained. Environment variable `RETAIN_STATE`.")
+    parser.add_argument('--attribute-topics', action='store_true',
+                        default=os.environ.get('ATTRIBUTE_TOPICS', '').lower() in ('1', 'true', 'yes'),
+                        help="Publish each state attribute to its own topic and only the attributes that changed, " \
+                        "instead of the full state JSON. Environment variable `ATTRIBUTE_TOPICS`.")
+    parser.add_argument('--state-qos', type=int, default=os.environ.get('STATE_QOS') or 0, choices=[0, 1, 2],
+                        help="MQTT QoS of the device state messages, default 0. Environment variable `STATE_QOS`.")
+    parser.add_argument('--discovery-qos', type=int, default=os.environ.get('DISCOVERY_QOS') or 0,
+                        choices=[0, 1, 2],
+                        help="MQTT QoS of the discovery and cluster messages, default 0. Environment variable " \
+                        "`DISCOVERY_QOS`.")
+    parser.add_argument('--max-inflight', type=int, default=os.environ.get('MQTT_MAX_INFLIGHT') or 20,
+                        help="Messages handed to the MQTT client but not yet published, default 20. Environment " \
+                        "variable `MQTT_MAX_INFLIGHT`.")
+    parser.add_argument('--publish-queue', type=int, default=os.environ.get('PUBLISH_QUEUE') or 1000,
+                        help="Messages waiting for room in the in-flight window, default 1000. Newer message " \
+                        "replaces a queued one for the same topic. Environment variable `PUBLISH_QUEUE`.")
+    parser.add_argument('--drop-policy', type=str, default=os.environ.get('DROP_POLICY') or "oldest",
+                        choices=["oldest", "newest", "block"],
+                        help="Message dropped when the publish queue is full, `block` waits for room before " \
+                        "dropping the new message. Discovery and cluster messages are never dropped. Default `oldest`. " \
+                        "Environment variable `DROP_POLICY`.")
+    parser.add_argument('-c', '--coalesce', type=int, default=os.environ.get('COMMAND_COALESCE_MS') or 0,
+                        help="Milliseconds to wait for further commands before sending them to the cloud as a " \
+                        "single update, default 0. Environment variable `COMMAND_COALESCE_MS`.")
+    parser.add_argument('--optimistic', action='store_true',
+                        default=os.environ.get('OPTIMISTIC', '').lower() in ('1', 'true', 'yes'),
+                        help="Report commands to HA right away instead of after the cloud has accepted them. " \
+                        "Failed commands are reverted. Environment variable `OPTIMISTIC`.")
+    parser.add_argument('-r', '--rate-limit', type=int, default=os.environ.get('RATE_LIMIT') or 60,
+                        help="Maximum Panasonic Comfort Cloud requests per minute, fifth of which is reserved " \
+                        "for commands. Default 60. Environment variable `RATE_LIMIT`.")
+    parser.add_argument('--token-dir', type=str, default=os.environ.get('TOKEN_DIR') or "~/.pcfmqtt",
+                        help="Directory where login tokens are stored per account and reused over restarts, " \
+                        "default `~/.pcfmqtt`. Environment variable `TOKEN_DIR`.")
+    parser.add_argument('--snapshot', type=str, default=os.environ.get('SNAPSHOT_FILE'),
+                        help="File for storing the devices and their last state. On start the devices are " \
+                        "introduced to HA from it right away and reconciled with the cloud in the background. " \
+                        "Thread engine only. Environment variable `SNAPSHOT_FILE`.")
+    parser.add_argument('--retry-file', type=str, default=os.environ.get('RETRY_FILE'),
+                        help="File for storing the device updates that failed and are waiting to be retried, so " \
+                        "they are not lost on restart. Environment variable `RETRY_FILE`.")
+    parser.add_argument('--energy-interval', type=int, default=os.environ.get('ENERGY_INTERVAL') or 0,
+                        help="Seconds between energy history fetches per device, published as HA energy sensor. " \
+                        "Disabled by default, 3600 is recommended. Thread engine only. Environment variable " \
+                        "`ENERGY_INTERVAL`.")
+    parser.add_argument('--energy-file', type=str, default=os.environ.get('ENERGY_FILE'),
+                        help="File for storing the energy meters so the totals continue over restarts. " \
+                        "Environment variable `ENERGY_FILE`.")
+    parser.add_argument('--history', action='store_true',
+                        default=os.environ.get('HISTORY', '').lower() in ('1', 'true', 'yes'),
+                        help="Keep a week of temperature readings per device in memory and answer history " \
+                        "requests on `pcfmqtt/history/request`. Thread engine only. Environment variable `HISTORY`.")
+    parser.add_argument('--history-qos', type=int, default=os.environ.get('HISTORY_QOS') or 0, choices=[0, 1, 2],
+                        help="MQTT QoS of the history responses, default 0. Environment variable `HISTORY_QOS`.")
+    parser.add_argument('-m', '--metrics-port', type=int, default=os.environ.get('METRICS_PORT') or 0,
+                        help="Port for serving Prometheus metrics at `/metrics`, disabled by default. " \
+                        "Environment variable `METRICS_PORT`.")
+    parser.add_argument('--trace-summary', action='store_true',
+                        default=os.environ.get('TRACE_SUMMARY', '').lower() in ('1', 'true', 'yes'),
+                        help="Log time spent per operation after each update cycle. Thread engine only. " \
+                        "Environment variable `TRACE_SUMMARY`.")
+    parser.add_argument('--trace-file', type=str, default=os.environ.get('TRACE_FILE'),
+                        help="Write every traced operation as JSON line to the given file, along with the device id " \
+                        "or MQTT topic. `mqtt.publish` times queueing the message, not the broker I/O. Environment " \
+                        "variable `TRACE_FILE`.")
+    parser.add_argument('-e', '--engine', type=str, default=os.environ.get('ENGINE') or "thread",
+                        choices=["thread", "asyncio"],
+                        help="Service engine, `thread` runs the blocking polling loop and `asyncio` runs polling, " \
+                        "commands and discovery on a single event loop with `--workers` cloud requests in flight. " \
+                        "Default `thread`. Environment variable `ENGINE`.")
+    parser.add_argument('--cluster', type=str, default=os.environ.get('CLUSTER'),
+                        help="Share the devices with the other instances of the same cluster name. Each device is " \
+                        "polled and commanded by one instance and devices of a stopped instance are taken over by " \
+                        "the others. Thread engine only. Environment variable `CLUSTER`.")
+    parser.add_argument('--instance-id', type=str,
+                        default=os.environ.get('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}",
+                        help="Unique name of this instance within the cluster, default `<hostname>-<pid>`. " \
+                        "Environment variable `INSTANCE_ID`.")
+    parser.add_argument('--cloud-url', type=str, default=os.environ.get('CLOUD_URL'),
+                        help="Use the given address for both Panasonic Comfort Cloud authentication and API, eg. " \
+                        "`http://localhost:8080` for `python3 -m benchmarks.fakecloud`. Environment variable " \
+                        "`CLOUD_URL`.")
     parser.add_argument('-l', '--log', type=str, default=os.environ.get('LOG_LEVEL') or "INFO",
                         choices=logger_mapping.keys(),
                         help="Logging level to use, defaults to INFO")
@@ -43,17 +148,74 @@ def main():
     handler.setFormatter(logger_format)
     logging.root.addHandler(handler)
 
-    if not args.username or not args.password or not args.server or not args.port or not args.topic:
+    if not args.accounts and (not args.username or not args.password):
         exit(parser.print_usage())
+    if not args.server or not args.port or not args.topic:
+        exit(parser.print_usage())
+    if args.accounts and args.engine == "asyncio":
+        parser.error("--accounts is supported by the thread engine only")
+    if args.cluster and args.engine == "asyncio":
+        parser.error("--cluster is supported by the thread engine only")
+    if args.energy_interval and args.engine == "asyncio":
+        parser.error("--energy-interval is supported by the thread engine only")
+    if args.history and args.engine == "asyncio":
+        parser.error("--history is supported by the thread engine only")
+    if args.snapshot and args.engine == "asyncio":
+        parser.error("--snapshot is supported by the thread engine only")
+    if args.trace_summary and args.engine == "asyncio":
+        parser.error("--trace-summary is supported by the thread engine only")
+    if args.bulk and args.engine == "asyncio":
+        parser.error("--bulk is supported by the thread engine only")
     username: str = args.username
     password: str = args.password
     server: str = args.server
     port: int = args.port
     topic: str = args.topic
     interval: int = args.interval
+    workers: int = args.workers
+    bulk: bool = args.bulk
+    state_max_age: float = args.state_max_age
+    retain: bool = args.retain
+    coalesce: int = args.coalesce
+    qos = {"state": args.state_qos, "energy": args.state_qos, "discovery": args.discovery_qos,
+           "cluster": args.discovery_qos, "history": args.history_qos}
+    publish_options = dict(qos=qos, max_inflight=args.max_inflight, max_queue=args.publish_queue,
+                           drop_policy=args.drop_policy, attribute_topics=args.attribute_topics)
+    rate_limit: int = args.rate_limit
+    token_dir: str = args.token_dir
+    snapshot_file: typing.Optional[str] = os.path.expanduser(args.snapshot) if args.snapshot else None
+    retry_file: typing.Optional[str] = os.path.expanduser(args.retry_file) if args.retry_file else None
 
-    mqtt = Mqtt(server, port, topic)
-    s = Service(username, password, mqtt, interval)
+    if args.cloud_url:
+        constants.BASE_PATH_AUTH = constants.BASE_PATH_ACC = args.cloud_url.rstrip('/')
+        logging.warning("Using Panasonic Comfort Cloud at %s", constants.BASE_PATH_ACC)
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+    if args.trace_file:
+        hooks.register(hooks.FileHook(args.trace_file))
+    if args.engine == "asyncio":
+        async_mqtt = AsyncMqtt(server, port, topic, state_max_age=state_max_age, retain_state=retain,
+                               **publish_options)
+        AsyncService(username, password, async_mqtt, interval, max_inflight=workers,
+                     coalesce_ms=coalesce, requests_per_minute=rate_limit,
+                     token_dir=token_dir, optimistic=args.optimistic, retry_file=retry_file).start()
+        return
+    accounts: typing.Optional[typing.List[Account]] = None
+    if args.accounts:
+        try:
+            accounts = load_accounts(os.path.expanduser(args.accounts), requests_per_minute=rate_limit,
+                                     token_dir=token_dir)
+        except ValueError as e:
+            parser.error(str(e))
+    cluster = Cluster(args.cluster, args.instance_id) if args.cluster else None
+    mqtt = Mqtt(server, port, topic, state_max_age=state_max_age, retain_state=retain,
+                energy_sensor=bool(args.energy_interval), **publish_options)
+    s = Service(username, password, mqtt, interval, poll_workers=workers, bulk_refresh=bulk,
+                coalesce_ms=coalesce, requests_per_minute=rate_limit, token_dir=token_dir,
+                snapshot_file=snapshot_file, trace_summary=args.trace_summary, accounts=accounts,
+                cluster=cluster, energy_interval=args.energy_interval,
+                energy_file=os.path.expanduser(args.energy_file) if args.energy_file else None,
+                history=args.history, optimistic=args.optimistic, retry_file=retry_file)
     s.start()
 
 
@@ -0,0 +1,121 @@
+"""
+Panasonic Comfort Cloud accounts served by a single bridge.
+"""
+import json
+import re
+import time
+import typing
+import logging
+from pcomfortcloud.exceptions import Error
+from pcomfortcloud.session import Session
+from pcfmqtt.device import Device
+from pcfmqtt.ratelimit import CircuitBreaker, GuardedSession, TokenBucket
+from pcfmqtt import tokens
+
+log = logging.getLogger(__name__)
+
+# Account name prefixes the device ids and MQTT topics
+_NAME = re.compile(r"[A-Za-z0-9_-]*")
+
+
+class Account:
+    """
+    Single Panasonic Comfort Cloud account with its own session, request budget and devices.
+
+    Budget and breaker are kept over the sessions so they survive reconnects. Fifth of the budget is
+    kept for the commands.
+    """
+
+    def __init__(self, username: str, password: str, name: str = "",
+                 session_wrapper: type[Session] = Session, requests_per_minute: int = 60,
+                 token_dir: typing.Optional[str] = None) -> None:
+        self.name = name
+        self.username = username
+        self._password = password
+        self._wrapper_session = session_wrapper
+        # Token is stored per account and reused over restarts and reconnects
+        self._token_file: typing.Optional[str] = tokens.token_file(token_dir, username) if token_dir else None
+        self._bucket = TokenBucket(requests_per_minute)
+        self._breaker = CircuitBreaker()
+        self._reserve = requests_per_minute / 5
+        self.session: GuardedSession = self._new_session()
+        # Devices have been listed with the current session
+        self.listed = False
+        self.devices: typing.Dict[str, Device] = {}
+        self.retry_at: float = 0  # Next connection attempt after a failed one
+
+    def __str__(self) -> str:
+        return self.name or self.username
+
+    def _new_session(self) -> GuardedSession:
+        if self._token_file:
+            session = self._wrapper_session(self.username, self._password, tokenFileName=self._token_file)
+        else:
+            session = self._wrapper_session(self.username, self._password)
+        return GuardedSession(session, self._bucket, self._breaker, self._reserve)
+
+    def login(self):
+        tokens.prepare(self._token_file)
+        self.session.login()
+        tokens.restrict(self._token_file)
+        self.retry_at = 0
+
+    def logout(self):
+        # Logging out would invalidate the stored token
+        if not self._token_file:
+            self.session.logout() # type: ignore
+
+    def handle_session_error(self, error: Error):
+        """
+        Start from a fresh session with full login if the token was rejected. Other errors are
+        transient and the session along with its token is kept.
+        """
+        if tokens.is_token_rejected(error):
+            log.warning("%s: Token rejected, logging in again", self)
+            tokens.discard(self._token_file)
+            self.session = self._new_session()
+            self.listed = False
+
+    def connection_failed(self, error: Error):
+        """ Next connection attempt is made after a minute, longer if backing off """
+        self.handle_session_error(error)
+        self.retry_at = max(self.session.next_allowed(), time.time() + 60)
+
+
+def load_accounts(path: str, session_wrapper: type[Session] = Session, requests_per_minute: int = 60,
+                  token_dir: typing.Optional[str] = None) -> typing.List[Account]:
+    """
+    Read the accounts from JSON file in format,
+
+        {"accounts": [{"name": "home", "username": "user@dev.null", "password": "123password",
+                       "rate_limit": 60}]}
+
+    Name is prefixed to the device ids so it is required when there are more than one account.
+    Rate limit is optional and defaults to `requests_per_minute`.
+
+    @raise ValueError: if the file is not a valid accounts file
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries = data["accounts"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Unable to read accounts from {path}: {e!r}") from e
+    accounts: typing.List[Account] = []
+    names: typing.Set[str] = set()
+    for entry in entries:
+        name = entry.get("name", "")
+        if not entry.get("username") or not entry.get("password"):
+            raise ValueError(f"Account {name!r} is missing username or password")
+        if not _NAME.fullmatch(name):
+            raise ValueError(f"Account name {name!r} may only contain letters, digits, '_' and '-'")
+        if name and name in names:
+            raise ValueError(f"Account name {name!r} is not unique")
+        names.add(name)
+        accounts.append(Account(entry["username"], entry["password"], name, session_wrapper,
+                                entry.get("rate_limit", requests_per_minute), token_dir))
+    if not accounts:
+        raise ValueError(f"No accounts in {path}")
+    if len(accounts) > 1 and "" in names:
+        raise ValueError("Account name is required when there are more than one account")
+    return accounts
@@ -0,0 +1,97 @@
+"""
+Per-device mailboxes served by a shared worker pool.
+"""
+import collections
+import functools
+import threading
+import typing
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+
+log = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+class DeviceActors:
+    """
+    Runs jobs for each device one at a time in the order they were submitted. Jobs for different
+    devices run in parallel on the worker pool.
+
+    Each worker run handles a single job and requeues the mailbox if there is more, so a device with
+    a long queue can't starve the others. Mailboxes with a priority job (commands) are served before
+    the rest, so a command does not wait behind the polls of the other devices.
+    """
+
+    def __init__(self, workers: int = 1) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="device")
+        self._lock = threading.Lock()
+        self._mailboxes: typing.Dict[
+            str, typing.Deque[typing.Tuple[float, typing.Callable[[], typing.Any], Future, bool]]] = {}
+        self._active: typing.Set[str] = set()
+        # Mailboxes waiting for a worker, one executor run has been submitted for each
+        self._urgent: typing.Deque[str] = collections.deque()
+        self._ready: typing.Deque[str] = collections.deque()
+        self._waited = 0.0  # Total time jobs have waited in the mailboxes
+        self._max_wait = 0.0
+        self._jobs = 0
+
+    def submit(self, key: str, func: typing.Callable[..., T], *args: typing.Any,
+               priority: bool = False) -> "Future[T]":
+        """ Queue job to the device mailbox, returns immediately """
+        future: "Future[T]" = Future()
+        with self._lock:
+            self._mailboxes.setdefault(key, collections.deque()).append(
+                (time(), functools.partial(func, *args), future, priority))
+            if key not in self._active:
+                self._active.add(key)
+                self._enqueue(key)
+            elif priority and key in self._ready:
+                self._ready.remove(key)
+                self._urgent.append(key)
+        return future
+
+    def _enqueue(self, key: str) -> None:
+        """ Wait for a worker, in the urgent lane if there is a priority job in the mailbox """
+        if any(job[3] for job in self._mailboxes[key]):
+            self._urgent.append(key)
+        else:
+            self._ready.append(key)
+        self._executor.submit(self._run_next)
+
+    def _run_next(self) -> None:
+        with self._lock:
+            key = self._urgent.popleft() if self._urgent else self._ready.popleft()
+            enqueued, job, future, _ = self._mailboxes[key].popleft()
+            wait = time() - enqueued
+            self._waited += wait
+            self._max_wait = max(self._max_wait, wait)
+            self._jobs += 1
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(job())
+            except BaseException as e:
+                future.set_exception(e)
+        with self._lock:
+            if self._mailboxes[key]:
+                self._enqueue(key)
+            else:
+                self._active.discard(key)
+
+    def queue_depth(self, key: typing.Optional[str] = None) -> int:
+        """ Number of queued jobs for the device or for all devices """
+        with self._lock:
+            if key is not None:
+                return len(self._mailboxes.get(key, ()))
+            return sum(len(mailbox) for mailbox in self._mailboxes.values())
+
+    def wait_stats(self) -> typing.Tuple[int, float, float]:
+        """ Number of jobs started, their average and maximum wait in seconds since the last call """
+        with self._lock:
+            jobs, waited, max_wait = self._jobs, self._waited, self._max_wait
+            self._jobs, self._waited, self._max_wait = 0, 0.0, 0.0
+        return jobs, waited / jobs if jobs else 0.0, max_wait
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,333 @@
+"""
+Asyncio engine for pcfmqtt.
+
+Runs polling, commands and discovery as coroutines on a single event loop. MQTT socket I/O is driven
+by the event loop directly instead of paho's network thread. Panasonic Comfort Cloud client is
+blocking so the cloud calls are offloaded to a bounded executor.
+"""
+import asyncio
+import functools
+import time
+import typing
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
+from pcomfortcloud.session import Session
+from pcomfortcloud.exceptions import Error
+from pcfmqtt.convergence import Convergence
+from pcfmqtt.device import Device
+from pcfmqtt.mqtt import Mqtt
+from pcfmqtt.ratelimit import CircuitBreaker, GuardedSession, TokenBucket
+from pcfmqtt.retry import RetryQueue
+from pcfmqtt import metrics, tokens
+
+log = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+class AsyncSession:
+    """
+    Awaitable wrapper for the blocking `Session`
+    """
+
+    def __init__(self, session: GuardedSession, max_inflight: int = 8) -> None:
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="cc")
+
+    async def run(self, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any) -> T:
+        """ Run blocking call in the executor """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def login(self) -> None:
+        await self.run(self.session.login)
+
+    async def get_devices(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return await self.run(self.session.get_devices) # type: ignore
+
+    async def get_device(self, device_id: str) -> typing.Dict[str, typing.Any]:
+        return await self.run(self.session.get_device, device_id) # type: ignore
+
+    async def set_device(self, device_id: str, **kwargs: typing.Any) -> bool:
+        return await self.run(self.session.set_device, device_id, **kwargs) # type: ignore
+
+    async def logout(self) -> None:
+        await self.run(self.session.logout)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+class AsyncMqtt(Mqtt):
+    """
+    MQTT client driven by the asyncio event loop.
+
+    Instead of starting paho's network thread the client socket is registered to the running event
+    loop, so all the callbacks are executed in the loop thread.
+    """
+
+    # Client is only used from the event loop, messages are handed to it right away
+    _publish_thread = False
+
+    def __init__(self, broker: str, port: int, topic_prefix: str, mqtt_wrapper: type[Client] = Client,
+                 state_max_age: float = 300, retain_state: bool = False,
+                 qos: typing.Optional[typing.Dict[str, int]] = None, max_inflight: int = 20,
+                 max_queue: int = 1000, drop_policy: str = "oldest", attribute_topics: bool = False,
+                 energy_sensor: bool = False):
+        super().__init__(broker, port, topic_prefix, mqtt_wrapper, state_max_age, retain_state,
+                         qos, max_inflight, max_queue, drop_policy, attribute_topics, energy_sensor)
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._misc: typing.Optional[asyncio.Task[None]] = None
+
+    def _on_socket_open(self, client: Client, userdata: typing.Any, sock: typing.Any):
+        self._loop.add_reader(sock, client.loop_read) # type: ignore
+
+    def _on_socket_close(self, client: Client, userdata: typing.Any, sock: typing.Any):
+        self._loop.remove_reader(sock) # type: ignore
+
+    def _on_socket_register_write(self, client: Client, userdata: typing.Any, sock: typing.Any):
+        self._loop.add_writer(sock, client.loop_write) # type: ignore
+
+    def _on_socket_unregister_write(self, client: Client, userdata: typing.Any, sock: typing.Any):
+        self._loop.remove_writer(sock) # type: ignore
+
+    async def _misc_loop(self):
+        """ Keepalives and reconnects, replaces the housekeeping done by paho's network thread """
+        while True:
+            if self._client.loop_misc() != MQTT_ERR_SUCCESS: # type: ignore
+                log.warning("MQTT connection lost, reconnecting")
+                try:
+                    self._client.reconnect() # type: ignore
+                    self._last_state = {}
+                    self.send_discovery_events(self._last_discovery_devices, force=True)
+                except OSError as e:
+                    log.error("MQTT reconnect failed: %s", e)
+            await asyncio.sleep(1)
+
+    def connect(self, message_callback: typing.Callable[[str, str, str], None]) -> None:
+        """ Connect to MQTT, must be called from the event loop """
+        self._msg_callback = message_callback
+        self._loop = asyncio.get_running_loop()
+        if self._misc:
+            self._misc.cancel()
+        log.info("Connecting to MQTT broker at %s:%s", self._broker, self._port)
+        self._ready.clear()
+        self._client = self._mqtt_wrapper()
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+        self._publisher.attach(self._client, self._recover)
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._client.connect(self._broker, self._port, 60) # type: ignore
+        self._misc = self._loop.create_task(self._misc_loop())
+        log.info("MQTT started")
+
+    def disconnect(self) -> None:
+        """ Disconnect from MQTT """
+        log.info("Disconnecting from MQTT")
+        if self._misc:
+            self._misc.cancel()
+            self._misc = None
+        self._client.disconnect() # type: ignore
+
+
+class AsyncService:
+    """
+    Main service running on asyncio.
+
+    Each device is polled by its own coroutine which sleeps until the device is next due for update
+    or until a command wakes it up. Polls and commands for the same device are serialized.
+    """
+
+    def __init__(self, username: str, password: str, mqtt: AsyncMqtt, update_interval: int = 60,
+                 session_wrapper: type[Session] = Session, max_inflight: int = 8, coalesce_ms: int = 0,
+                 requests_per_minute: int = 60, token_dir: typing.Optional[str] = None,
+                 optimistic: bool = False, retry_file: typing.Optional[str] = None) -> None:
+        self._username = username
+        self._password = password
+        self._mqtt = mqtt
+        self._update_interval = update_interval
+        self._max_inflight = max_inflight
+        self._coalesce_ms = coalesce_ms
+        self._optimistic = optimistic
+        self._convergence = Convergence()
+        self._retries = RetryQueue(retry_file)
+        metrics.RETRY_QUEUE_DEPTH.set_function(lambda: [((), self._retries.depth())])
+        self._wrapper_session = session_wrapper
+        self._token_file: typing.Optional[str] = tokens.token_file(token_dir, username) if token_dir else None
+        self._bucket = TokenBucket(requests_per_minute)
+        self._breaker = CircuitBreaker()
+        self._reserve = requests_per_minute / 5
+        self._session = self._new_session()
+        # Devices have been listed with the current session, it is replaced when the token is rejected
+        self._listed = False
+        self._session_lock = asyncio.Lock()
+        self._devices: typing.Dict[str, Device] = {}
+        self._locks: typing.Dict[str, asyncio.Lock] = {}
+        self._wakeups: typing.Dict[str, asyncio.Event] = {}
+        self._tasks: typing.Set[asyncio.Task[None]] = set()
+
+    def _new_session(self) -> AsyncSession:
+        if self._token_file:
+            session = self._wrapper_session(self._username, self._password, tokenFileName=self._token_file)
+        else:
+            session = self._wrapper_session(self._username, self._password)
+        return AsyncSession(GuardedSession(session, self._bucket, self._breaker, self._reserve), self._max_inflight)
+
+    def _renew_session(self) -> None:
+        """ Start from a fresh session with full login, the rejected token is discarded """
+        tokens.discard(self._token_file)
+        self._session.close()
+        self._session = self._new_session()
+        self._listed = False
+
+    def _spawn(self, coro: typing.Coroutine[typing.Any, typing.Any, None]) -> None:
+        """ Run coroutine in background, keeping reference until it is done """
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _register(self, device: Device) -> None:
+        self._devices[device.get_id()] = device
+        self._locks[device.get_id()] = asyncio.Lock()
+        self._wakeups[device.get_id()] = asyncio.Event()
+
+    async def connect_to_cc(self) -> bool:
+        """
+        Connect to Panasonic Comfort Cloud and populate the devices. State is fetched by the device
+        coroutines once they are started.
+
+        @return: True if connected, False otherwise
+        """
+        log.info("Connecting to Panasonic Comfort Cloud..")
+        try:
+            tokens.prepare(self._token_file)
+            await self._session.login()
+            tokens.restrict(self._token_file)
+            log.info("Login succesfull. Reading and populating devices")
+            devices = [Device(raw, self._coalesce_ms / 1000, optimistic=self._optimistic,
+                              convergence=self._convergence, retries=self._retries) for raw in await self._session.get_devices()]
+            for device in devices:
+                self._register(device)
+            self._mqtt.introduce_devices(devices)
+        except Error as e:
+            log.error("Failed initialization to Panasonic Comfort Cloud: %s", e)
+            if tokens.is_token_rejected(e):
+                self._renew_session()
+            return False
+        self._listed = True
+        log.info("Total %i devices found", len(self._devices))
+        log.info("Connected to Panasonic Comfort Cloud")
+        return True
+
+    async def _handle_session_error(self, session: AsyncSession, error: Error):
+        """
+        Log in again with a fresh session if the token was rejected, the way the thread engine does.
+        Devices are kept, they only need to be listed with the new session. Listing is tried again on
+        the next error until it succeeds.
+        """
+        async with self._session_lock:
+            if session is not self._session:
+                # Already replaced after an error of another device
+                return
+            if tokens.is_token_rejected(error):
+                log.warning("Token rejected, logging in again")
+                self._renew_session()
+            if self._listed:
+                return
+            try:
+                tokens.prepare(self._token_file)
+                await self._session.login()
+                tokens.restrict(self._token_file)
+                await self._session.get_devices()
+                self._listed = True
+                log.info("Logged in to Panasonic Comfort Cloud again")
+            except Error as e:
+                log.error("Failed to log in to Panasonic Comfort Cloud again: %s", e)
+
+    async def _device_loop(self, device: Device):
+        """ Keep single device up to date """
+        wakeup = self._wakeups[device.get_id()]
+        while True:
+            session = self._session
+            try:
+                async with self._locks[device.get_id()]:
+                    if await session.run(device.update_state, session.session, self._update_interval):
+                        self._mqtt.send_state_event(device)
+            except Error as e:
+                log.warning("%s: Error in Panasonic Comfort Cloud: %r", device.get_name(), e)
+                await self._handle_session_error(session, e)
+            # Respect the backoff after errors
+            delay = max(device.get_refresh_time(), self._session.session.next_allowed()) - time.time()
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _command(self, device: Device, command: str, payload: str, received: float):
+        session = self._session
+        try:
+            async with self._locks[device.get_id()]:
+                changed = await session.run(device.command, session.session, command, payload, received)
+            if changed:
+                self._mqtt.send_state_event(device)
+                log.info("%s: Reported state change, sending update to HA", device.get_name())
+            else:
+                log.debug("%s: Reported no state change, ignoring", device.get_name())
+        except Error as e:
+            log.exception("%s: Command failed: %r", device.get_name(), e)
+            await self._handle_session_error(session, e)
+        except Exception as e:
+            log.exception("%s: Command failed: %r", device.get_name(), e)
+        # Command reschedules the next refresh
+        self._wakeups[device.get_id()].set()
+
+    def handle_message(self, device_id: str, command: str, payload: str):
+        """ MQTT message callback, runs in the event loop thread """
+        device = self._devices.get(device_id)
+        if device:
+            self._spawn(self._command(device, command, payload, time.time()))
+        else:
+            log.debug("No device for this event, ignoring")
+
+    async def run(self):
+        """
+        Run the service until cancelled
+        """
+        self._mqtt.connect(self.handle_message)
+        try:
+            while not await self.connect_to_cc():
+                await asyncio.sleep(max(self._session.session.next_allowed() - time.time(), 60))
+            for device in self._devices.values():
+                self._spawn(self._device_loop(device))
+            while True:
+                # Check discovery configurations once an hour, only the changed ones are sent
+                self._mqtt.send_discovery_events(list(self._devices.values()))
+                log.info("Discovery cycle done for all devices")
+                await asyncio.sleep(60*60)
+        finally:
+            log.info("Shutting down")
+            for task in list(self._tasks):
+                task.cancel()
+            self._mqtt.disconnect()
+            # Logging out would invalidate the stored token
+            if not self._token_file:
+                try:
+                    await self._session.logout()
+                except Error as e:
+                    log.warning("Logout failed: %r", e)
+            self._session.close()
+            log.info("Shutdown complete")
+
+    def start(self):
+        """
+        Start the service
+        """
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt as e:
+            log.exception("Interrupted: %r", e)
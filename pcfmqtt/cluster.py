@@ -0,0 +1,87 @@
+"""
+Partitioning of the devices between bridge instances sharing the same accounts.
+"""
+import bisect
+import hashlib
+import threading
+import time
+import typing
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    # Built-in hash is randomized per process so it can't be used to agree on the owners
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of the members. Each member is placed on the ring multiple times so the keys
+    spread evenly and only the keys of a joining or leaving member move.
+    """
+
+    def __init__(self, members: typing.Iterable[str], replicas: int = 100) -> None:
+        points = sorted((_hash(f"{member}#{i}"), member) for member in members for i in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._members = [point[1] for point in points]
+
+    def owner(self, key: str) -> str:
+        """ Member owning the key, first one clockwise from the key on the ring """
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[index]
+
+
+class Cluster:
+    """
+    Membership of the bridge instances. Instances announce themselves with heartbeats and are
+    considered gone after missing them for `timeout` seconds or after announcing they are offline.
+    Devices are assigned to the live instances by consistent hashing of their cloud id.
+    """
+
+    def __init__(self, name: str, instance: str, heartbeat_interval: float = 10, timeout: float = 0) -> None:
+        self.name = name
+        self.instance = instance
+        self.heartbeat_interval = heartbeat_interval
+        self._timeout = timeout or heartbeat_interval * 3.5
+        self._lock = threading.Lock()
+        self._seen: typing.Dict[str, float] = {}  # Last heartbeat per peer
+        self._members: typing.Tuple[str, ...] = (instance,)
+        self._ring = HashRing(self._members)
+
+    def heartbeat(self, member: str, payload: str, now: typing.Optional[float] = None) -> bool:
+        """
+        Record heartbeat from a peer, returns True if it may change the membership
+        """
+        if member == self.instance:
+            return False
+        with self._lock:
+            if payload == "offline":
+                return self._seen.pop(member, None) is not None
+            known = member in self._seen
+            self._seen[member] = now if now is not None else time.time()
+            return not known
+
+    def refresh(self, now: typing.Optional[float] = None) -> bool:
+        """ Drop the peers that have gone silent and update the ring, returns True if membership changed """
+        now = now if now is not None else time.time()
+        with self._lock:
+            for member, seen in list(self._seen.items()):
+                if seen + self._timeout < now:
+                    log.warning("Instance %s missed its heartbeats, taking over its devices", member)
+                    del self._seen[member]
+            members = tuple(sorted([self.instance] + list(self._seen)))
+            if members == self._members:
+                return False
+            self._members = members
+            self._ring = HashRing(members)
+        log.info("Cluster members changed: %s", ", ".join(members))
+        return True
+
+    def members(self) -> typing.Tuple[str, ...]:
+        return self._members
+
+    def owns(self, key: str) -> bool:
+        """ True if this instance is responsible for the key """
+        return self._ring.owner(key) == self.instance
@@ -0,0 +1,56 @@
+"""
+Learned delay between a cloud update and the polled state reflecting it.
+"""
+import threading
+import typing
+
+# First verification poll before anything has been learned, the delay used before
+INITIAL_DELAY = 5.0
+# Bounds of the first verification poll
+MIN_DELAY = 1.0
+MAX_DELAY = 30.0
+# First poll is this much later than the learned latency, polling early costs a request
+MARGIN = 1.25
+# Weight of the latest observation
+ALPHA = 0.3
+# Polls after a mismatch are this far apart, doubling each time
+BACKOFF = 2.0
+# Cloud state is accepted as is if it has not converged by then
+DEADLINE = 30.0
+
+
+class Convergence:
+    """
+    Convergence latency per device model as exponentially weighted average. The exact latency is
+    unknown, only that it was between the last mismatching poll and the matching one, so the middle
+    of the two is observed. Polling right at the estimate lets it drift down until a poll is early,
+    which pushes it back up.
+    """
+
+    def __init__(self) -> None:
+        self._latency: typing.Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def first_delay(self, model: str) -> float:
+        """ Seconds after the update before the first verification poll """
+        with self._lock:
+            latency = self._latency.get(model)
+        if latency is None:
+            return INITIAL_DELAY
+        return min(max(latency * MARGIN, MIN_DELAY), MAX_DELAY)
+
+    def observe(self, model: str, low: float, high: float) -> None:
+        """ Record that the update converged between `low` and `high` seconds after it was sent """
+        seconds = (low + high) / 2
+        with self._lock:
+            latency = self._latency.get(model)
+            self._latency[model] = seconds if latency is None else latency + ALPHA * (seconds - latency)
+
+    def latency(self, model: str) -> typing.Optional[float]:
+        with self._lock:
+            return self._latency.get(model)
+
+
+def backoff(attempt: int) -> float:
+    """ Seconds until the next verification poll after `attempt` mismatching ones """
+    return BACKOFF * 2 ** (attempt - 1)
@@ -7,12 +7,34 @@ import typing
 import logging
 from pcomfortcloud.session import Session
 from pcomfortcloud import constants
+from pcomfortcloud.exceptions import Error
 import pcfmqtt.mappings as mappings
+from pcfmqtt import hooks, metrics
+from pcfmqtt.timeseries import Series
+from pcfmqtt.convergence import Convergence, DEADLINE, backoff
+from pcfmqtt.ratelimit import CircuitOpenError, RateLimitedError
+from pcfmqtt.retry import RetryQueue
+
+# Commands accepted from HomeAssistant, each one has its own topic
+COMMANDS = ("power_cmd", "mode_cmd", "temp_cmd", "fan_cmd", "swing_cmd", "swing_h_cmd", "s_eco_cmd",
+            "s_nanoe_cmd")
+# Refresh is tried again this long after it failed, doubling on each consecutive failure
+POLL_RETRY = 5
+MAX_POLL_RETRY = 300
 
 
 class DeviceState:
     """ State of a single device """
 
+    __slots__ = ("name", "_log", "defaults", "temperature", "power", "temperature_inside", "temperature_outside",
+                 "mode", "fan_speed", "air_swing_horizontal", "air_swing_vertical", "eco", "nanoe", "epoch")
+
+    # Fields set by the commands and the read-only metrics along with their names in the log
+    SETTINGS = (("temperature", "temperature"), ("power", "power"), ("mode", "mode"), ("fan_speed", "fan speed"),
+                ("air_swing_horizontal", "air swing horizontal"), ("air_swing_vertical", "air swing vertical"),
+                ("eco", "eco"), ("nanoe", "nanoe"))
+    METRICS = (("temperature_inside", "temperature inside"), ("temperature_outside", "temperature outside"))
+
     def __init__(self, logger: logging.Logger, name: str, params: typing.Dict[str, typing.Any]) -> None:
         self.name: str = name
         self._log = logger
@@ -34,67 +56,190 @@ class DeviceState:
             "nanoe", constants.NanoeMode.On)
         self.epoch: float = time()
 
+    def to_params(self) -> typing.Dict[str, typing.Any]:
+        """
+        State in the same format as the parameters received from the cloud
+        """
+        return {
+            "temperature": self.temperature,
+            "power": self.power,
+            "temperatureInside": self.temperature_inside,
+            "temperatureOutside": self.temperature_outside,
+            "mode": self.mode,
+            "fanSpeed": self.fan_speed,
+            "airSwingHorizontal": self.air_swing_horizontal,
+            "airSwingVertical": self.air_swing_vertical,
+            "eco": self.eco,
+            "nanoe": self.nanoe,
+        }
+
     def log_if_updated(self, current_value: typing.Any, new_value: typing.Any, value_name: str):
         if current_value != new_value:
             self._log.info("Updated %s ( %r -> %r )", value_name, current_value, new_value)
         return new_value
 
-    def refresh_all(self, state: "DeviceState"):
+    def _refresh_fields(self, state: "DeviceState",
+                        fields: typing.Tuple[typing.Tuple[str, str], ...]) -> typing.List[str]:
+        changed: typing.List[str] = []
+        for field, value_name in fields:
+            current_value, new_value = getattr(self, field), getattr(state, field)
+            if current_value != new_value:
+                changed.append(field)
+                setattr(self, field, self.log_if_updated(current_value, new_value, value_name))
+        return changed
+
+    def refresh_all(self, state: "DeviceState") -> typing.List[str]:
+        """
+        Refresh the full state, including read-only metrics. Returns the fields that changed.
+        """
+        changed = self.refresh(state)
+        return changed + self._refresh_fields(state, self.METRICS)
+
+    def refresh_metrics(self, state: "DeviceState") -> typing.List[str]:
         """
-        Refresh the full state, including read-only metrics
+        Refresh only the read-only metrics. Returns the fields that changed.
         """
-        self.refresh(state)
-        self.temperature_inside = self.log_if_updated(
-            self.temperature_inside, state.temperature_inside, "temperature inside")
-        self.temperature_outside = self.log_if_updated(
-            self.temperature_outside, state.temperature_outside, "temperature outside")
+        self.epoch = time()
+        return self._refresh_fields(state, self.METRICS)
+
+    def matches(self, state: "DeviceState") -> bool:
+        """ True if the settings are the same as in the given state """
+        return all(getattr(self, field) == getattr(state, field) for field, _ in self.SETTINGS)
 
-    def refresh(self, state: "DeviceState"):
+    def refresh(self, state: "DeviceState") -> typing.List[str]:
         """
         Refresh the state from the given one. This is to update the current state from desired when 
-        device has been succesfully update. 
+        device has been succesfully update. Returns the fields that changed.
         """
         self.defaults = False
-        self.temperature = self.log_if_updated(
-            self.temperature, state.temperature, "temperature")
-        self.power = self.log_if_updated(
-            self.power, state.power, "power")
-        self.mode = self.log_if_updated(
-            self.mode, state.mode, "mode")
-        self.fan_speed = self.log_if_updated(
-            self.fan_speed, state.fan_speed, "fan speed")
-        self.air_swing_horizontal = self.log_if_updated(
-            self.air_swing_horizontal, state.air_swing_horizontal,
-            "air swing horizontal")
-        self.air_swing_vertical = self.log_if_updated(
-            self.air_swing_vertical, state.air_swing_vertical, "air swing vertical")
-        self.eco = self.log_if_updated(self.eco, state.eco, "eco")
-        self.nanoe = self.log_if_updated(
-            self.nanoe, state.nanoe, "nanoe")
+        changed = self._refresh_fields(state, self.SETTINGS)
         self.epoch = time()
+        return changed
+
+
+# Fields of the state reported to HA
+STATE_FIELDS = tuple(field for field, _ in DeviceState.SETTINGS + DeviceState.METRICS)
 
 
 class Device:
 
-    def __init__(self, raw: typing.Dict[str, typing.Any]) -> None:
-        self._dirty = False # True if there is some message that failed and needs to be resent
+    def __init__(self, raw: typing.Dict[str, typing.Any], coalesce_window: float = 0, namespace: str = "",
+                 optimistic: bool = False, convergence: typing.Optional[Convergence] = None,
+                 retries: typing.Optional[RetryQueue] = None) -> None:
+        # Updates that failed and need to be resent, shared by the devices of the service
+        self._retries = retries or RetryQueue()
+        # Commands are reported as done right away and written to the cloud in the background
+        self._optimistic = optimistic
+        # Last state confirmed by the cloud while an optimistic state is not yet reconciled
+        self._confirmed: typing.Optional[typing.Dict[str, typing.Any]] = None
+        # Commands received within this many seconds are sent to the cloud as a single update
+        self._coalesce_window = coalesce_window
+        self._pending_since: typing.Optional[float] = None # First command waiting to be sent
+        self._pending_commands = 0
+        self._writes = 0
+        self._command_received: float = 0 # When the command being handled was received
+        self._command_since: typing.Optional[float] = None # Oldest command not yet sent to the cloud
+        # Latency until the cloud reflects an update, shared by the devices of the service
+        self._convergence = convergence or Convergence()
+        self._verify_since: typing.Optional[float] = None # Update not yet seen in the polled state
+        self._verify_checked: float = 0 # Seconds after the update of the last mismatching poll
+        self._verify_attempts = 0
         self._name: str = raw["name"]
         self._ha_name: str = "pcc_" + \
             raw["name"].lower().replace(" ", "_").strip()
         self._group: str = raw["group"]
         self._model: str = raw["model"]
         self._id: str = raw["id"]
+        # Prefix for the id when the bridge serves more than one account
+        self._namespace = namespace
         self._target_refresh: float = 0
+        self._poll_failures = 0
         self._log = logging.getLogger(f"Device.{self.get_name()}")
         self._state: DeviceState = DeviceState(self._log, self.get_name(), {})
         self._desired_state: DeviceState = DeviceState(
             self._log, self.get_name(), {})
+        self._restore_queued()
+        # Readings recorded on every refresh from the cloud when enabled
+        self._history: typing.Optional[Series] = None
+        # State fields changed since they were last reported, everything is new at first
+        self._changed: typing.Set[str] = set(STATE_FIELDS)
+        self._commands: typing.Dict[str, typing.Callable[[Session, str], bool]] = {
+            "mode_cmd": self._cmd_mode,
+            "temp_cmd": self._cmd_temp,
+            "fan_cmd": self._cmd_fan,
+            "swing_cmd": self._cmd_swing,
+            "s_eco_cmd": self._cmd_eco,
+            "s_nanoe_cmd": self._cmd_nanoe,
+            "swing_h_cmd": self._cmd_swing_horizontal,
+            "power_cmd": self._cmd_power}
         self._log.info("New device: %s (%s)", self._name, self._ha_name)
 
-    def update_state(self, session: Session, refresh_delay: float) -> bool:
+    def get_raw(self) -> typing.Dict[str, typing.Any]:
+        """
+        Device description in the same format as received from the cloud
+        """
+        return {"name": self._name, "group": self._group, "model": self._model, "id": self._id}
+
+    def get_state_params(self) -> typing.Dict[str, typing.Any]:
+        return self._state.to_params()
+
+    def restore_state(self, params: typing.Dict[str, typing.Any], epoch: float):
+        """
+        Restore last known state, eg. from snapshot. Device is still due for update from the cloud.
+        """
+        self._state = DeviceState(self._log, self.get_name(), params)
+        self._state.epoch = epoch
+        self._desired_state = DeviceState(self._log, self.get_name(), params)
+        self._restore_queued()
+        self._changed.update(STATE_FIELDS)
+
+    def _restore_queued(self):
+        """ Desired state of an update queued before a restart """
+        entry = self._retries.get(self.get_id())
+        if entry is not None:
+            self._desired_state = DeviceState(self._log, self.get_name(), entry.params)
+
+    def set_history(self, history: Series):
+        self._history = history
+
+    def get_history(self) -> typing.Optional[Series]:
+        return self._history
+
+    def pop_changed(self) -> typing.Set[str]:
+        """
+        State fields (`DeviceState` attribute names) that changed since the previous call. Not locked,
+        call it from the same thread or mailbox job that refreshes and commands the device.
+        """
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def needs_refresh(self) -> bool:
+        """
+        Check whether the device is due for update
+        """
+        return self.get_refresh_time() <= time()
+
+    def get_refresh_time(self) -> float:
+        """
+        Epoch when the device is next due for update
+        """
+        refresh_time = self._target_refresh
+        if self._pending_since is not None:
+            refresh_time = min(refresh_time, self._pending_since + self._coalesce_window)
+        retry_at = self._retries.retry_at(self.get_id())
+        if retry_at is not None:
+            refresh_time = min(refresh_time, retry_at)
+        return refresh_time
+
+    @hooks.traced("device.update_state", lambda self, *args, **kwargs: {"device": self.get_id()})
+    def update_state(self, session: Session, refresh_delay: float,
+                     parameters: typing.Optional[typing.Dict[str, typing.Any]] = None) -> bool:
         """
         Update device state from the cloud, return true if something was done
 
+        If `parameters` is given (eg. from bulk group listing) it is used instead of requesting the
+        device state separately.
+
         Example payload for parameters for future reference,
             'parameters': 
                 {'temperatureInside': 21,
@@ -110,20 +255,89 @@ class Device:
             }
         """
         # Push delayed updates
-        if self._dirty:
+        flushed = self.flush_pending(session)
+        retry_at = self._retries.retry_at(self.get_id())
+        if not flushed and retry_at is not None and retry_at <= time():
+            self._log.info("Retrying queued update")
             self._send_update(session)
-            self._dirty = False
+            flushed = True
+        if flushed:
+            # Given parameters were read before the update went out
+            parameters = None
         if self._target_refresh < time():
-            self._log.debug("Retrieving data")
-            data: typing.Dict[str, typing.Any] = session.get_device(self._id) # type: ignore
+            data: typing.Dict[str, typing.Any]
+            if parameters is None:
+                self._log.debug("Retrieving data")
+                try:
+                    data = session.get_device(self._id) # type: ignore
+                    if data is None:
+                        raise Error(f"Device {self._id} not listed in the session")
+                except Error as e:
+                    # Requests that were never sent are rescheduled by the session budget
+                    if not isinstance(e, (CircuitOpenError, RateLimitedError)):
+                        self._poll_failed()
+                    raise
+                self._poll_failures = 0
+            else:
+                data = {"parameters": parameters}
             if self._desired_state.defaults:
                 self._desired_state = DeviceState(
                     self._log, self.get_name(), data["parameters"]) # type: ignore
-            self._state.refresh_all(DeviceState(
-                self._log, self.get_name(), data["parameters"])) # type: ignore
+            cloud_state = DeviceState(self._log, self.get_name(), data["parameters"]) # type: ignore
+            if self._verify_since is not None and not self._verify(cloud_state):
+                # Cloud has not caught up with the update yet, keep reporting the updated settings
+                self._changed.update(self._state.refresh_metrics(cloud_state))
+                refresh_delay = min(backoff(self._verify_attempts), self._verify_since + DEADLINE - time())
+            else:
+                changed = self._state.refresh_all(cloud_state)
+                self._changed.update(changed)
+                if self._confirmed is not None and not self._pending_since and \
+                        self._retries.retry_at(self.get_id()) is None:
+                    self._reconcile(changed)
+            if self._history is not None:
+                self._history.append(self._state.epoch, {"inside_temperature": self._state.temperature_inside,
+                                                         "outside_temperature": self._state.temperature_outside,
+                                                         "target_temperature": self._state.temperature})
             self._target_refresh = time() + refresh_delay
             return True
-        return False
+        return flushed
+
+    def _project(self):
+        """ Report the desired state as the current one until the cloud confirms it """
+        if self._confirmed is None:
+            self._confirmed = self._state.to_params()
+        self._changed.update(self._state.refresh(self._desired_state))
+
+    def _reconcile(self, changed: typing.List[str]):
+        """ Cloud state after an optimistic update, changed settings mean the projection was wrong """
+        settings = [field for field in changed if field in dict(DeviceState.SETTINGS)]
+        if settings:
+            self._log.warning("Cloud state differs from the optimistic state, corrected %s", ", ".join(settings))
+            metrics.OPTIMISTIC_CORRECTIONS.inc("mismatch")
+        self._confirmed = None
+
+    def _revert(self):
+        """ Report the last confirmed state again after the optimistic update failed """
+        if self._confirmed is None:
+            return
+        self._log.warning("Update failed, reverting to the last confirmed state")
+        metrics.OPTIMISTIC_CORRECTIONS.inc("failure")
+        self._changed.update(self._state.refresh(DeviceState(self._log, self.get_name(), self._confirmed)))
+        self._confirmed = None
+
+    def flush_pending(self, session: Session) -> bool:
+        """
+        Send the coalesced commands once the coalescing window has passed, return true if sent
+        """
+        if self._pending_since is None or self._pending_since + self._coalesce_window > time():
+            return False
+        pending_since, commands = self._pending_since, self._pending_commands
+        self._pending_since = None
+        self._pending_commands = 0
+        self._send_update(session)
+        self._log.info("Sent %i coalesced command(s) in one update, %.0f ms after first command (%i updates total)",
+                       commands, (time() - pending_since) * 1000, self._writes)
+        return True
     
     def set_eco(self, eco: constants.EcoMode):
         self._desired_state.eco = eco
@@ -167,7 +381,12 @@ class Device:
         return "climate"
 
     def get_id(self) -> str:
+        if self._namespace:
+            return f"{self._namespace}_{self.get_name()}"
         return self.get_name()
+
+    def get_namespace(self) -> str:
+        return self._namespace
     
     def get_fanmode_str(self) -> str:
         return mappings.fans_to_string.get(self._state.fan_speed, "")
@@ -208,16 +427,78 @@ class Device:
     def get_temperature_outside(self) -> float:
         return self._state.temperature_outside
 
+    def _poll_failed(self):
+        """
+        Back off the refreshes of a failing device so it is not retried in a loop
+        """
+        self._poll_failures += 1
+        delay = min(POLL_RETRY * 2 ** (self._poll_failures - 1), MAX_POLL_RETRY)
+        self._log.info("Refresh failed, trying again in %.0f s", delay)
+        self._target_refresh = time() + delay
+
     def _refresh_soon(self):
         """
-        Refresh the state "soonish". It sometimes can take some seconds before the state is reflected
-        in the response so wait a while before checking it. Fetching the state too soonish will result
-        in the value being reverted back to the original one in HA eventhough the state is correct in 
-        reality. 
+        Refresh the state "soonish" after a failed update
         """
         self._target_refresh = time() + 5
 
+    def _verify_soon(self):
+        """
+        Verify the update once the cloud is expected to reflect it. It sometimes can take some seconds
+        before the state is reflected in the response and fetching it too soon would revert the value
+        in HA eventhough the state is correct in reality. The first poll is timed by the latency
+        learned for the model and the following ones back off until the state matches or the
+        deadline has passed.
+        """
+        self._verify_since = time()
+        self._verify_checked = 0
+        self._verify_attempts = 0
+        self._target_refresh = self._verify_since + self._convergence.first_delay(self._model)
+
+    def _verify(self, cloud_state: DeviceState) -> bool:
+        """
+        Check the polled state against the update being verified, return true if verification is done
+        """
+        elapsed = time() - self._verify_since # type: ignore
+        if cloud_state.matches(self._desired_state):
+            self._convergence.observe(self._model, self._verify_checked, elapsed)
+            self._log.debug("Update reflected in the cloud within %.1f s after %i poll(s)", elapsed,
+                            self._verify_attempts + 1)
+            metrics.VERIFY_POLLS.inc("converged")
+        elif elapsed >= DEADLINE:
+            self._log.warning("Update not reflected in the cloud within %.0f s, accepting the cloud state", elapsed)
+            metrics.VERIFY_POLLS.inc("expired")
+        else:
+            self._verify_checked = elapsed
+            self._verify_attempts += 1
+            metrics.VERIFY_POLLS.inc("pending")
+            return False
+        self._verify_since = None
+        return True
+
+    def _request_update(self, session: Session):
+        """
+        Send the desired state to the cloud. When coalescing, the update is delayed until the
+        window has passed so that commands arriving meanwhile are sent together.
+
+        When optimistic, the desired state is reported right away and the update is always left to
+        the next refresh. The refresh after the update reconciles the state with the cloud, and a
+        failed update reverts it to the last confirmed state.
+        """
+        if self._command_since is None:
+            self._command_since = self._command_received or time()
+        if self._optimistic:
+            self._project()
+        elif not self._coalesce_window:
+            self._send_update(session)
+            return
+        if self._pending_since is None:
+            self._pending_since = time()
+        self._pending_commands += 1
+
+    @hooks.traced("device.send_update", lambda self, *args, **kwargs: {"device": self.get_id()})
     def _send_update(self, session: Session):
+        self._writes += 1
         try:
             if session.set_device(self.get_internal_id(), # type: ignore
                                 mode=self._desired_state.mode,
@@ -228,16 +509,35 @@ class Device:
                                 airSwingVertical=self._desired_state.air_swing_vertical,
                                 nanoe=self._desired_state.nanoe,
                                 eco=self._desired_state.eco):
-                self._state.refresh(self._desired_state)
-                self._refresh_soon()
+                self._retries.done(self.get_id())
+                self._changed.update(self._state.refresh(self._desired_state))
+                self._verify_soon()
+                if self._command_since is not None:
+                    metrics.COMMAND_SECONDS.observe(time() - self._command_since)
+                    self._command_since = None
             else:
-                self._log.info("Device update failed")
+                # Session has not listed the device, eg. the account is being logged in again
+                retry_at = self._retries.put(self.get_id(), self._desired_state.to_params(), time())
+                self._log.info("Device update failed, device not listed. Retrying in %.0f s", retry_at - time())
+                self._revert()
         except Exception as e:
             # Occasionally the update fails with comfort cloud and needs to be retried at later time
             self._log.exception("Error in device update: %r", e)
-            self._dirty = True
+            retry_at = self._retries.put(self.get_id(), self._desired_state.to_params(), time())
+            self._log.info("Update queued, retrying in %.0f s", retry_at - time())
+            self._revert()
             self._refresh_soon()
 
+    def _reference_state(self) -> DeviceState:
+        """
+        State the commands are compared against to skip the ones not leading to action. While an update
+        is waiting to be sent or retried, the device ends up in the desired state instead of the
+        reported one.
+        """
+        if self._pending_since is not None or self._retries.get(self.get_id()) is not None:
+            return self._desired_state
+        return self._state
+
     def _cmd_mode(self, session: Session, payload: str) -> bool:
         """
         Set operating mode command
@@ -253,15 +553,15 @@ class Device:
         if target_mode is not None:
             self.set_mode(target_mode)
             self.set_power(constants.Power.On)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command ->  Mode set to %s", payload)
             return True
         # Change power state
         if target_power is not None:
             # Don't turn off the device twice
-            if self.get_power() != target_power:
+            if self._reference_state().power != target_power:
                 self.set_power(target_power)
-                self._send_update(session)
+                self._request_update(session)
                 self._log.info("Command -> Mode set to %s", payload)
                 return True
             self._log.info(
@@ -281,9 +581,9 @@ class Device:
         if target_fan is None:
             self._log.info("Unknown fan command: %r", payload)
             return False
-        if self.get_fanmode_str() != target_fan:
+        if self._reference_state().fan_speed != target_fan:
             self.set_fanmode(target_fan)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Fan set to %s", payload)
             return True
         self._log.info(
@@ -300,9 +600,9 @@ class Device:
         if target_swing is None:
             self._log.info("Unknown air swing command: %r", payload)
             return False
-        if self.get_swingmode_str() != target_swing:
+        if self._reference_state().air_swing_vertical != target_swing:
             self.set_swingmode(target_swing)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Air swing set to %s", payload)
             return True
         self._log.info(
@@ -319,9 +619,9 @@ class Device:
         if target_swing is None:
             self._log.info("Unknown air swing horizontal command: %r", payload)
             return False
-        if self.get_swing_horizontal_str() != target_swing:
+        if self._reference_state().air_swing_horizontal != target_swing:
             self.set_swing_horizontal(target_swing)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Air swing horizontal set to %s", payload)
             return True
         self._log.info(
@@ -340,7 +640,7 @@ class Device:
                 "Temperature command would not lead to action, skipping: %s", payload)
             return False
         self.set_target_temperature(new_temp)
-        self._send_update(session)
+        self._request_update(session)
         self._log.info("Command ->  Temperature set to %r", payload)
         return True
     
@@ -354,9 +654,9 @@ class Device:
         if target_nanoe is None:
             self._log.info("Unknown nanoe command: %r", payload)
             return False
-        if self.get_nanoe_str() != target_nanoe:
+        if self._reference_state().nanoe != target_nanoe:
             self.set_nanoe(target_nanoe)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Nanoe set to %s", payload)
             return True
         self._log.info(
@@ -372,9 +672,9 @@ class Device:
         if target_eco is None:
             self._log.info("Unknown eco command: %r", payload)
             return False
-        if self.get_eco_str() != target_eco:
+        if self._reference_state().eco != target_eco:
             self.set_eco(target_eco)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Eco set to %s", payload)
             return True
         self._log.info(
@@ -392,29 +692,24 @@ class Device:
             self._log.info("Bad power command received: %r", payload)
             return False
         # Don't turn off the device twice
-        if self.get_power() != literal:
+        if self._reference_state().power != literal:
             self.set_power(literal)
-            self._send_update(session)
+            self._request_update(session)
             self._log.info("Command -> Power set to %r", payload)
             return True
         self._log.info(
             "Power command would not lead to action, skipping: %r", payload)
         return False
 
-    def command(self, session: Session, command: str, payload: str) -> bool:
+    def command(self, session: Session, command: str, payload: str, received: float = 0) -> bool:
         """
-        Resolve command coming from HomeAssistant / MQTT. 
+        Resolve command coming from HomeAssistant / MQTT. `received` is the epoch when the command
+        was received, used for measuring the command latency.
 
         Returns true if something changed and state update needs to be delivered
         """
-        cmd = {"mode_cmd": self._cmd_mode,
-               "temp_cmd": self._cmd_temp,
-               "fan_cmd": self._cmd_fan,
-               "swing_cmd": self._cmd_swing,
-               "s_eco_cmd": self._cmd_eco,
-               "s_nanoe_cmd": self._cmd_nanoe,
-               "swing_h_cmd": self._cmd_swing_horizontal,
-               "power_cmd": self._cmd_power}.get(command)
+        self._command_received = received
+        cmd = self._commands.get(command)
         if cmd:
             return cmd(session, payload)
         elif command in ["config", "state"]:
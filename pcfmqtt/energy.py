@@ -0,0 +1,132 @@
+"""
+Incremental collection of the energy consumption history.
+"""
+import datetime
+import hashlib
+import json
+import os
+import typing
+import logging
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+# History is requested a day at a time, the finest the cloud provides
+DAY_MODE = "Day"
+# Hourly buckets may still be updated by the cloud for a while after the hour has ended
+CLOSE_AFTER = 30 * 60
+# Days missed while the bridge was not running are caught up one request at a time, at most this many
+MAX_CATCH_UP_DAYS = 7
+
+
+def stagger(key: str) -> float:
+    """ Stable fraction in [0, 1) for the key, spreads the first fetches of the devices over the interval """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big") / 2 ** 64
+
+
+def utc_offset(now: float) -> str:
+    """ Local UTC offset in the format the cloud expects, eg. `+02:00` """
+    offset = datetime.datetime.fromtimestamp(now).astimezone().strftime("%z")
+    return f"{offset[:3]}:{offset[3:]}"
+
+
+def _day_start(date: str) -> float:
+    return datetime.datetime.strptime(date, "%Y%m%d").timestamp()
+
+
+def _date(epoch: float) -> str:
+    return datetime.datetime.fromtimestamp(epoch).strftime("%Y%m%d")
+
+
+class EnergyMeter:
+    """
+    Cumulative energy consumption of a single device in kWh, built from the hourly history buckets.
+
+    The cursor is the day being collected and the hours of it already closed. Closed hours are kept in
+    the cache and never taken from the cloud again, only the open hours of each response are merged.
+    Once every hour of the day is closed the day is folded into the total and the cursor moves to the
+    next day, so week, month and year views are never requested.
+    """
+
+    def __init__(self, total: float = 0, day: str = "", hours: typing.Optional[typing.Dict[int, float]] = None,
+                 closed: int = 0, reported: float = 0) -> None:
+        self._total = total  # Days before the cursor
+        self._day = day
+        self._hours: typing.Dict[int, float] = dict(hours or {})
+        self._closed = closed  # Hours of the cursor day before this one are final
+        self._reported = reported
+
+    def next_date(self, now: float) -> str:
+        """ Day to request next, YYYYMMDD in local time """
+        today = _date(now)
+        if not self._day:
+            self._day = today
+        oldest = _date(now - MAX_CATCH_UP_DAYS * 24 * 60 * 60)
+        if self._day < oldest:
+            log.warning("Energy history not collected since %s, skipping to %s", self._day, oldest)
+            self._day, self._hours, self._closed = oldest, {}, 0
+        return self._day
+
+    def behind(self, now: float) -> bool:
+        """ True if earlier days are still to be collected """
+        return bool(self._day) and self._day < _date(now)
+
+    def merge(self, date: str, buckets: typing.Iterable[typing.Dict[str, typing.Any]], now: float) -> None:
+        """ Merge the hourly buckets of the day returned by the cloud """
+        if date != self._day:
+            return
+        start = _day_start(date)
+        for bucket in buckets:
+            hour = bucket.get("dataNumber")
+            consumption = bucket.get("consumption")
+            if not isinstance(hour, int) or not 0 <= hour < 24 or hour < self._closed:
+                continue
+            if isinstance(consumption, (int, float)) and consumption >= 0:
+                self._hours[hour] = float(consumption)
+        self._reported = max(self._reported, self._total + sum(self._hours.values()))
+        # Hours are closed in order, missing ones count as nothing once closed
+        while self._closed < 24 and start + (self._closed + 1) * 60 * 60 + CLOSE_AFTER <= now:
+            self._closed += 1
+        if self._closed == 24:
+            self._total += sum(self._hours.values())
+            self._day = _date(start + 36 * 60 * 60)
+            self._hours, self._closed = {}, 0
+
+    def total(self) -> float:
+        """ Consumption since the collection started, never decreases """
+        return self._reported
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {"total": self._total, "day": self._day, "hours": {str(k): v for k, v in self._hours.items()},
+                "closed": self._closed, "reported": self._reported}
+
+    @staticmethod
+    def from_dict(data: typing.Dict[str, typing.Any]) -> "EnergyMeter":
+        return EnergyMeter(data["total"], data["day"], {int(k): v for k, v in data["hours"].items()},
+                           data["closed"], data["reported"])
+
+
+def save(path: str, meters: typing.Dict[str, EnergyMeter]) -> None:
+    """ Write the meters atomically """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": VERSION, "devices": {key: meter.to_dict() for key, meter in meters.items()}}, f)
+    os.replace(tmp, path)
+    log.debug("Energy meters of %i devices written to %s", len(meters), path)
+
+
+def load(path: str) -> typing.Dict[str, EnergyMeter]:
+    """ Read the meters by device id, returns empty dict if there are no usable meters """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            log.warning("Ignoring energy meters with unknown version: %r", data.get("version"))
+            return {}
+        return {key: EnergyMeter.from_dict(entry) for key, entry in data["devices"].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        log.warning("Ignoring unreadable energy meters %s: %r", path, e)
+        return {}
@@ -6,6 +6,7 @@ import typing
 
 from pcfmqtt.mappings import fans_to_literal, airswing_to_literal, airswing_horizontal_to_literal, eco_to_literal, nanoe_to_literal
 from pcfmqtt.device import Device
+from pcfmqtt import hooks
 
 
 def discovery_topic(topic_prefix: str, component: str, device_id: str) -> str:
@@ -17,6 +18,14 @@ def discovery_topic(topic_prefix: str, component: str, device_id: str) -> str:
     """
     return f"{topic_prefix}/{component}/{device_id}/config"
 
+def _state_source(base_topic_path: str, attribute: str, attribute_topics: bool) -> typing.Tuple[str, str]:
+    """
+    State topic and value template of the attribute, either from its own topic or from the state JSON
+    """
+    if attribute_topics:
+        return f"{base_topic_path}/{attribute}", "{{ value }}"
+    return f"{base_topic_path}/state", "{{ value_json." + attribute + " }}"
+
 def _create_device_block(device: Device) -> typing.Dict[str, typing.Any]:
     """
     Creates shared device block for discovery payload.
@@ -30,10 +39,11 @@ def _create_device_block(device: Device) -> typing.Dict[str, typing.Any]:
 
 def _create_discovery_temperature_sensor_tuple(
         topic_prefix: str, base_topic_path: str, sensor_name: str,
-        device: Device) -> typing.Tuple[str, str]:
+        device: Device, attribute_topics: bool = False) -> typing.Tuple[str, str]:
     """
     Creates tuple containing the topic and json payload to register new temperature sensor.
     """
+    topic, template = _state_source(base_topic_path, sensor_name + "_temperature", attribute_topics)
     return (
         discovery_topic(topic_prefix, "sensor",
                         device.get_id() + "_temperature_" + sensor_name),
@@ -43,8 +53,27 @@ def _create_discovery_temperature_sensor_tuple(
             "unit_of_measurement": "°C",
             "device_class": "temperature",
             "icon": "mdi:thermometer",
-            "state_topic": f"{base_topic_path}/state",
-            "value_template": "{{ value_json." + sensor_name + "_temperature }}",
+            "state_topic": topic,
+            "value_template": template,
+            "device": _create_device_block(device),
+            }))
+
+def _create_discovery_energy_sensor_tuple(
+        topic_prefix: str, base_topic_path: str, device: Device) -> typing.Tuple[str, str]:
+    """
+    Creates tuple containing the topic and json payload to register new energy sensor.
+    """
+    return (
+        discovery_topic(topic_prefix, "sensor",
+                        device.get_id() + "_energy"),
+        json.dumps({
+            "name": "energy",
+            "unique_id": device.get_id() + "_energy",
+            "unit_of_measurement": "kWh",
+            "device_class": "energy",
+            "state_class": "total_increasing",
+            "icon": "mdi:lightning-bolt",
+            "state_topic": f"{base_topic_path}/energy",
             "device": _create_device_block(device),
             }))
 
@@ -70,10 +99,12 @@ def _create_discovery_alive_sensor_tuple(
 
 def _create_discovery_select_tuple(
         topic_prefix: str, base_topic_path: str, select_name: str, title: str,
-        device: Device, options: typing.List[str], icon: str) -> typing.Tuple[str, str]:
+        device: Device, options: typing.List[str], icon: str,
+        attribute_topics: bool = False) -> typing.Tuple[str, str]:
     """
     Creates tuple containing the topic and json payload to register new select entity.
     """
+    topic, template = _state_source(base_topic_path, "s_" + select_name, attribute_topics)
     return (
         discovery_topic(topic_prefix, "select",
                         device.get_id() + "_" + select_name),
@@ -81,19 +112,30 @@ def _create_discovery_select_tuple(
             "name": title,
             "unique_id":  device.get_id() + "select_" + select_name,
             "icon": icon,
-            "state_topic": f"{base_topic_path}/state",
+            "state_topic": topic,
             "options": options,
             "command_topic": f"{base_topic_path}/s_{select_name}_cmd",
-            "value_template": "{{ value_json.s_" + select_name + " }}",
+            "value_template": template,
             "device": _create_device_block(device),
             }))
 
-def discovery_event(topic_prefix: str, device: Device) -> typing.List[typing.Tuple[str, str]]:
+@hooks.traced("events.discovery_event", lambda topic_prefix, device, *args, **kwargs: {"device": device.get_id()})
+def discovery_event(topic_prefix: str, device: Device, attribute_topics: bool = False,
+                    energy: bool = False) -> typing.List[typing.Tuple[str, str]]:
     """
     Create list of discovery events. Tuple consists of (discovery topic, event payload) 
+
+    With `attribute_topics` the entities read each attribute from its own topic instead of the
+    state JSON. With `energy` the energy consumption sensor is included.
     """ 
     base_topic_path = "{}/{}/{}".format(topic_prefix,
                                         device.get_component(), device.get_id())
+    mode_topic, mode_template = _state_source(base_topic_path, "mode", attribute_topics)
+    temperature_topic, temperature_template = _state_source(base_topic_path, "target_temperature",
+                                                            attribute_topics)
+    fan_topic, fan_template = _state_source(base_topic_path, "fan_mode", attribute_topics)
+    swing_topic, swing_template = _state_source(base_topic_path, "swing_mode", attribute_topics)
+    swing_h_topic, swing_h_template = _state_source(base_topic_path, "swing_horizontal", attribute_topics)
     topics = [
         (discovery_topic(topic_prefix, "climate", device.get_id()),
          json.dumps({
@@ -104,47 +146,55 @@ def discovery_event(topic_prefix: str, device: Device) -> typing.List[typing.Tup
              "icon": "mdi:air-conditioner",
              "temperature_unit": "C",
              "mode_command_topic": "{}/mode_cmd".format(base_topic_path),
-             "mode_state_topic": "{}/state".format(base_topic_path),
-             "mode_state_template": "{{ value_json.mode }}",
+             "mode_state_topic": mode_topic,
+             "mode_state_template": mode_template,
              "temperature_command_topic": "{}/temp_cmd".format(base_topic_path),
-             "temperature_state_topic": "{}/state".format(base_topic_path),
-             "temperature_state_template": "{{ value_json.target_temperature }}",
+             "temperature_state_topic": temperature_topic,
+             "temperature_state_template": temperature_template,
              "fan_mode_command_topic": "{}/fan_cmd".format(base_topic_path),
-             "fan_mode_state_topic": "{}/state".format(base_topic_path),
-             "fan_mode_state_template": "{{ value_json.fan_mode }}",
+             "fan_mode_state_topic": fan_topic,
+             "fan_mode_state_template": fan_template,
              "fan_modes": list(fans_to_literal.keys()),
              "swing_mode_command_topic": "{}/swing_cmd".format(base_topic_path),
-             "swing_mode_state_topic": "{}/state".format(base_topic_path),
-             "swing_mode_state_template": "{{ value_json.swing_mode }}",
+             "swing_mode_state_topic": swing_topic,
+             "swing_mode_state_template": swing_template,
              "swing_modes": list(airswing_to_literal.keys()),
              "swing_horizontal_mode_command_topic": "{}/swing_h_cmd".format(base_topic_path),
-             "swing_horizontal_mode_state_topic": "{}/state".format(base_topic_path),
-             "swing_horizontal_mode_state_template": "{{ value_json.swing_horizontal }}",
+             "swing_horizontal_mode_state_topic": swing_h_topic,
+             "swing_horizontal_mode_state_template": swing_h_template,
              "swing_horizontal_modes": list(airswing_horizontal_to_literal.keys()),
              "power_command_topic": "{}/power_cmd".format(base_topic_path),
              "device": _create_device_block(device),
              })),
         _create_discovery_temperature_sensor_tuple(
-            topic_prefix, base_topic_path, "outside", device),
+            topic_prefix, base_topic_path, "outside", device, attribute_topics),
         _create_discovery_temperature_sensor_tuple(
-            topic_prefix, base_topic_path, "inside", device),
+            topic_prefix, base_topic_path, "inside", device, attribute_topics),
         # TODO: Figure out and fix the alive sensor
         #_create_discovery_alive_sensor_tuple(
         #    topic_prefix, base_topic_path, device),
         _create_discovery_select_tuple(
             topic_prefix, base_topic_path, "eco", "Eco mode", device,
-            list(eco_to_literal.keys()), "mdi:leaf"),
+            list(eco_to_literal.keys()), "mdi:leaf", attribute_topics),
         _create_discovery_select_tuple(
             topic_prefix, base_topic_path, "nanoe", "Nanoe mode", device,
-            list(nanoe_to_literal.keys()), "mdi:air-filter"),
+            list(nanoe_to_literal.keys()), "mdi:air-filter", attribute_topics),
     ]
+    if energy:
+        topics.append(_create_discovery_energy_sensor_tuple(topic_prefix, base_topic_path, device))
     return topics
 
 
-def state_event(topic_prefix: str, device: Device) -> typing.Tuple[str, str]:
-    topic = "{}/{}/{}/state".format(topic_prefix,
-                                    device.get_component(), device.get_id())
-    payload = {
+def state_topic(topic_prefix: str, device: Device) -> str:
+    return "{}/{}/{}/state".format(topic_prefix,
+                                   device.get_component(), device.get_id())
+
+
+def state_payload(device: Device) -> typing.Dict[str, typing.Any]:
+    """
+    State of the device as published to HA
+    """
+    return {
         "mode": device.get_mode_str(),
         "power": device.get_power_str(),
         "fan_mode": device.get_fanmode_str(),
@@ -157,4 +207,41 @@ def state_event(topic_prefix: str, device: Device) -> typing.Tuple[str, str]:
         "s_eco": device.get_eco_str(),
         "s_nanoe": device.get_nanoe_str(),
     }
-    return (topic, json.dumps(payload))
+
+
+# Attributes affected by each state field, mode is reported off while the power is off
+_FIELD_ATTRIBUTES: typing.Dict[str, typing.Tuple[str, ...]] = {
+    "temperature": ("target_temperature",),
+    "power": ("power", "mode"),
+    "mode": ("mode",),
+    "fan_speed": ("fan_mode",),
+    "air_swing_vertical": ("swing_mode",),
+    "air_swing_horizontal": ("swing_horizontal",),
+    "temperature_inside": ("inside_temperature",),
+    "temperature_outside": ("outside_temperature",),
+    "eco": ("s_eco",),
+    "nanoe": ("s_nanoe",),
+}
+
+
+def energy_topic(topic_prefix: str, device: Device) -> str:
+    return "{}/{}/{}/energy".format(topic_prefix, device.get_component(), device.get_id())
+
+
+def attribute_topic(topic_prefix: str, device: Device, attribute: str) -> str:
+    return "{}/{}/{}/{}".format(topic_prefix, device.get_component(), device.get_id(), attribute)
+
+
+def state_attributes(device: Device) -> typing.Dict[str, typing.Any]:
+    """
+    State of the device as published to the attribute topics. Update epoch changes on every poll
+    and is left out.
+    """
+    payload = state_payload(device)
+    del payload["update_epoch"]
+    return payload
+
+
+def changed_attributes(fields: typing.Iterable[str]) -> typing.Set[str]:
+    """ Attributes affected by the changed state fields """
+    return {attribute for field in fields for attribute in _FIELD_ATTRIBUTES.get(field, ())}
@@ -0,0 +1,40 @@
+"""
+Bulk state retrieval from the Comfort Cloud group listing.
+"""
+import hashlib
+import typing
+from pcomfortcloud import constants
+from pcomfortcloud.session import Session
+
+# Parameters of a complete device state as returned by `Session.get_device`
+STATE_PARAMETERS = ("temperature", "power", "temperatureInside", "temperatureOutside", "mode", "fanSpeed",
+                    "airSwingHorizontal", "airSwingVertical", "eco", "nanoe")
+
+
+def _device_id(raw: typing.Dict[str, typing.Any]) -> str:
+    """
+    Resolve device id the same way as `pcomfortcloud` does when listing the devices
+    """
+    if "deviceHashGuid" in raw:
+        return raw["deviceHashGuid"]
+    return hashlib.md5(raw["deviceGuid"].encode("utf-8")).hexdigest()
+
+
+def get_group_states(session: Session) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    Retrieve device parameters for all devices with a single group listing request.
+
+    Returns mapping of device id to parameters in the same format as `Session.get_device` returns them.
+    Devices for which the listing does not contain the complete parameters are left out and need to
+    be requested separately, a partial state would reset the missing settings to their defaults.
+    """
+    groups = session.execute_get( # type: ignore
+        f"{constants.BASE_PATH_ACC}/device/group", "get_groups", 200)
+    states: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for group in groups.get("groupList", []):
+        for device in group.get("deviceList", group.get("deviceIdList", [])):
+            if device and "parameters" in device:
+                parameters = session._api._read_parameters(device["parameters"]) # type: ignore
+                if all(key in parameters for key in STATE_PARAMETERS):
+                    states[_device_id(device)] = parameters
+    return states
@@ -0,0 +1,119 @@
+"""
+Instrumentation hooks for the hot paths of the bridge.
+
+Hooks are called after each traced operation with the span name, start epoch, duration in seconds and
+attributes. When no hooks are registered tracing costs a single check per call.
+
+Built-in spans carry the device id (`device`) or the MQTT topic and message type (`topic`, `kind`).
+`mqtt.publish` measures queueing the message, the broker I/O happens later in the publisher.
+"""
+import contextlib
+import functools
+import json
+import threading
+import typing
+import logging
+from time import perf_counter, time
+
+log = logging.getLogger(__name__)
+
+Hook = typing.Callable[[str, float, float, typing.Dict[str, typing.Any]], None]
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+_hooks: typing.List[Hook] = []
+
+
+def register(hook: Hook) -> None:
+    """ Register hook to be called for every span """
+    _hooks.append(hook)
+
+
+def unregister(hook: Hook) -> None:
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def _emit(name: str, started: float, duration: float, attributes: typing.Dict[str, typing.Any]) -> None:
+    for hook in list(_hooks):
+        try:
+            hook(name, started, duration, attributes)
+        except Exception as e:
+            log.exception("Error in hook %r: %r", hook, e)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: typing.Any) -> typing.Iterator[None]:
+    """ Trace the enclosed block """
+    if not _hooks:
+        yield
+        return
+    started = time()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _emit(name, started, perf_counter() - start, attributes)
+
+
+def traced(name: str, attributes: typing.Optional[typing.Callable[..., typing.Dict[str, typing.Any]]] = None
+           ) -> typing.Callable[[F], F]:
+    """
+    Trace every call of the decorated function. `attributes` is called with the arguments of the
+    function for the span attributes, only when there are hooks registered.
+    """
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            if not _hooks:
+                return func(*args, **kwargs)
+            started = time()
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _emit(name, started, perf_counter() - start, attributes(*args, **kwargs) if attributes else {})
+        return typing.cast(F, wrapper)
+    return decorator
+
+
+class CycleSummary:
+    """
+    Hook summing up the time spent per span, `flush` logs one line with the totals
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._totals: typing.Dict[str, typing.List[float]] = {}
+
+    def __call__(self, name: str, started: float, duration: float, attributes: typing.Dict[str, typing.Any]):
+        with self._lock:
+            total = self._totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+
+    def flush(self) -> None:
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        if totals:
+            log.info("Cycle: %s", ", ".join(f"{name} {int(count)}x {spent * 1000:.1f} ms"
+                                            for name, (count, spent) in sorted(totals.items())))
+
+
+class FileHook:
+    """
+    Hook writing each span as a JSON line to the given file
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, name: str, started: float, duration: float, attributes: typing.Dict[str, typing.Any]):
+        line = json.dumps({"name": name, "start": started, "duration": duration, **attributes}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
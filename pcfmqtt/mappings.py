@@ -1,4 +1,5 @@
 """ Mapping of modes and power states between pcomfortcloud and pcfmqtt. """
+import typing
 from pcomfortcloud import constants
 
 modes_to_literal = {
@@ -68,3 +69,24 @@ airswing_horizontal_to_string = {b: a for a, b in airswing_horizontal_to_literal
 airswing_to_string = {b: a for a, b in airswing_to_literal.items()}
 eco_to_string = {b: a for a, b in eco_to_literal.items()}
 nanoe_to_string = {b: a for a, b in nanoe_to_literal.items()}
+
+# Enum typed state parameters, stored by their value
+param_enums: typing.Dict[str, typing.Any] = {
+    "power": constants.Power,
+    "mode": constants.OperationMode,
+    "fanSpeed": constants.FanSpeed,
+    "airSwingHorizontal": constants.AirSwingLR,
+    "airSwingVertical": constants.AirSwingUD,
+    "eco": constants.EcoMode,
+    "nanoe": constants.NanoeMode,
+}
+
+
+def params_to_json(params: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """ State parameters with the enums replaced by their values """
+    return {key: value.value if key in param_enums else value for key, value in params.items()}
+
+
+def params_from_json(params: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """ State parameters with the enum values converted back to enums """
+    return {key: param_enums[key](value) if key in param_enums else value for key, value in params.items()}
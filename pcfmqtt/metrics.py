@@ -0,0 +1,193 @@
+"""
+Prometheus metrics for the bridge.
+
+Metrics are collected in memory and exported in Prometheus text format by an optional HTTP endpoint.
+"""
+import abc
+import bisect
+import threading
+import typing
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+LabelValues = typing.Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str],
+                   extra: typing.Optional[typing.Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> None:
+        self.name = name
+        self._documentation = documentation
+        self._label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @abc.abstractmethod
+    def _samples(self) -> typing.List[str]:
+        """ Sample lines in Prometheus text format """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self._documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """ Monotonically increasing value per label set """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: typing.Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def _samples(self) -> typing.List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self._label_names, labels)} {value}" for labels, value in values]
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values per label set """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(buckets)
+        # Per label set: counts per bucket (non-cumulative, last one is +Inf), sum
+        self._values: typing.Dict[LabelValues, typing.Tuple[typing.List[int], float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts, total = self._values.get(labels) or ([0] * (len(self._buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            values = self._values.get(labels)
+            return sum(values[0]) if values else 0
+
+    def total(self, *labels: str) -> float:
+        """ Sum of the observed values """
+        with self._lock:
+            values = self._values.get(labels)
+            return values[1] if values else 0.0
+
+    def _samples(self) -> typing.List[str]:
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self._label_names, labels, ('le', le))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self._label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self._label_names, labels)} {cumulative}")
+        return lines
+
+
+class GaugeFunction(_Metric):
+    """ Gauge whose values are read from a callback when exported """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._function: typing.Callable[[], typing.Iterable[typing.Tuple[LabelValues, float]]] = lambda: ()
+
+    def set_function(self, function: typing.Callable[[], typing.Iterable[typing.Tuple[LabelValues, float]]]):
+        self._function = function
+
+    def _samples(self) -> typing.List[str]:
+        return [f"{self.name}{_format_labels(self._label_names, labels)} {value}"
+                for labels, value in self._function()]
+
+
+REGISTRY: typing.List[_Metric] = []
+
+CLOUD_REQUEST_SECONDS = Histogram(
+    "pcfmqtt_cloud_request_seconds", "Panasonic Comfort Cloud request latency", ["call"])
+POLL_CYCLE_SECONDS = Histogram(
+    "pcfmqtt_poll_cycle_seconds", "Duration of a device poll cycle")
+COMMAND_SECONDS = Histogram(
+    "pcfmqtt_command_seconds", "Command latency from MQTT message to completed cloud update")
+MQTT_PUBLISHED = Counter(
+    "pcfmqtt_mqtt_published_total", "Published MQTT messages", ["type"])
+MQTT_PUBLISHED_BYTES = Counter(
+    "pcfmqtt_mqtt_published_bytes_total", "Published MQTT payload bytes", ["type"])
+MQTT_DROPPED = Counter(
+    "pcfmqtt_mqtt_dropped_total", "MQTT messages dropped by the publish queue", ["type"])
+MQTT_DELIVERY_SECONDS = Histogram(
+    "pcfmqtt_mqtt_delivery_seconds", "Time from queueing MQTT message until it was published", ["type"])
+MQTT_QUEUE = GaugeFunction(
+    "pcfmqtt_mqtt_queue_messages", "MQTT messages waiting in the publish queue and in flight", ["state"])
+OPTIMISTIC_CORRECTIONS = Counter(
+    "pcfmqtt_optimistic_corrections_total", "Optimistic states corrected after the cloud disagreed", ["reason"])
+VERIFY_POLLS = Counter(
+    "pcfmqtt_verify_polls_total", "Polls verifying a cloud update by result", ["result"])
+ERRORS = Counter(
+    "pcfmqtt_errors_total", "Errors by exception type", ["type"])
+DEVICE_STALENESS = GaugeFunction(
+    "pcfmqtt_device_staleness_seconds", "Seconds since the device state was last updated", ["device"])
+RETRY_QUEUE_DEPTH = GaugeFunction(
+    "pcfmqtt_retry_queue_devices", "Devices with a failed cloud update waiting to be retried")
+DEVICE_QUEUE_DEPTH = GaugeFunction(
+    "pcfmqtt_device_queue_depth", "Jobs waiting in the device mailboxes")
+
+
+def render() -> str:
+    """ All metrics in Prometheus text format """
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        log.debug(format, *args)
+
+
+def start_server(port: int, address: str = "") -> ThreadingHTTPServer:
+    """ Serve the metrics over HTTP in a background thread """
+    server = ThreadingHTTPServer((address, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics at port %i", port)
+    return server
@@ -1,13 +1,22 @@
+import json
+import threading
+import time
 import typing
 from paho.mqtt.client import Client, WebsocketConnectionError
 from paho.mqtt.client import MQTTMessage
 import logging
 
-from pcfmqtt.device import Device
-from pcfmqtt.events import discovery_event, state_event
+from pcfmqtt import hooks, metrics
+from pcfmqtt.device import COMMANDS, Device
+from pcfmqtt.events import (attribute_topic, changed_attributes, discovery_event, energy_topic,
+                            state_attributes, state_payload, state_topic)
+from pcfmqtt.publisher import Message, Publisher
 
 log = logging.getLogger(__name__)
 
+# Topic filters per SUBSCRIBE and UNSUBSCRIBE packet
+_SUBSCRIBE_BATCH = 100
+
 class Mqtt(object):
     """
     MQTT client wrapper for the paho-mqtt library.
@@ -15,67 +24,237 @@ class Mqtt(object):
     and publishes messages to the broker.
     """
 
-    def __init__(self, broker: str, port: int, topic_prefix: str, mqtt_wrapper: type[Client] = Client):
+    # Messages are handed to the client from a dedicated thread
+    _publish_thread = True
+
+    def __init__(self, broker: str, port: int, topic_prefix: str, mqtt_wrapper: type[Client] = Client,
+                 state_max_age: float = 300, retain_state: bool = False,
+                 qos: typing.Optional[typing.Dict[str, int]] = None, max_inflight: int = 20,
+                 max_queue: int = 1000, drop_policy: str = "oldest", attribute_topics: bool = False,
+                 energy_sensor: bool = False):
         self._port = port
         self._broker = broker
         self._topic_prefix = topic_prefix
         self._mqtt_wrapper: type[Client] = mqtt_wrapper
         self._client: Client = mqtt_wrapper()
         self._msg_callback: typing.Callable[[str, str, str], None] = lambda topic, payload, device_id: None
-        self._ready = False
+        self._ready = threading.Event()
         # The last devices that were discovered, used to resend discovery events on reconnect
         self._last_discovery_devices: typing.List[Device] = []
+        # Unchanged state is republished only after this many seconds, 0 to publish always
+        self._state_max_age = state_max_age
+        self._retain_state = retain_state
+        # Each attribute is published to its own topic instead of a single state JSON
+        self._attribute_topics = attribute_topics
+        # Devices are introduced with the energy consumption sensor
+        self._energy_sensor = energy_sensor
+        # Hash and publish time of the last state sent per topic
+        self._last_state: typing.Dict[str, typing.Tuple[int, float]] = {}
+        # Generated discovery events per device id along with the metadata they were generated from
+        self._discovery_cache: typing.Dict[
+            str, typing.Tuple[typing.Tuple[str, ...], typing.List[typing.Tuple[str, str]]]] = {}
+        # Hash of the last discovery payload published per topic
+        self._discovery_sent: typing.Dict[str, int] = {}
+        # Device id and command per command topic of the introduced devices, subscribed again on reconnect
+        self._routes: typing.Dict[str, typing.Tuple[str, str]] = {}
+        # Heartbeat topic and callback when running as part of a cluster
+        self._cluster_topic: typing.Optional[str] = None
+        self._instance = ""
+        self._cluster_callback: typing.Callable[[str, str], None] = lambda instance, payload: None
+        # History request topic and callback when serving the recorded readings
+        self._history_topic: typing.Optional[str] = None
+        self._history_callback: typing.Callable[[str], None] = lambda payload: None
+        # QoS per message type (state, discovery, cluster), 0 by default
+        self._publisher = Publisher(qos, max_inflight, max_queue, drop_policy, threaded=self._publish_thread)
+        self._publisher.attach(self._client, self._recover, self._on_delivered)
+        metrics.MQTT_QUEUE.set_function(lambda: [(("queued",), self._publisher.queued()),
+                                                 (("inflight",), self._publisher.inflight())])
 
     def _on_connect(self, client: Client, userdata: typing.Any, _flags: int, _rc: int):
         """ Handle MQTT connection """
         log.info("Connected to MQTT broker at %s:%s", self._broker, self._port)
         log.info("Subscribing to homeassistant/status")
         self._client.subscribe("homeassistant/status") # type: ignore
-        self._ready = True
+        if self._cluster_topic:
+            self._subscribe(f"{self._cluster_topic}/+")
+        if self._history_topic:
+            self._subscribe(self._history_topic)
+        self._subscribe_all(list(self._routes))
+        self._ready.set()
+        self._publisher.wake()
 
     def is_ready(self) -> bool:
         """ Check if the MQTT client is ready and it is ok to subscribe to topics """
-        return self._ready
+        return self._ready.is_set()
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """ Wait for the connection to be established, returns False on timeout """
+        return self._ready.wait(timeout)
 
     def _subscribe(self, topic: str) -> None:
         """ Subscribe to a topic """
         log.info("Subscribing to %s", topic)
         self._client.subscribe(topic) # type: ignore
 
+    def _subscribe_all(self, topics: typing.List[str]) -> None:
+        """ Subscribe to the topics with as few SUBSCRIBE packets as possible """
+        for i in range(0, len(topics), _SUBSCRIBE_BATCH):
+            self._client.subscribe([(topic, 0) for topic in topics[i:i + _SUBSCRIBE_BATCH]]) # type: ignore
+
+    def _unsubscribe_all(self, topics: typing.List[str]) -> None:
+        for i in range(0, len(topics), _SUBSCRIBE_BATCH):
+            self._client.unsubscribe(topics[i:i + _SUBSCRIBE_BATCH]) # type: ignore
+
+    def _command_routes(self, device: Device) -> typing.Dict[str, typing.Tuple[str, str]]:
+        return {f"{self._topic_prefix}/climate/{device.get_id()}/{command}": (device.get_id(), command)
+                for command in COMMANDS}
+
     def introduce_device(self, device: Device):
         """ Introduce a device to the MQTT broker, subscribing to its topics """
-        for postfix in ["power_cmd", "mode_cmd", "temp_cmd", "fan_cmd", "swing_cmd", "swing_h_cmd", 
-                       "s_eco_cmd", "s_nanoe_cmd"]:
-            self._subscribe(f"{self._topic_prefix}/climate/{device.get_id()}/{postfix}")
-    
-    def _publish(self, topic: str, payload: str) -> None:
-        """ Publish a message to the MQTT broker """
+        self.introduce_devices([device])
+
+    def introduce_devices(self, devices: typing.List[Device]):
+        """ Introduce the devices to the MQTT broker, subscribing to their command topics in batches """
+        topics: typing.List[str] = []
+        for device in devices:
+            for topic, route in self._command_routes(device).items():
+                if topic not in self._routes:
+                    self._routes[topic] = route
+                    topics.append(topic)
+        if topics:
+            log.info("Subscribing to %i command topics of %i device(s)", len(topics), len(devices))
+            self._subscribe_all(topics)
+
+    def forget_device(self, device: Device):
+        """ Stop handling commands for the device, eg. when another instance took it over """
+        topics = [topic for topic in self._command_routes(device) if self._routes.pop(topic, None)]
+        if topics:
+            log.info("Unsubscribing from command topics of %s", device.get_id())
+            self._unsubscribe_all(topics)
+        # State is sent again if the device comes back
+        self._last_state.pop(state_topic(self._topic_prefix, device), None)
+        for attribute in state_attributes(device):
+            self._last_state.pop(attribute_topic(self._topic_prefix, device, attribute), None)
+
+    def join_cluster(self, cluster: str, instance: str, callback: typing.Callable[[str, str], None]) -> None:
+        """
+        Exchange heartbeats with the other instances of the cluster. Callback gets the instance and
+        the heartbeat payload, `online` or `offline`. Must be called before connecting so that the
+        broker announces this instance offline if the connection is lost.
+        """
+        self._cluster_topic = f"pcfmqtt/{cluster}/members"
+        self._instance = instance
+        self._cluster_callback = callback
+
+    def serve_history(self, callback: typing.Callable[[str], None]) -> None:
+        """ Pass the history requests to the callback, must be called before connecting """
+        self._history_topic = "pcfmqtt/history/request"
+        self._history_callback = callback
+
+    def send_history_response(self, topic: str, payload: str) -> None:
+        self._publish(topic, payload, "history")
+
+    def send_heartbeat(self, online: bool = True) -> None:
+        """ Announce this instance to the other instances of the cluster """
+        if self._cluster_topic:
+            self._publish(f"{self._cluster_topic}/{self._instance}", "online" if online else "offline", "cluster")
+
+    @hooks.traced("mqtt.publish", lambda self, topic, payload, kind, *args, **kwargs: {"topic": topic, "kind": kind})
+    def _publish(self, topic: str, payload: str, kind: str, retain: bool = False) -> None:
+        """
+        Queue a message for publishing, kind selects the QoS and is used for metrics (state / discovery)
+        """
         log.debug("Publishing to %s: %s", topic, payload)
-        try:
-            self._client.publish(topic, payload) # type: ignore
-        except WebsocketConnectionError as e:
-            log.error("MQTT publish failed: %s", e)
-            log.info("Starting recovery process")
-            self.disconnect()
-            self.connect(self._msg_callback)
-            self.send_discovery_events(self._last_discovery_devices)
-            log.info("Recovery process done")
-            return
+        self._publisher.submit(topic, payload, kind, retain)
+
+    def _recover(self, error: Exception) -> None:
+        """ Reconnect after the client failed to publish, called from the publisher """
+        log.error("MQTT publish failed: %s", error)
+        metrics.ERRORS.inc(type(error).__name__)
+        log.info("Starting recovery process")
+        self._last_state = {}
+        self.disconnect()
+        self.connect(self._msg_callback)
+        self.send_discovery_events(self._last_discovery_devices, force=True)
+        log.info("Recovery process done")
 
-    def send_discovery_events(self, devices: typing.List[Device]) -> None:
-        """ Send discovery events for the given device IDs """
+    def _on_delivered(self, message: Message) -> None:
+        """ Discovery configuration counts as sent only once it has been published """
+        if message.kind == "discovery":
+            self._discovery_sent[message.topic] = hash(message.payload)
+
+    def _discovery_events(self, device: Device) -> typing.List[typing.Tuple[str, str]]:
+        """ Discovery events for the device, regenerated only if the device metadata has changed """
+        key = (self._topic_prefix, device.get_component(), device.get_name(), device.get_model(),
+               device.get_internal_id())
+        cached = self._discovery_cache.get(device.get_id())
+        if cached is None or cached[0] != key:
+            cached = (key, discovery_event(self._topic_prefix, device, self._attribute_topics,
+                                           self._energy_sensor))
+            self._discovery_cache[device.get_id()] = cached
+        return cached[1]
+
+    def send_discovery_events(self, devices: typing.List[Device], force: bool = False) -> None:
+        """
+        Send discovery events for the given devices. Unless forced, only the configurations that differ
+        from the ones sent earlier are published.
+        """
         self._last_discovery_devices = devices
         for device in devices:
-            events = discovery_event(self._topic_prefix, device)
-            for topic, payload in events:
+            for topic, payload in self._discovery_events(device):
+                fingerprint = hash(payload)
+                if not force and self._discovery_sent.get(topic) == fingerprint:
+                    continue
                 log.info("Publishing entity configuration to %s", topic)
-                self._publish(topic, payload)
+                self._publish(topic, payload, "discovery")
 
     def send_state_event(self, device: Device) -> None:
-        """ Send state event for the given device """
-        state_topic, state_payload = state_event(self._topic_prefix, device)
+        """
+        Send state event for the given device. State identical to the last one sent is skipped
+        until it is older than the max age.
+        """
+        if self._attribute_topics:
+            self._send_attributes(device)
+            return
+        with hooks.span("events.state_event", device=device.get_id()):
+            topic = state_topic(self._topic_prefix, device)
+            payload = state_payload(device)
+            # Update epoch changes on every poll and is not considered as a change
+            fingerprint = hash(json.dumps({k: v for k, v in payload.items() if k != "update_epoch"}))
+        now = time.time()
+        last = self._last_state.get(topic)
+        if self._state_max_age and last and last[0] == fingerprint and last[1] + self._state_max_age > now:
+            log.debug("%s: State unchanged, skipping update", device.get_name())
+            return
+        self._last_state[topic] = (fingerprint, now)
         log.info("%s: Reported state change, sending update to HA", device.get_name())
-        self._publish(state_topic, state_payload) # type: ignore
+        self._publish(topic, json.dumps(payload), "state", self._retain_state)
+
+    def send_energy_event(self, device: Device, total: float) -> None:
+        """ Send the energy consumption of the device in kWh """
+        self._publish(energy_topic(self._topic_prefix, device), f"{total:.3f}", "energy", self._retain_state)
+
+    def _send_attributes(self, device: Device) -> None:
+        """
+        Publish each attribute to its own topic. Only the attributes whose state fields changed are
+        compared to the last sent value, the rest are sent again once older than the max age.
+        """
+        changed = changed_attributes(device.pop_changed())
+        now = time.time()
+        sent = 0
+        for attribute, value in state_attributes(device).items():
+            topic = attribute_topic(self._topic_prefix, device, attribute)
+            last = self._last_state.get(topic)
+            if last and self._state_max_age and last[1] + self._state_max_age > now:
+                if attribute not in changed or last[0] == hash(value):
+                    continue
+            self._last_state[topic] = (hash(value), now)
+            self._publish(topic, str(value), "state", self._retain_state)
+            sent += 1
+        if sent:
+            log.info("%s: Reported state change, sent %i attribute(s) to HA", device.get_name(), sent)
+        else:
+            log.debug("%s: State unchanged, skipping update", device.get_name())
 
     def connect(self, message_callback: typing.Callable[[str, str, str], None]) -> None:
         """ Connect to MQTT """
@@ -87,16 +266,26 @@ class Mqtt(object):
         except WebsocketConnectionError as e:
             log.info("MQTT client already disconnected: %s", e)
         print(f"Connecting to MQTT broker at {self._broker}:{self._port}")
+        self._ready.clear()
         self._client = self._mqtt_wrapper()
         self._client.on_connect = self._on_connect
         self._client.on_message = self._on_message
+        self._publisher.attach(self._client, self._recover, self._on_delivered)
+        if self._cluster_topic:
+            self._client.will_set(f"{self._cluster_topic}/{self._instance}", "offline") # type: ignore
         self._client.connect(self._broker, self._port, 60) # type: ignore
         self._client.loop_start() # type: ignore
         log.info("MQTT started")
 
+    def flush(self, timeout: float) -> bool:
+        """ Wait until the queued messages are handed to the client, returns False on timeout """
+        return self._publisher.flush(timeout)
+
     def disconnect(self) -> None:
         """ Disconnect from MQTT """
         log.info("Disconnecting from MQTT")
+        if not self.flush(5):
+            log.warning("%i MQTT messages were not published before disconnecting", self._publisher.queued())
         self._client.loop_stop() # type: ignore
         self._client.disconnect() # type: ignore
 
@@ -107,7 +296,9 @@ class Mqtt(object):
     def _handle_hass_status(self, payload: str):
         if payload == "online":
             log.info("Received hass online event, resending configuration..")
-            self.send_discovery_events(self._last_discovery_devices)
+            # HA needs the state again as well
+            self._last_state = {}
+            self.send_discovery_events(self._last_discovery_devices, force=True)
         elif payload == "offline":
             log.info("Received hass offline event")
         else:
@@ -121,11 +312,20 @@ class Mqtt(object):
         if topic == "homeassistant/status":
             self._handle_hass_status(payload)
             return
-        parts = topic.split("/")
-        if parts[0] != self._topic_prefix or len(parts) < 4:
+        if self._cluster_topic and topic.startswith(self._cluster_topic + "/"):
+            self._cluster_callback(topic[len(self._cluster_topic) + 1:], payload)
+            return
+        if topic == self._history_topic:
+            try:
+                self._history_callback(payload)
+            except Exception as e:
+                log.exception("Error in MQTT history callback: %s", e)
+            return
+        route = self._routes.get(topic)
+        if route is None:
+            log.debug("No route for %s, ignoring", topic)
             return
-        device_id = parts[2]
-        command = parts[3]
+        device_id, command = route
         try:
             self._msg_callback(device_id, command, payload)
         except Exception as e:
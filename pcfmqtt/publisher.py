@@ -0,0 +1,306 @@
+"""
+Publish queue between the bridge and the paho client.
+"""
+import collections
+import itertools
+import threading
+import time
+import typing
+import logging
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS, WebsocketConnectionError
+
+from pcfmqtt import metrics
+
+log = logging.getLogger(__name__)
+
+DROP_POLICIES = ("oldest", "newest", "block")
+# Never dropped nor counted against the queue size, lost discovery would not be sent again, lost
+# heartbeats would let the other instances take over the devices and lost replies are never asked again
+PROTECTED = ("discovery", "cluster", "history")
+# Replies to requests, each one is delivered instead of replacing the queued one for the same topic
+REPLIES = ("history",)
+# Wait after the first failed recovery, doubled on each consecutive one
+RECOVER_BACKOFF = 1.0
+MAX_RECOVER_BACKOFF = 60.0
+
+
+class Message(typing.NamedTuple):
+    topic: str
+    payload: str
+    kind: str
+    qos: int
+    retain: bool
+    queued: float
+    key: str  # Key in the queue, the topic unless the message is a reply
+
+
+class Publisher:
+    """
+    Queues the messages and hands them to the client while there is room in the in-flight window.
+    Messages leave the window once paho reports them published, for QoS 0 that is when they are
+    written to the socket and for QoS 1 and 2 when the broker has acknowledged them.
+
+    Every topic carries the latest state only, so a queued message is replaced by a newer one for
+    the same topic. Replies are the exception, they share the topic of the requester and are queued
+    each on their own. When the queue is full the `oldest` policy drops the oldest queued message,
+    `newest` drops the new one and `block` makes the caller wait for room before dropping the new one.
+    Discovery, cluster and reply messages are always queued without waiting and only the other
+    messages are dropped, so callers in the MQTT network thread sending those never block.
+
+    By default the messages are sent from a dedicated thread so callers never wait for the broker.
+    Without the thread they are sent right away from the caller, used with the asyncio engine where
+    the client is only touched from the event loop.
+    """
+
+    def __init__(self, qos: typing.Optional[typing.Dict[str, int]] = None, max_inflight: int = 20,
+                 max_queue: int = 1000, drop_policy: str = "oldest", threaded: bool = True,
+                 block_timeout: float = 5, inflight_timeout: float = 60) -> None:
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self._qos = dict(qos or {})
+        self._max_inflight = max(max_inflight, 1)
+        self._max_queue = max(max_queue, 1)
+        self._drop_policy = drop_policy
+        self._threaded = threaded
+        self._block_timeout = block_timeout
+        self._inflight_timeout = inflight_timeout
+        self._cond = threading.Condition()
+        self._client: typing.Optional[Client] = None
+        self._on_error: typing.Callable[[Exception], None] = lambda error: None
+        self._on_delivered: typing.Callable[[Message], None] = lambda message: None
+        self._queue: "collections.OrderedDict[str, Message]" = collections.OrderedDict()
+        self._replies = itertools.count()
+        self._bounded = 0 # Queued messages that count against the queue size
+        # Connection error to recover from once the backoff has passed, after recovery itself failed
+        self._error: typing.Optional[Exception] = None
+        self._recover_at: float = 0
+        self._recover_failures = 0
+        self._inflight: typing.Dict[int, typing.Tuple[Message, float]] = {}
+        # Published before the client returned the message id
+        self._early: typing.Set[int] = set()
+        self._sending = 0
+        self._draining = False
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def attach(self, client: Client, on_error: typing.Callable[[Exception], None],
+               on_delivered: typing.Optional[typing.Callable[[Message], None]] = None) -> None:
+        """
+        Send through the given client. Messages in flight on the previous client are queued again,
+        `on_error` is called when the client fails with connection error and `on_delivered` when
+        a message has been published. Errors raised by `on_error` are retried with a backoff.
+        `on_delivered` is called with the queue locked and must not block.
+        """
+        client.on_publish = self.on_publish
+        with self._cond:
+            self._client = client
+            self._on_error = on_error
+            if on_delivered is not None:
+                self._on_delivered = on_delivered
+            for message, _ in self._inflight.values():
+                self._requeue(message)
+            self._inflight.clear()
+            self._early.clear()
+        self.wake()
+
+    def submit(self, topic: str, payload: str, kind: str, retain: bool = False) -> bool:
+        """ Queue message for publishing, returns False if it was dropped """
+        key = f"{topic}#{next(self._replies)}" if kind in REPLIES else topic
+        message = Message(topic, payload, kind, self._qos.get(kind, 0), retain, time.time(), key)
+        with self._cond:
+            if key in self._queue:
+                # Replaced in place so frequently updated topics don't fall behind
+                self._remove(key)
+                self._add(message)
+                return True
+            if kind not in PROTECTED:
+                if self._bounded >= self._max_queue and self._drop_policy == "block" and self._may_block():
+                    self._cond.wait_for(lambda: self._bounded < self._max_queue, self._block_timeout)
+                if self._bounded >= self._max_queue:
+                    oldest = next((queued for queued in self._queue.values() if queued.kind not in PROTECTED), None)
+                    if self._drop_policy == "oldest" and oldest is not None:
+                        self._remove(oldest.key)
+                        self._dropped(oldest, "queue full")
+                    else:
+                        self._dropped(message, "queue full")
+                        return False
+            self._add(message)
+            self._ensure_thread()
+            self._cond.notify_all()
+        if not self._threaded:
+            self._drain()
+        return True
+
+    def on_publish(self, client: Client, userdata: typing.Any, mid: int) -> None:
+        """ Paho callback for published messages """
+        with self._cond:
+            if client is not self._client:
+                return
+            entry = self._inflight.pop(mid, None)
+            if entry is None:
+                self._early.add(mid)
+                return
+            self._delivered(entry[0])
+            self._cond.notify_all()
+        if not self._threaded:
+            self._drain()
+
+    def wake(self) -> None:
+        """ Try sending again, eg. after the client has connected """
+        with self._cond:
+            self._cond.notify_all()
+        if not self._threaded:
+            self._drain()
+
+    def flush(self, timeout: float) -> bool:
+        """ Wait until all the queued messages are handed to the client, returns False on timeout """
+        if not self._threaded or threading.current_thread() is self._thread:
+            return not self._queue
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._sending, timeout)
+
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def _may_block(self) -> bool:
+        return self._threaded and threading.current_thread() is not self._thread
+
+    def _ensure_thread(self) -> None:
+        if self._threaded and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mqtt-publish", daemon=True)
+            self._thread.start()
+
+    def _add(self, message: Message) -> None:
+        self._queue[message.key] = message
+        if message.kind not in PROTECTED:
+            self._bounded += 1
+
+    def _remove(self, key: str) -> Message:
+        message = self._queue.pop(key)
+        if message.kind not in PROTECTED:
+            self._bounded -= 1
+        return message
+
+    def _requeue(self, message: Message) -> None:
+        """ Put message back to the front of the queue unless there is a newer one for the topic """
+        if message.key not in self._queue:
+            self._add(message)
+            self._queue.move_to_end(message.key, last=False)
+
+    def _dropped(self, message: Message, reason: str) -> None:
+        log.debug("Dropping message to %s: %s", message.topic, reason)
+        metrics.MQTT_DROPPED.inc(message.kind)
+
+    def _delivered(self, message: Message) -> None:
+        metrics.MQTT_DELIVERY_SECONDS.observe(time.time() - message.queued, message.kind)
+        self._on_delivered(message)
+
+    def _expire(self, now: float) -> None:
+        """ Give up on messages that never got published, eg. QoS 0 messages lost with the connection """
+        for mid, (message, sent) in list(self._inflight.items()):
+            if sent + self._inflight_timeout < now:
+                del self._inflight[mid]
+                self._dropped(message, "not published in time")
+
+    def _sendable(self) -> bool:
+        """ True if there are messages, room in the window and the client is connected """
+        if not self._queue or self._client is None:
+            return False
+        self._expire(time.time())
+        if len(self._inflight) + self._sending >= self._max_inflight:
+            return False
+        return bool(self._client.is_connected()) # type: ignore
+
+    def _next(self) -> typing.Optional[Message]:
+        if not self._sendable():
+            return None
+        message = self._remove(next(iter(self._queue)))
+        self._sending += 1
+        self._cond.notify_all()
+        return message
+
+    def _send(self, client: Client, message: Message) -> bool:
+        """ Hand message to the client, returns False if it has to be retried later """
+        try:
+            info = client.publish(message.topic, message.payload, qos=message.qos, retain=message.retain)
+        except (WebsocketConnectionError, OSError) as e:
+            # Connection is recovered by the owner of the client
+            with self._cond:
+                self._sending -= 1
+                self._requeue(message)
+            self._recover(e)
+            return False
+        except (ValueError, TypeError) as e:
+            log.error("Unable to publish to %s: %s", message.topic, e)
+            with self._cond:
+                self._sending -= 1
+            metrics.MQTT_DROPPED.inc(message.kind)
+            return True
+        with self._cond:
+            self._sending -= 1
+            if info.rc != MQTT_ERR_SUCCESS or client is not self._client:
+                self._requeue(message)
+                return False
+            metrics.MQTT_PUBLISHED.inc(message.kind)
+            metrics.MQTT_PUBLISHED_BYTES.inc(message.kind, amount=len(message.payload.encode("utf-8")))
+            if info.mid in self._early:
+                self._early.discard(info.mid)
+                self._delivered(message)
+            else:
+                self._inflight[info.mid] = (message, time.time())
+            self._cond.notify_all()
+        return True
+
+    def _recover(self, error: Exception) -> None:
+        """ Let the owner recover the connection, failed recovery is tried again after a backoff """
+        try:
+            self._on_error(error)
+        except Exception as e:
+            self._recover_failures += 1
+            delay = min(RECOVER_BACKOFF * 2 ** (self._recover_failures - 1), MAX_RECOVER_BACKOFF)
+            log.error("MQTT recovery failed, trying again in %.0f s: %r", delay, e)
+            metrics.ERRORS.inc(type(e).__name__)
+            self._error, self._recover_at = error, time.time() + delay
+            return
+        self._error, self._recover_failures = None, 0
+
+    def _drain(self) -> bool:
+        """ Send while there is room in the window, returns False if sending failed """
+        with self._cond:
+            # Publishing can call back here, the outermost call keeps sending
+            if self._draining:
+                return True
+            self._draining = True
+        try:
+            if self._error is not None:
+                if self._recover_at > time.time():
+                    return False
+                self._recover(self._error)
+                if self._error is not None:
+                    return False
+            while True:
+                with self._cond:
+                    client = self._client
+                    message = self._next()
+                if message is None:
+                    return True
+                if not self._send(client, message): # type: ignore
+                    return False
+        finally:
+            with self._cond:
+                self._draining = False
+
+    def _run(self) -> None:
+        while True:
+            try:
+                failed = not self._drain()
+            except Exception as e:
+                # Keeps the thread alive, nothing would be published otherwise
+                log.exception("Unexpected error in MQTT publisher: %r", e)
+                failed = True
+            with self._cond:
+                if failed or not self._sendable():
+                    # Wakes up once a second to notice connection and expired messages
+                    self._cond.wait(1)
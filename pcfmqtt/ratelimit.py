@@ -0,0 +1,207 @@
+"""
+Rate limiting and circuit breaking for Panasonic Comfort Cloud requests.
+"""
+import random
+import threading
+import typing
+import logging
+from time import time, sleep
+from pcomfortcloud.session import Session
+from pcomfortcloud.exceptions import Error
+from pcfmqtt import metrics
+
+log = logging.getLogger(__name__)
+
+
+class RateLimitedError(Error):
+    """ Request was not sent as the request budget is used up """
+
+
+class CircuitOpenError(Error):
+    """ Request was not sent as the cloud is failing and we are backing off """
+
+
+class TokenBucket:
+    """
+    Request budget refilled continuously at the given rate per minute
+    """
+
+    def __init__(self, per_minute: float, burst: typing.Optional[float] = None) -> None:
+        self._rate = per_minute / 60
+        self._capacity = burst or per_minute
+        self._tokens = self._capacity
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def try_acquire(self, reserve: float = 0) -> bool:
+        """ Take a token if one is available without going below `reserve` tokens """
+        with self._lock:
+            self._refill(time())
+            if self._tokens - 1 >= reserve:
+                self._tokens -= 1
+                return True
+            return False
+
+    def available_at(self, reserve: float = 0) -> float:
+        """ Epoch when a token is available without going below `reserve` tokens """
+        with self._lock:
+            now = time()
+            self._refill(now)
+            missing = reserve + 1 - self._tokens
+            return now if missing <= 0 else now + missing / self._rate
+
+    def acquire(self, timeout: float) -> bool:
+        """ Wait for a token at most `timeout` seconds """
+        deadline = time() + timeout
+        while not self.try_acquire():
+            wait_until = self.available_at()
+            if wait_until > deadline:
+                return False
+            sleep(max(wait_until - time(), 0.01))
+        return True
+
+
+class CircuitBreaker:
+    """
+    Stops requests after consecutive failures. Requests are allowed again after exponentially growing
+    delay with jitter, first as a single probe (half-open) and after it succeeds as normal.
+
+    Failures of the same device count once, a single failing unit is backed off by the device itself
+    and must not stop the requests of the whole account.
+    """
+
+    def __init__(self, threshold: int = 3, base_delay: float = 15, max_delay: float = 600) -> None:
+        self._threshold = threshold
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._failures = 0
+        self._failed: typing.Set[str] = set()  # Devices failed since the last success
+        self._opened = 0  # How many times opened in a row, grows the delay
+        self._retry_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """ Check whether request can be sent, claims the probe when half-open """
+        with self._lock:
+            if self._opened == 0:
+                return True
+            if self._probing or time() < self._retry_at:
+                return False
+            log.info("Probing Panasonic Comfort Cloud after backoff")
+            self._probing = True
+            return True
+
+    def retry_at(self) -> float:
+        """ Epoch when requests are allowed again, 0 if they are allowed now """
+        with self._lock:
+            return self._retry_at if self._opened else 0
+
+    def release_probe(self) -> None:
+        """ Give up the claimed probe without sending the request """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened:
+                log.info("Panasonic Comfort Cloud recovered, resuming requests")
+            self._failures = 0
+            self._failed.clear()
+            self._opened = 0
+            self._probing = False
+
+    def record_failure(self, key: typing.Optional[str] = None) -> None:
+        """ Count a failed request, `key` identifies the device the request was for """
+        with self._lock:
+            if key is None or key not in self._failed:
+                self._failures += 1
+            if key is not None:
+                self._failed.add(key)
+            if not self._probing and self._failures < self._threshold:
+                return
+            delay = min(self._max_delay, self._base_delay * 2 ** self._opened)
+            delay = random.uniform(delay / 2, delay)
+            self._opened += 1
+            self._probing = False
+            self._retry_at = time() + delay
+            log.warning("Sequence of errors detected. Halting requests for %.0f seconds", delay)
+
+
+class GuardedSession:
+    """
+    `Session` wrapper applying the shared request budget and circuit breaker to the cloud requests.
+
+    Commands (`set_device`) and logins have priority: background polls can only use the budget above
+    the reserved share and never wait for it, while commands wait for the next token. The wait is kept
+    short as it holds a device worker, commands not sent in time are retried from the retry queue.
+    """
+
+    def __init__(self, session: Session, bucket: TokenBucket, breaker: CircuitBreaker,
+                 reserve: float = 0, command_timeout: float = 5) -> None:
+        self._session = session
+        self._bucket = bucket
+        self._breaker = breaker
+        self._reserve = reserve
+        self._command_timeout = command_timeout
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._session, name)
+
+    def _call(self, call: str, priority: bool, key: typing.Optional[str],
+              func: typing.Callable[..., typing.Any], *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if not self._breaker.allow():
+            metrics.ERRORS.inc(CircuitOpenError.__name__)
+            raise CircuitOpenError("Requests halted after errors")
+        if priority:
+            acquired = self._bucket.acquire(self._command_timeout)
+        else:
+            acquired = self._bucket.try_acquire(self._reserve)
+        if not acquired:
+            # Probe was not sent, let the next one try
+            self._breaker.release_probe()
+            metrics.ERRORS.inc(RateLimitedError.__name__)
+            raise RateLimitedError("Request budget used up")
+        start = time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            # Token refresh raises the errors of requests as is, they must not leave the probe claimed
+            self._breaker.record_failure(key)
+            metrics.ERRORS.inc(type(e).__name__)
+            raise
+        finally:
+            metrics.CLOUD_REQUEST_SECONDS.observe(time() - start, call)
+        self._breaker.record_success()
+        return result
+
+    def next_allowed(self) -> float:
+        """ Epoch when background requests can be sent again """
+        return max(self._breaker.retry_at(), self._bucket.available_at(self._reserve))
+
+    def login(self) -> None:
+        self._call("login", True, None, self._session.login)
+
+    def get_devices(self) -> typing.Any:
+        return self._call("get_devices", False, None, self._session.get_devices)
+
+    def get_device(self, device_id: str) -> typing.Any:
+        return self._call("get_device", False, device_id, self._session.get_device, device_id)
+
+    def set_device(self, device_id: str, **kwargs: typing.Any) -> typing.Any:
+        return self._call("set_device", True, device_id, self._session.set_device, device_id, **kwargs)
+
+    def history(self, device_id: str, mode: str, date: str, tz: str = "+01:00") -> typing.Any:
+        # History is the least urgent, it leaves twice the reserve for the polls and commands
+        if self._bucket.available_at(self._reserve * 2) > time():
+            metrics.ERRORS.inc(RateLimitedError.__name__)
+            raise RateLimitedError("Request budget used up")
+        return self._call("history", False, device_id, self._session.history, device_id, mode, date, tz)
+
+    def execute_get(self, url: str, function_description: str, expected_status_code: int) -> typing.Any:
+        return self._call(function_description, False, None, self._session.execute_get, url, function_description,
+                          expected_status_code)
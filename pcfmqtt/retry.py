@@ -0,0 +1,122 @@
+"""
+Durable queue of the device updates that failed to reach the cloud.
+"""
+import json
+import os
+import threading
+import typing
+import logging
+from pcfmqtt.mappings import params_from_json, params_to_json
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Wait after the first failure, doubled on each consecutive one
+MIN_BACKOFF = 5.0
+MAX_BACKOFF = 300.0
+# Rest of the queue is retried this long after the oldest entry, which probes whether the cloud is back
+DRAIN_DELAY = 1.0
+
+
+class RetryEntry(typing.NamedTuple):
+    params: typing.Dict[str, typing.Any]
+    queued: float  # When the device first failed
+
+
+def backoff(failures: int) -> float:
+    """ Seconds until the next attempt after `failures` consecutive failed updates """
+    return min(MIN_BACKOFF * 2 ** (failures - 1), MAX_BACKOFF)
+
+
+class RetryQueue:
+    """
+    Latest desired state per device waiting to be written to the cloud, in the order the devices
+    first failed. A newer state for a queued device replaces the older one but keeps its place.
+
+    Failures are usually the cloud being unavailable for every device, so the backoff is shared.
+    Once it has passed the oldest entry is retried first and the rest follow shortly after, right
+    away if the oldest went through. Every change is written to `path` so queued updates survive
+    a restart.
+    """
+
+    def __init__(self, path: typing.Optional[str] = None) -> None:
+        self._path = path
+        self._entries: typing.Dict[str, RetryEntry] = load(path) if path else {}
+        self._failures = 0
+        self._next_at: float = 0
+        self._lock = threading.Lock()
+        if self._entries:
+            log.info("%i queued device update(s) to retry", len(self._entries))
+
+    def put(self, key: str, params: typing.Dict[str, typing.Any], now: float) -> float:
+        """ Queue the desired state after a failed update, returns the epoch of the next attempt """
+        with self._lock:
+            entry = self._entries.get(key)
+            self._entries[key] = RetryEntry(params, entry.queued if entry else now)
+            self._failures += 1
+            self._next_at = now + backoff(self._failures)
+            self._save()
+            return self._retry_at(key)
+
+    def done(self, key: str) -> None:
+        """ Cloud answered the update of the device, so it is reachable again """
+        with self._lock:
+            self._failures = 0
+            self._next_at = 0
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def get(self, key: str) -> typing.Optional[RetryEntry]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def retry_at(self, key: str) -> typing.Optional[float]:
+        """ Epoch when the queued update of the device is due, None if there is nothing queued """
+        with self._lock:
+            return self._retry_at(key) if key in self._entries else None
+
+    def _retry_at(self, key: str) -> float:
+        if not self._failures or next(iter(self._entries)) == key:
+            return self._next_at
+        return self._next_at + DRAIN_DELAY
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _save(self) -> None:
+        if not self._path:
+            return
+        try:
+            save(self._path, self._entries)
+        except OSError as e:
+            log.warning("Failed to write the retry queue %s: %r", self._path, e)
+
+
+def save(path: str, entries: typing.Dict[str, RetryEntry]) -> None:
+    """ Write the queue atomically """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": VERSION, "devices": [
+            {"id": key, "params": params_to_json(entry.params), "queued": entry.queued}
+            for key, entry in entries.items()]}, f)
+    os.replace(tmp, path)
+    log.debug("Retry queue of %i devices written to %s", len(entries), path)
+
+
+def load(path: str) -> typing.Dict[str, RetryEntry]:
+    """ Read the queue by device id in order, returns empty dict if there is no usable queue """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            log.warning("Ignoring retry queue with unknown version: %r", data.get("version"))
+            return {}
+        return {entry["id"]: RetryEntry(params_from_json(entry["params"]), entry["queued"])
+                for entry in data["devices"]}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning("Ignoring unreadable retry queue %s: %r", path, e)
+        return {}
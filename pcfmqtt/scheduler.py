@@ -0,0 +1,76 @@
+"""
+Scheduler for device refreshes.
+"""
+import heapq
+import itertools
+import threading
+import typing
+from time import time
+
+
+class RefreshScheduler:
+    """
+    Priority queue of refresh deadlines keyed by device id.
+
+    Each key has at most one effective deadline, rescheduling replaces the earlier one. Outdated heap
+    entries are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self) -> None:
+        self._heap: typing.List[typing.Tuple[float, int, str]] = []
+        self._deadlines: typing.Dict[str, float] = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def schedule(self, key: str, deadline: float) -> None:
+        """ Set the next deadline for the key and wake up the waiting loop """
+        with self._cond:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), key))
+            self._cond.notify_all()
+
+    def remove(self, key: str) -> None:
+        """ Forget the key """
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def _drop_stale(self) -> None:
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> typing.Optional[float]:
+        """ Earliest deadline, None if nothing is scheduled """
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: typing.Optional[float] = None) -> typing.List[str]:
+        """ Remove and return all keys whose deadline has passed """
+        now = time() if now is None else now
+        due: typing.List[str] = []
+        with self._cond:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, key = heapq.heappop(self._heap)
+                del self._deadlines[key]
+                due.append(key)
+                self._drop_stale()
+        return due
+
+    def wait(self, until: float) -> None:
+        """
+        Block until the next deadline or the given epoch, whichever comes first. Returns early if
+        something is (re)scheduled or `wake` is called meanwhile.
+        """
+        with self._cond:
+            self._drop_stale()
+            if self._heap:
+                until = min(until, self._heap[0][0])
+            remaining = until - time()
+            if remaining > 0:
+                self._cond.wait(remaining)
+
+    def wake(self) -> None:
+        """ Wake up the waiting loop """
+        with self._cond:
+            self._cond.notify_all()
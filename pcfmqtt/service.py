@@ -1,75 +1,451 @@
 """ Main service for pcfmqtt """
+import json
+import threading
 import time
 import typing
 import logging
+from concurrent.futures import as_completed
 from pcomfortcloud.session import Session
 from pcomfortcloud.exceptions import Error
+from pcfmqtt.accounts import Account
+from pcfmqtt.actors import DeviceActors
+from pcfmqtt.cluster import Cluster
+from pcfmqtt.convergence import Convergence
 from pcfmqtt.device import Device
+from pcfmqtt.groups import get_group_states
 from pcfmqtt.mqtt import Mqtt
+from pcfmqtt.ratelimit import CircuitOpenError, RateLimitedError
+from pcfmqtt.retry import RetryQueue
+from pcfmqtt.scheduler import RefreshScheduler
+from pcfmqtt import energy, hooks, metrics, snapshot, timeseries
 
 log = logging.getLogger(__name__)
 
 class Service:
     """
     Main service
+
+    Each account has its own session, request budget and devices. Devices of all the accounts share
+    the MQTT connection, refresh scheduler and workers.
     """
     def __init__(self, username: str, password: str, mqtt: Mqtt, update_interval: int = 60,
-                 session_wrapper: type[Session] = Session) -> None:
-        self._username = username
-        self._password = password
+                 session_wrapper: type[Session] = Session, poll_workers: int = 1,
+                 bulk_refresh: bool = False, coalesce_ms: int = 0, requests_per_minute: int = 60,
+                 token_dir: typing.Optional[str] = None, snapshot_file: typing.Optional[str] = None,
+                 trace_summary: bool = False, accounts: typing.Optional[typing.List[Account]] = None,
+                 cluster: typing.Optional[Cluster] = None, energy_interval: int = 0,
+                 energy_file: typing.Optional[str] = None, history: bool = False,
+                 optimistic: bool = False, retry_file: typing.Optional[str] = None) -> None:
         self._mqtt: Mqtt = mqtt
         self._update_interval = update_interval
+        self._accounts: typing.List[Account] = accounts or [
+            Account(username, password, "", session_wrapper, requests_per_minute, token_dir)]
+        # Devices of all the accounts by their id, and the account each one belongs to
         self._devices: typing.Dict[str, Device] = {}
-        self._wrapper_session = session_wrapper
-        self._session: Session = session_wrapper(self._username, self._password)
+        self._owners: typing.Dict[str, Account] = {}
+        # Devices polled and commanded by this instance, all of them unless partitioned in a cluster
+        self._owned: typing.Set[str] = set()
+        self._cluster = cluster
+        self._heartbeat_stop = threading.Event()
+        if cluster:
+            mqtt.join_cluster(cluster.name, cluster.instance, self._on_heartbeat)
+        # Readings of the devices are recorded and served over MQTT
+        self._history = history
+        if history:
+            mqtt.serve_history(self._on_history_request)
+        self._bulk_refresh = bulk_refresh
+        self._coalesce_ms = coalesce_ms
+        # Commands are reported to HA before they are written to the cloud
+        self._optimistic = optimistic
+        # Learned per model from the updates of every device
+        self._convergence = Convergence()
+        # Failed cloud updates, written to the file so they are retried after a restart
+        self._retries = RetryQueue(retry_file)
+        self._scheduler = RefreshScheduler()
+        self._snapshot_file = snapshot_file
+        # Energy history is fetched per device every this many seconds, 0 to disable
+        self._energy_interval = energy_interval
+        self._energy_file = energy_file
+        self._energy_scheduler = RefreshScheduler()
+        self._energy_lock = threading.Lock()
+        self._meters: typing.Dict[str, energy.EnergyMeter] = \
+            energy.load(energy_file) if energy_interval and energy_file else {}
+        # Logs time spent per traced operation after each loop cycle
+        self._cycle_summary: typing.Optional[hooks.CycleSummary] = None
+        if trace_summary:
+            self._cycle_summary = hooks.CycleSummary()
+            hooks.register(self._cycle_summary)
+        # Polls and commands are run per device in order, different devices in parallel
+        self._actors = DeviceActors(poll_workers)
+        metrics.DEVICE_STALENESS.set_function(lambda: [
+            ((device.get_id(),), time.time() - device.get_update_epoch())
+            for device in list(self._devices.values())])
+        metrics.DEVICE_QUEUE_DEPTH.set_function(lambda: [((), self._actors.queue_depth())])
+        metrics.RETRY_QUEUE_DEPTH.set_function(lambda: [((), self._retries.depth())])
+
+    def _register(self, account: Account, device: Device):
+        if self._history and device.get_history() is None:
+            device.set_history(timeseries.Series())
+        self._devices[device.get_id()] = device
+        self._owners[device.get_id()] = account
+        account.devices[device.get_id()] = device
+
+    def _is_owned(self, device: Device) -> bool:
+        return self._cluster is None or self._cluster.owns(device.get_internal_id())
+
+    def _owned_devices(self) -> typing.List[Device]:
+        return [device for device in self._devices.values() if device.get_id() in self._owned]
+
+    def _take(self, devices: typing.List[Device]):
+        """ Start polling the devices and accepting commands for them """
+        if not devices:
+            return
+        self._owned.update(device.get_id() for device in devices)
+        self._mqtt.introduce_devices(devices)
+        if self._energy_interval:
+            now = time.time()
+            for device in devices:
+                # Spread over the interval so the fetches don't line up with each other or the polls
+                self._energy_scheduler.schedule(
+                    device.get_id(), now + self._energy_interval * energy.stagger(device.get_id()))
+
+    def _release(self, device: Device):
+        """ Stop polling the device and accepting commands for it """
+        self._owned.discard(device.get_id())
+        self._scheduler.remove(device.get_id())
+        self._energy_scheduler.remove(device.get_id())
+        self._mqtt.forget_device(device)
+
+    def _reschedule(self, device: Device):
+        """
+        Schedule next refresh for the device, respecting the backoff of its account after errors.
+        Devices of an account that is not listed are scheduled once it has been listed again.
+        """
+        account = self._owners.get(device.get_id())
+        if account and account.listed and device.get_id() in self._owned:
+            self._scheduler.schedule(device.get_id(),
+                                     max(device.get_refresh_time(), account.session.next_allowed()))
 
-    def connect_to_cc(self) -> bool:
+    def connect_to_cc(self, account: typing.Optional[Account] = None) -> bool:
         """
         Connect to Panasonic Comfort Cloud. This will also populate the initial devices list.
 
+        Already known devices (eg. from snapshot) are kept along with their state and they are
+        refreshed in the background, new ones are refreshed before introducing them.
+
+        @param account: Account to connect, all accounts by default
         @return: True if connected, False otherwise
         """
-        log.info("Connecting to Panasonic Comfort Cloud..")
+        if account is None:
+            return all([self.connect_to_cc(each) for each in self._accounts])
+        log.info("Connecting to Panasonic Comfort Cloud as %s..", account)
+        for key in account.devices:
+            self._scheduler.remove(key)
         try:
-            self._session.login()
+            account.login()
             log.info("Login succesfull. Reading and populating devices")
-            self._devices = {}
-            for d in self._session.get_devices():
-                device = Device(d)
-                # Refresh state after 30s so HA can pick it up
-                device.update_state(self._session, 30)
-                self._devices[device.get_id()] = device
-                self._mqtt.introduce_device(device)
+            known = {device.get_internal_id(): device for device in account.devices.values()}
+            devices: typing.Dict[str, Device] = {}
+            for d in account.session.get_devices():
+                device = known.get(d["id"])
+                if device is None:
+                    device = Device(d, self._coalesce_ms / 1000, account.name, self._optimistic,
+                                    self._convergence, self._retries)
+                    if self._is_owned(device):
+                        # Refresh state after 30s so HA can pick it up
+                        device.update_state(account.session, 30)
+                devices[device.get_id()] = device
         except Error as e:
-            log.error(
-                "Failed initialization to Panasonic Comfort Cloud: %s. " +
-                "Will attempt again in 10 minutes.", e)
-            self._session = self._wrapper_session(self._username, self._password)
+            log.error("Failed initialization to Panasonic Comfort Cloud as %s: %s", account, e)
+            account.connection_failed(e)
             return False
-        log.info("Total %i devices found", len(self._devices))
-        log.info("Connected to Panasonic Comfort Cloud")
+        for key, device in account.devices.items():
+            if key not in devices:
+                self._release(device)
+                self._devices.pop(key, None)
+                self._owners.pop(key, None)
+                self._retries.done(key)
+        account.devices = {}
+        for device in devices.values():
+            self._register(account, device)
+        taken = [device for device in devices.values() if self._is_owned(device)]
+        self._take(taken)
+        account.listed = True
+        for device in taken:
+            self._reschedule(device)
+        log.info("Total %i devices found", len(devices))
+        log.info("Connected to Panasonic Comfort Cloud as %s", account)
         return True
 
     def _check_connections(self) -> bool:
         """
-        Check if we are connected to CC. If not, try to reconnect.
+        Check if we are connected to CC. If not, try to reconnect the accounts that are not waiting
+        for their next attempt.
 
-        @return: True if connected, False otherwise
+        @return: True if at least one account is connected, False otherwise
         """
-        if not self._session.is_token_valid(): # type: ignore
-            return self.connect_to_cc()
-        return True
+        now = time.time()
+        return any([self._check_connection(account) for account in self._accounts if account.retry_at <= now])
+
+    def _check_connection(self, account: Account) -> bool:
+        if not account.listed:
+            return self.connect_to_cc(account)
+        if account.session.is_token_valid(): # type: ignore
+            return True
+        if account.devices:
+            # Devices are known already, refreshing the token is enough
+            try:
+                account.login()
+                return True
+            except Error as e:
+                log.error("Token refresh failed for %s: %s", account, e)
+                account.connection_failed(e)
+                return False
+        return self.connect_to_cc(account)
+
+    def _update_devices(self):
+        """
+        Refresh the devices that are due and send state event for each one that got updated. Devices
+        are scheduled again according to their next refresh time.
+
+        With more than one poll worker the refreshes are run in parallel and state is published as soon
+        as each device completes, so full cycle takes about as long as the slowest single request.
+        Refreshes go through the same device mailboxes as the commands so they never overlap.
+
+        With bulk refresh the states are read from a single group listing per account and only the
+        devices missing from it are requested one by one.
+
+        Cloud errors are handled per account so failing account does not hold back the others. Devices
+        of an account that is not listed are left out until the account has been listed again.
+        """
+        due = [self._devices[key] for key in self._scheduler.pop_due()
+               if key in self._devices and self._owners[key].listed]
+        if not due:
+            return
+        try:
+            self._refresh(due)
+        finally:
+            for device in due:
+                self._reschedule(device)
+
+    def _refresh(self, devices: typing.List[Device]):
+        start = time.time()
+        try:
+            self._refresh_devices(devices)
+        finally:
+            metrics.POLL_CYCLE_SECONDS.observe(time.time() - start)
+
+    def _refresh_devices(self, devices: typing.List[Device]):
+        states: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        errors: typing.Dict[Account, Error] = {}
+        if self._bulk_refresh:
+            for account in dict.fromkeys(self._owners[device.get_id()] for device in devices):
+                try:
+                    states.update(get_group_states(account.session))
+                except Error as e:
+                    errors[account] = e
+            log.debug("Bulk refresh returned state for %i of %i devices", len(states), len(devices))
+        futures = {self._actors.submit(device.get_id(), self._poll, device, self._owners[device.get_id()].session,
+                                       states.get(device.get_internal_id())): device
+                   for device in devices if self._owners[device.get_id()] not in errors}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Error as e:
+                # Let rest of the devices finish before handling
+                errors.setdefault(self._owners[futures[future].get_id()], e)
+        jobs, avg_wait, max_wait = self._actors.wait_stats()
+        log.debug("Device queue depth %i, %i jobs waited %.0f ms on average, %.0f ms at most",
+                  self._actors.queue_depth(), jobs, avg_wait * 1000, max_wait * 1000)
+        for account, error in errors.items():
+            if isinstance(error, (CircuitOpenError, RateLimitedError)):
+                log.info("Postponing updates for %s: %s", account, error)
+            else:
+                log.error("Error in Panasonic Comfort Cloud for %s: %r", account, error)
+                account.handle_session_error(error)
+
+    def _poll(self, device: Device, session: Session, parameters: typing.Optional[typing.Dict[str, typing.Any]]):
+        """
+        Refresh the device and send its state in the same mailbox job, so the changed fields are read
+        before the next command of the device changes them again
+        """
+        if device.update_state(session, self._update_interval, parameters):
+            self._mqtt.send_state_event(device)
+
+    def _warm_start(self):
+        """
+        Introduce devices from the snapshot and publish their last known state right away. The devices
+        are reconciled against the cloud once connected.
+        """
+        entries = snapshot.load(self._snapshot_file) if self._snapshot_file else []
+        if not entries:
+            return
+        if not self._mqtt.wait_until_ready(10):
+            log.warning("MQTT not ready, skipping warm start")
+            return
+        accounts = {account.name: account for account in self._accounts}
+        taken: typing.List[Device] = []
+        for entry in entries:
+            if entry.account not in accounts:
+                continue
+            device = Device(entry.raw, self._coalesce_ms / 1000, entry.account, self._optimistic,
+                            self._convergence, self._retries)
+            device.restore_state(entry.params, entry.epoch)
+            self._register(accounts[entry.account], device)
+            if self._is_owned(device):
+                taken.append(device)
+        self._take(taken)
+        for device in taken:
+            self._scheduler.schedule(device.get_id(), 0)
+        self._mqtt.send_discovery_events(self._owned_devices())
+        for device in self._owned_devices():
+            self._mqtt.send_state_event(device)
+        log.info("Warm started %i devices from snapshot", len(self._devices))
+
+    def _on_heartbeat(self, instance: str, payload: str):
+        """ Heartbeat from a cluster member, runs in the MQTT network thread """
+        if self._cluster and self._cluster.heartbeat(instance, payload):
+            self._scheduler.wake()
+
+    def _send_heartbeats(self):
+        """ Heartbeats are sent from own thread so that long update cycles don't delay them """
+        while not self._heartbeat_stop.is_set():
+            self._mqtt.send_heartbeat()
+            # Main loop checks for the silent members
+            self._scheduler.wake()
+            self._heartbeat_stop.wait(self._cluster.heartbeat_interval)
+
+    def _join_cluster(self):
+        """ Start the heartbeats and give the other members time to show up before taking any devices """
+        self._mqtt.wait_until_ready(10)
+        threading.Thread(target=self._send_heartbeats, name="heartbeat", daemon=True).start()
+        time.sleep(self._cluster.heartbeat_interval + 1)
+        self._cluster.refresh()
+        log.info("Joined cluster %s as %s", self._cluster.name, self._cluster.instance)
+
+    def _rebalance(self):
+        """ Take over and hand off devices as members join and leave the cluster """
+        if not self._cluster or not self._cluster.refresh():
+            return
+        taken: typing.List[Device] = []
+        released = 0
+        for device in list(self._devices.values()):
+            owned = self._is_owned(device)
+            if owned and device.get_id() not in self._owned:
+                taken.append(device)
+            elif not owned and device.get_id() in self._owned:
+                self._release(device)
+                released += 1
+        self._take(taken)
+        for device in taken:
+            # Previous owner kept the state, refresh right away
+            self._scheduler.schedule(device.get_id(), 0)
+        if taken:
+            self._mqtt.send_discovery_events(self._owned_devices())
+        log.info("Took over %i and handed off %i devices, handling %i of %i devices", len(taken), released,
+                 len(self._owned), len(self._devices))
+
+    def _on_history_request(self, payload: str):
+        """
+        Answer history request, runs in the MQTT network thread. Request is JSON,
 
-    def _sleep_on_last_error(self, last_error: bool):
-        if last_error:
-            # Protect Panasonic Comfort Cloud from being spammed with faulty requests.
-            # Service seems to experience a good amount of Bad Gateway errors so better
-            # to wait if too many errors are encountered.
-            log.warning("Sequence of errors detected. " +
-                              "Halting requests for 10 minutes")
-            time.sleep(600)
+            {"id": "1", "device": "pcc_living_room_ac", "metric": "inside_temperature", "window": 3600,
+             "reply_to": "pcfmqtt/history/response"}
+
+        Window is in seconds back from now, `since` and `until` epochs can be given instead. Response
+        has the points as `[start, avg, min, max]` along with their resolution and a summary. In a
+        cluster only the instance owning the device answers.
+        """
+        try:
+            request = json.loads(payload)
+            device_id = str(request["device"])
+            reply_to = str(request.get("reply_to") or "pcfmqtt/history/response")
+            until = float(request.get("until") or time.time())
+            since = float(request.get("since") or until - float(request.get("window") or 3600))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning("Ignoring invalid history request %r: %r", payload, e)
+            return
+        response: typing.Dict[str, typing.Any] = {"id": request.get("id"), "device": device_id,
+                                                  "metric": request.get("metric")}
+        device = self._devices.get(device_id)
+        if device is not None and device_id not in self._owned:
+            return
+        history = device.get_history() if device else None
+        if history is None:
+            if self._cluster:
+                return
+            response["error"] = "Unknown device"
         else:
-            time.sleep(60)
+            try:
+                resolution, points = history.query(str(request.get("metric")), since, until)
+                response.update(timeseries.summary(points))
+                response["resolution"] = resolution
+                response["points"] = [[point.start, round(point.avg, 2), point.min, point.max] for point in points]
+            except KeyError:
+                response["error"] = f"Unknown metric, one of {', '.join(timeseries.METRICS)}"
+        self._mqtt.send_history_response(reply_to, json.dumps(response))
+
+    def _update_energy(self):
+        """ Queue the energy history fetches that are due to the device mailboxes """
+        for key in self._energy_scheduler.pop_due():
+            device = self._devices.get(key)
+            if device and key in self._owned:
+                self._actors.submit(key, self._collect_energy, device)
+
+    def _collect_energy(self, device: Device):
+        """
+        Fetch the newest energy history of the device and publish its consumption. History only uses
+        the budget left over from the polls and commands, it is postponed when there is none.
+        """
+        account = self._owners.get(device.get_id())
+        if account is None:
+            return
+        now = time.time()
+        with self._energy_lock:
+            meter = self._meters.setdefault(device.get_id(), energy.EnergyMeter())
+            date = meter.next_date(now)
+        try:
+            data = account.session.history(device.get_internal_id(), energy.DAY_MODE, date,
+                                           energy.utc_offset(now))
+        except (CircuitOpenError, RateLimitedError) as e:
+            log.debug("%s: Postponing energy history: %s", device.get_name(), e)
+            self._energy_scheduler.schedule(device.get_id(), max(account.session.next_allowed(), now + 60))
+            return
+        except Error as e:
+            log.warning("%s: Failed to fetch energy history: %s", device.get_name(), e)
+            account.handle_session_error(e)
+            self._energy_scheduler.schedule(device.get_id(), now + self._energy_interval)
+            return
+        if data is None:
+            # Device not listed in the session, merging nothing would close the hours as zero
+            log.warning("%s: Failed to fetch energy history: device not listed", device.get_name())
+            self._energy_scheduler.schedule(device.get_id(), now + self._energy_interval)
+            return
+        with self._energy_lock:
+            parameters = data.get("parameters") or {}
+            meter.merge(date, parameters.get("historyDataList") or [], time.time())
+            total = meter.total()
+            # Earlier days are caught up without waiting for the full interval
+            delay = 60 if meter.behind(time.time()) else self._energy_interval
+        self._mqtt.send_energy_event(device, total)
+        self._energy_scheduler.schedule(device.get_id(), time.time() + delay)
+
+    def _save_energy(self):
+        if not self._energy_file or not self._meters:
+            return
+        try:
+            with self._energy_lock:
+                energy.save(self._energy_file, self._meters)
+        except OSError as e:
+            log.error("Failed to write energy meters: %r", e)
+
+    def _save_snapshot(self):
+        if not self._snapshot_file or not any(account.listed for account in self._accounts):
+            return
+        try:
+            snapshot.save(self._snapshot_file, list(self._devices.values()))
+        except OSError as e:
+            log.error("Failed to write snapshot: %r", e)
 
     def start(self):
         """
@@ -77,49 +453,89 @@ class Service:
         
         Main loop will update the devices and publish the state to MQTT. If connection to
         either CC or MQTT is lost, it will reset the connection and try to reconnect again
-        in start of the loop.
+        in start of the loop. Between the updates the loop sleeps until the next device is due or
+        until a command reschedules one.
+
+        Errors from the cloud don't stop the loop. The circuit breaker of the account backs off after
+        repeated errors and the failed devices are scheduled after the backoff.
+
+        In a cluster the devices are partitioned between the members and the devices of a member that
+        leaves or goes silent are taken over by the others.
         """
         last_full_update = 0
-        last_error = False  # Flag to represent whether we encountered error on last update pass
+        last_snapshot = time.time()
         self._mqtt.connect(self.handle_message)
         try:
+            if self._cluster:
+                self._join_cluster()
+            self._warm_start()
             while True:
                 if not self._check_connections():
-                    log.warning("Connection errors. Waiting for 10 minutes")
-                    time.sleep(600)
+                    # Wait until next account can be tried again
+                    delay = max(min(account.retry_at for account in self._accounts) - time.time(), 0)
+                    log.warning("Connection errors. Waiting for %.0f seconds", delay)
+                    time.sleep(delay)
                     continue
                 try:
-                    for device in self._devices.values():
-                        if device.update_state(self._session, self._update_interval):
-                            self._mqtt.send_state_event(device)
-                    # Do one full update once an hour
-                    # just in case we have missed HA restart for some reason
+                    self._rebalance()
+                    self._update_devices()
+                    self._update_energy()
+                    if self._cycle_summary:
+                        self._cycle_summary.flush()
+                    # Check discovery configurations once an hour, only the changed ones are sent
                     if last_full_update + 60*60 < time.time():
-                        self._mqtt.send_discovery_events(list(self._devices.values()))
+                        self._mqtt.send_discovery_events(self._owned_devices())
                         last_full_update = time.time()
-                        log.info("Full discovery cycle done for all devices")
-                    time.sleep(1)
-                    last_error = False
+                        log.info("Discovery cycle done for all devices")
+                    if last_snapshot + 5*60 < time.time():
+                        self._save_snapshot()
+                        self._save_energy()
+                        last_snapshot = time.time()
+                    deadlines = [account.retry_at for account in self._accounts if account.retry_at]
+                    energy_due = self._energy_scheduler.next_deadline()
+                    if energy_due is not None:
+                        deadlines.append(energy_due)
+                    self._scheduler.wait(min([last_full_update + 60*60, last_snapshot + 5*60] + deadlines))
                 except Error as e:
                     log.exception("Error in Panasonic Comfort Cloud: %r", e)
-                    self._sleep_on_last_error(last_error)
-                    last_error = True
-                    self._session = self._wrapper_session(self._username, self._password)
         except KeyboardInterrupt as e:
             log.exception("Interrupted: %r", e)
         finally:
             log.info("Shutting down")
+            self._save_snapshot()
+            self._save_energy()
+            self._heartbeat_stop.set()
+            # Let the other members take over right away
+            self._mqtt.send_heartbeat(online=False)
             self._mqtt.disconnect()
-            self._session.logout() # type: ignore
+            self._actors.shutdown()
+            for account in self._accounts:
+                account.logout()
             log.info("Shutdown complete")
 
     def handle_message(self, device_id: str, command: str, payload: str):
+        """
+        MQTT message callback. Runs in the MQTT network thread so the command is only queued to the
+        device mailbox.
+        """
         device = self._devices.get(device_id)
-        if device:
-            if device.command(self._session, command, payload):
+        if device and device_id in self._owned:
+            self._actors.submit(device.get_id(), self._command, device, command, payload, time.time(),
+                                priority=True)
+        else:
+            log.debug("No device for this event, ignoring")
+
+    def _command(self, device: Device, command: str, payload: str, received: float):
+        account = self._owners.get(device.get_id())
+        if account is None:
+            return
+        try:
+            if device.command(account.session, command, payload, received):
                 self._mqtt.send_state_event(device)
                 log.info("%s: Reported state change, sending update to HA", device.get_name())
             else:
                 log.debug("%s: Reported no state change, ignoring", device.get_name())
-        else:
-            log.debug("No device for this event, ignoring")
+        except Exception as e:
+            log.exception("%s: Command failed: %r", device.get_name(), e)
+        # Commands move the next refresh
+        self._reschedule(device)
@@ -0,0 +1,54 @@
+"""
+Snapshot of the known devices and their last state, used to warm start the bridge.
+"""
+import json
+import os
+import typing
+import logging
+from pcfmqtt.device import Device
+from pcfmqtt.mappings import params_from_json, params_to_json
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class SnapshotEntry(typing.NamedTuple):
+    raw: typing.Dict[str, typing.Any]
+    params: typing.Dict[str, typing.Any]
+    epoch: float
+    account: str = ""
+
+
+def save(path: str, devices: typing.Iterable[Device]) -> None:
+    """ Write the snapshot atomically """
+    entries = []
+    for device in devices:
+        entries.append({"raw": device.get_raw(), "params": params_to_json(device.get_state_params()),
+                        "epoch": device.get_update_epoch(),
+                        "account": device.get_namespace()})
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": VERSION, "devices": entries}, f)
+    os.replace(tmp, path)
+    log.debug("Snapshot of %i devices written to %s", len(entries), path)
+
+
+def load(path: str) -> typing.List[SnapshotEntry]:
+    """ Read the snapshot, returns empty list if there is no usable snapshot """
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            log.warning("Ignoring snapshot with unknown version: %r", data.get("version"))
+            return []
+        return [SnapshotEntry(entry["raw"],
+                              params_from_json(entry["params"]),
+                              entry["epoch"],
+                              entry.get("account", ""))
+                for entry in data["devices"]]
+    except (OSError, ValueError, KeyError) as e:
+        log.warning("Ignoring unreadable snapshot %s: %r", path, e)
+        return []
@@ -0,0 +1,122 @@
+"""
+In-memory time series of the device readings with downsampling.
+"""
+import array
+import threading
+import typing
+
+# Readings recorded per device, named as in the state payload
+METRICS = ("inside_temperature", "outside_temperature", "target_temperature")
+
+# Resolution in seconds and number of buckets per tier, 0 resolution keeps every sample. With the
+# default poll interval raw samples cover 2 hours, 5 minute buckets a day and hourly buckets a week.
+TIERS = ((0, 120), (5 * 60, 288), (60 * 60, 168))
+
+
+class Point(typing.NamedTuple):
+    start: float
+    avg: float
+    min: float
+    max: float
+    count: int
+
+
+class _Tier:
+    """
+    Ring buffer of buckets aggregating the samples within `resolution` seconds. Values are kept in
+    arrays of 32-bit floats so the memory per device is fixed.
+    """
+
+    def __init__(self, resolution: int, capacity: int, metrics: int) -> None:
+        self.resolution = resolution
+        self._capacity = capacity
+        self._metrics = metrics
+        self._start = array.array("d", bytes(8 * capacity))
+        self._count = array.array("I", bytes(4 * capacity))
+        # Min, max and sum per metric, metric major
+        self._min = array.array("f", bytes(4 * capacity * metrics))
+        self._max = array.array("f", bytes(4 * capacity * metrics))
+        self._sum = array.array("f", bytes(4 * capacity * metrics))
+        self._head = -1  # Latest bucket
+        self._size = 0
+
+    def add(self, epoch: float, values: typing.Sequence[float]) -> None:
+        start = epoch - epoch % self.resolution if self.resolution else epoch
+        i = self._head
+        if self._size and self._start[i] == start:
+            self._count[i] += 1
+            for m, value in enumerate(values):
+                j = m * self._capacity + i
+                self._min[j] = min(self._min[j], value)
+                self._max[j] = max(self._max[j], value)
+                self._sum[j] += value
+            return
+        i = self._head = (self._head + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
+        self._start[i] = start
+        self._count[i] = 1
+        for m, value in enumerate(values):
+            j = m * self._capacity + i
+            self._min[j] = self._max[j] = self._sum[j] = value
+
+    def covers(self, since: float) -> bool:
+        """ True if no samples after `since` have been dropped from the tier """
+        if self._size < self._capacity:
+            return True
+        return self._start[(self._head + 1) % self._capacity] <= since
+
+    def points(self, metric: int, since: float, until: float) -> typing.List[Point]:
+        """ Buckets starting within the window, oldest first """
+        points: typing.List[Point] = []
+        for n in range(self._size - 1, -1, -1):
+            i = (self._head - n) % self._capacity
+            start = self._start[i]
+            if since <= start <= until:
+                j = metric * self._capacity + i
+                count = self._count[i]
+                points.append(Point(start, self._sum[j] / count, self._min[j], self._max[j], count))
+        return points
+
+
+class Series:
+    """
+    Readings of a single device. Each sample is added to every tier so the coarser ones are
+    downsampled as the samples arrive, queries are answered from the finest tier covering the window.
+    """
+
+    def __init__(self, metrics: typing.Sequence[str] = METRICS,
+                 tiers: typing.Sequence[typing.Tuple[int, int]] = TIERS) -> None:
+        self._metrics = {name: i for i, name in enumerate(metrics)}
+        self._tiers = [_Tier(resolution, capacity, len(metrics)) for resolution, capacity in tiers]
+        self._last = float("-inf")
+        self._lock = threading.Lock()
+
+    def append(self, epoch: float, readings: typing.Mapping[str, float]) -> None:
+        """ Record the readings, samples not newer than the previous one are ignored """
+        with self._lock:
+            if epoch <= self._last:
+                return
+            self._last = epoch
+            values = [float(readings[name]) for name in self._metrics]
+            for tier in self._tiers:
+                tier.add(epoch, values)
+
+    def query(self, metric: str, since: float, until: float) -> typing.Tuple[int, typing.List[Point]]:
+        """
+        Points of the metric within the window and their resolution in seconds, 0 for raw samples
+
+        @raise KeyError: if the metric is not recorded
+        """
+        index = self._metrics[metric]
+        with self._lock:
+            tier = next((tier for tier in self._tiers if tier.covers(since)), self._tiers[-1])
+            return tier.resolution, tier.points(index, since, until)
+
+
+def summary(points: typing.Sequence[Point]) -> typing.Dict[str, typing.Any]:
+    """ Minimum, maximum and average over the points, weighted by the samples in each """
+    count = sum(point.count for point in points)
+    if not count:
+        return {"min": None, "max": None, "avg": None, "samples": 0}
+    return {"min": min(point.min for point in points), "max": max(point.max for point in points),
+            "avg": sum(point.avg * point.count for point in points) / count, "samples": count}
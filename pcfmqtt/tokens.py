@@ -0,0 +1,57 @@
+"""
+On-disk token storage for Panasonic Comfort Cloud sessions.
+"""
+import hashlib
+import os
+import typing
+import logging
+from pcomfortcloud.exceptions import Error, LoginError
+
+log = logging.getLogger(__name__)
+
+
+def token_file(directory: str, username: str) -> str:
+    """
+    Path to the token file of the account. Directory is created with access for the owner only.
+    """
+    directory = os.path.expanduser(directory)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # Mode is applied only when the directory is created
+    os.chmod(directory, 0o700)
+    account = hashlib.sha256(username.strip().lower().encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"token-{account}.json")
+
+
+def prepare(path: typing.Optional[str]) -> None:
+    """
+    Make sure the token file is accessible by the owner only before the session writes to it.
+    `pcomfortcloud` creates the file with the process umask, so a missing file is created beforehand
+    holding no token, which makes the next login a full one.
+    """
+    if not path:
+        return
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        os.chmod(path, 0o600)
+        return
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write("null")
+
+
+def restrict(path: typing.Optional[str]) -> None:
+    """ Limit token file access to the owner """
+    if path and os.path.exists(path):
+        os.chmod(path, 0o600)
+
+
+def discard(path: typing.Optional[str]) -> None:
+    """ Remove stored token so that next login is a full one """
+    if path and os.path.exists(path):
+        log.info("Discarding stored token")
+        os.remove(path)
+
+
+def is_token_rejected(error: Error) -> bool:
+    """ Check whether the error means that the token is no longer accepted """
+    return isinstance(error, LoginError) or "received: 401" in str(error)
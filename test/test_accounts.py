@@ -0,0 +1,46 @@
+""" Tests for accounts """
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from pcomfortcloud.session import Session
+from pcfmqtt.accounts import load_accounts
+
+
+class TestAccounts(unittest.TestCase):
+    """ Test reading the accounts file """
+
+    def _load(self, data):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "accounts.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            return load_accounts(path, mock.create_autospec(Session), requests_per_minute=30)
+
+    def test_load(self):
+        accounts = self._load({"accounts": [
+            {"name": "home", "username": "user1", "password": "pass1"},
+            {"name": "cabin", "username": "user2", "password": "pass2", "rate_limit": 10}]})
+        self.assertEqual(["home", "cabin"], [account.name for account in accounts])
+        self.assertEqual(6, accounts[0]._reserve)
+        self.assertEqual(2, accounts[1]._reserve)
+
+    def test_single_account_without_name(self):
+        accounts = self._load({"accounts": [{"username": "user1", "password": "pass1"}]})
+        self.assertEqual("", accounts[0].name)
+
+    def test_invalid(self):
+        for data in ({}, {"accounts": []},
+                     {"accounts": [{"name": "home", "username": "user1"}]},
+                     {"accounts": [{"name": "home/1", "username": "user1", "password": "pass1"}]},
+                     {"accounts": [{"name": "home", "username": "user1", "password": "pass1"},
+                                   {"name": "home", "username": "user2", "password": "pass2"}]},
+                     {"accounts": [{"username": "user1", "password": "pass1"},
+                                   {"name": "cabin", "username": "user2", "password": "pass2"}]}):
+            with self.assertRaises(ValueError):
+                self._load(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+""" Tests for DeviceActors """
+import threading
+import unittest
+from pcfmqtt.actors import DeviceActors
+
+
+class TestDeviceActors(unittest.TestCase):
+    """ Test DeviceActors """
+
+    def test_jobs_for_device_run_in_order(self):
+        actors = DeviceActors(4)
+        results = []
+        futures = [actors.submit("device", results.append, i) for i in range(20)]
+        for future in futures:
+            future.result(1)
+        self.assertEqual(list(range(20)), results)
+        actors.shutdown()
+
+    def test_submit_returns_before_job_runs(self):
+        """ Submitting does not wait for the job, queue depth is visible meanwhile """
+        actors = DeviceActors(1)
+        release = threading.Event()
+        first = actors.submit("device", release.wait, 1)
+        second = actors.submit("device", lambda: "done")
+        self.assertGreaterEqual(actors.queue_depth("device"), 1)
+        release.set()
+        self.assertTrue(first.result(1))
+        self.assertEqual("done", second.result(1))
+        self.assertEqual(0, actors.queue_depth())
+        jobs, _, _ = actors.wait_stats()
+        self.assertEqual(2, jobs)
+        actors.shutdown()
+
+    def test_exception_is_stored_in_future(self):
+        actors = DeviceActors(1)
+        future = actors.submit("device", int, "invalid")
+        with self.assertRaises(ValueError):
+            future.result(1)
+        self.assertEqual(7, actors.submit("device", int, "7").result(1))
+        actors.shutdown()
+
+
+    def test_priority_job_not_delayed_by_other_devices(self):
+        """ Command is served before the polls already queued for the other devices """
+        actors = DeviceActors(1)
+        release = threading.Event()
+        results = []
+        busy = actors.submit("busy", release.wait, 1)
+        polls = [actors.submit(f"device{i}", results.append, f"poll{i}") for i in range(10)]
+        command = actors.submit("commanded", results.append, "command", priority=True)
+        release.set()
+        busy.result(1)
+        command.result(1)
+        for poll in polls:
+            poll.result(1)
+        self.assertEqual("command", results[0])
+        actors.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+""" Tests for asyncio engine """
+import asyncio
+import unittest
+from unittest import mock
+
+from pcomfortcloud.exceptions import ResponseError
+from pcomfortcloud.session import Session
+from pcfmqtt.aio import AsyncMqtt, AsyncService
+
+
+class TestAsyncService(unittest.TestCase):
+    """ Test AsyncService """
+
+    def setUp(self):
+        self.mqtt_mock = mock.create_autospec(AsyncMqtt, instance=True)
+        self.session_mock = mock.create_autospec(Session)
+        self.service = AsyncService("username", "password", self.mqtt_mock, 60, self.session_mock)
+
+    def test_command_sends_state_on_change(self):
+        """ State is sent once the command has been applied """
+        device = mock.Mock()
+        device.get_id.return_value = "device"
+        device.command.return_value = True
+
+        async def run():
+            self.service._register(device)
+            await self.service._command(device, "temp_cmd", "21", 0)
+
+        asyncio.run(run())
+        device.command.assert_called_once_with(self.service._session.session, "temp_cmd", "21", 0)
+        self.mqtt_mock.send_state_event.assert_called_once_with(device)
+
+    def test_rejected_token_logs_in_again(self):
+        """ Token rejected after startup is replaced by full login with a fresh session """
+        session = self.service._session
+        self.service._listed = True
+
+        async def run():
+            await self.service._handle_session_error(session, ResponseError("Expected status code 200, received: 401"))
+            # Errors from the replaced session are not handled twice
+            await self.service._handle_session_error(session, ResponseError("Expected status code 200, received: 401"))
+
+        asyncio.run(run())
+        self.assertIsNot(session, self.service._session)
+        self.assertTrue(self.service._listed)
+        self.session_mock.return_value.login.assert_called_once()
+        self.session_mock.return_value.get_devices.assert_called_once()
+
+    def test_unknown_device_ignored(self):
+        """ Messages for unknown devices do not spawn anything """
+        self.service.handle_message("missing", "temp_cmd", "21")
+        self.assertEqual(0, len(self.service._tasks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+""" Smoke test for the benchmarks """
+import unittest
+from benchmarks.__main__ import run
+
+
+class TestBenchmarks(unittest.TestCase):
+    """ Run the benchmark scenarios with few devices """
+
+    def test_run(self):
+        result = run(devices=5, latency_ms=0, error_rate=0, workers=2, cycles=1)
+        self.assertTrue(result["connected"])
+        self.assertEqual(5, result["commands_completed"])
+        self.assertEqual(25, result["discovery_messages"])
+        self.assertEqual(5, result["cloud_requests"]["set_device"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+""" Tests for cluster membership and device partitioning """
+import unittest
+from pcfmqtt.cluster import Cluster, HashRing
+
+
+class TestCluster(unittest.TestCase):
+    """ Test hash ring and membership """
+
+    def test_ring_moves_only_keys_of_leaving_member(self):
+        keys = [f"device-{i}" for i in range(1000)]
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b"])
+        owners = {key: before.owner(key) for key in keys}
+        self.assertTrue(all(300 < list(owners.values()).count(member) < 370 for member in "abc"))
+        for key in keys:
+            if owners[key] != "c":
+                self.assertEqual(owners[key], after.owner(key))
+
+    def test_members_agree_on_owners(self):
+        a = Cluster("cluster", "a")
+        b = Cluster("cluster", "b")
+        a.heartbeat("b", "online")
+        b.heartbeat("a", "online")
+        self.assertTrue(a.refresh())
+        self.assertTrue(b.refresh())
+        keys = [f"device-{i}" for i in range(100)]
+        self.assertEqual(len(keys), sum(a.owns(key) for key in keys) + sum(b.owns(key) for key in keys))
+        self.assertTrue(all(a.owns(key) != b.owns(key) for key in keys))
+
+    def test_silent_and_offline_members_are_dropped(self):
+        cluster = Cluster("cluster", "a", heartbeat_interval=10)
+        self.assertTrue(cluster.heartbeat("b", "online", now=0))
+        self.assertFalse(cluster.heartbeat("b", "online", now=10))
+        self.assertTrue(cluster.heartbeat("c", "online", now=10))
+        self.assertTrue(cluster.refresh(now=20))
+        self.assertEqual(("a", "b", "c"), cluster.members())
+        self.assertTrue(cluster.heartbeat("c", "offline"))
+        self.assertTrue(cluster.refresh(now=50))
+        self.assertEqual(("a",), cluster.members())
+        self.assertFalse(cluster.refresh(now=60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+""" Tests for convergence latency """
+import unittest
+
+from pcfmqtt import convergence
+from pcfmqtt.convergence import Convergence
+
+
+class TestConvergence(unittest.TestCase):
+    """ Test Convergence class """
+
+    def test_initial_delay_until_learned(self):
+        learned = Convergence()
+        self.assertEqual(convergence.INITIAL_DELAY, learned.first_delay("model"))
+        learned.observe("model", 0, 2)
+        self.assertEqual(1, learned.latency("model"))
+        self.assertEqual(1.25, learned.first_delay("model"))
+        self.assertEqual(convergence.INITIAL_DELAY, learned.first_delay("other"))
+
+    def test_latency_moves_towards_observations(self):
+        learned = Convergence()
+        learned.observe("model", 2, 2)
+        learned.observe("model", 12, 12)
+        self.assertAlmostEqual(5, learned.latency("model"))
+
+    def test_first_delay_bounded(self):
+        learned = Convergence()
+        learned.observe("fast", 0, 0)
+        learned.observe("slow", 100, 100)
+        self.assertEqual(convergence.MIN_DELAY, learned.first_delay("fast"))
+        self.assertEqual(convergence.MAX_DELAY, learned.first_delay("slow"))
+
+    def test_backoff_doubles(self):
+        self.assertEqual([2, 4, 8], [convergence.backoff(attempt) for attempt in (1, 2, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 """ Tests for Device """
+import time
 import unittest
 from unittest import mock
+from pcomfortcloud import constants
+from pcomfortcloud.exceptions import Error, ResponseError
+from pcfmqtt.convergence import Convergence
 from pcfmqtt.device import Device
 
 raw_data = {"name": "name", "group": "group", "model": "model", "id": "id"}
@@ -62,6 +66,135 @@ class TestDevice(unittest.TestCase):
         device.update_state(session, 0)
         self.assertGreater(device.get_update_epoch(), value)
 
+    def test_changed_fields_reported(self):
+        device = Device(raw_data)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperature": 20, "temperatureInside": 19}}
+        device.pop_changed()
+        device.update_state(session, 0)
+        self.assertEqual({"temperature", "temperature_inside"}, device.pop_changed())
+        device.update_state(session, 0)
+        self.assertEqual(set(), device.pop_changed())
+        session.set_device.return_value = True
+        device.command(session, "fan_cmd", "high")
+        self.assertEqual({"fan_speed"}, device.pop_changed())
+
+    def test_failed_refresh_backs_off(self):
+        device = Device(raw_data)
+        session = mock.Mock()
+        session.get_device.side_effect = ResponseError("Bad gateway")
+        for delay in (5, 10, 20):
+            device._target_refresh = 0
+            with self.assertRaises(ResponseError):
+                device.update_state(session, 60)
+            self.assertAlmostEqual(time.time() + delay, device.get_refresh_time(), delta=1)
+        session.get_device.side_effect = None
+        session.get_device.return_value = {"parameters": {"temperature": 20}}
+        device._target_refresh = 0
+        device.update_state(session, 60)
+        self.assertEqual(0, device._poll_failures)
+
+    def test_unlisted_device(self):
+        """ Session that has not listed the device fails the refresh and queues the update """
+        device = Device(raw_data)
+        session = mock.Mock()
+        session.get_device.return_value = None
+        with self.assertRaises(Error):
+            device.update_state(session, 60)
+        session.set_device.return_value = False
+        self.assertTrue(device.command(session, "temp_cmd", "22"))
+        self.assertIsNotNone(device._retries.get(device.get_id()))
+
+    def test_commands_coalesced_into_single_update(self):
+        """ Commands within the window are sent as one update once it has passed """
+        device = Device(raw_data, coalesce_window=0.05)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperature": 20}}
+        device.update_state(session, 60)
+        device.command(session, "temp_cmd", "21")
+        device.command(session, "temp_cmd", "22")
+        self.assertFalse(device.flush_pending(session))
+        session.set_device.assert_not_called()
+        self.assertGreater(device.get_refresh_time(), time.time())
+
+        time.sleep(0.06)
+        self.assertTrue(device.needs_refresh())
+        self.assertTrue(device.update_state(session, 60))
+        session.set_device.assert_called_once()
+        self.assertEqual(22, session.set_device.call_args.kwargs["temperature"])
+
+    def test_command_compared_to_pending_update(self):
+        """ Command undoing a pending one is not skipped as already done """
+        device = Device(raw_data, coalesce_window=0.05)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"power": constants.Power.On}}
+        device.update_state(session, 60)
+        self.assertTrue(device.command(session, "power_cmd", "off"))
+        self.assertTrue(device.command(session, "power_cmd", "on"))
+        self.assertFalse(device.command(session, "power_cmd", "on"))
+        time.sleep(0.06)
+        device.update_state(session, 60)
+        self.assertEqual(constants.Power.On, session.set_device.call_args.kwargs["power"])
+
+    def test_update_verified_until_cloud_converges(self):
+        """ Polled state lagging behind the update does not revert the settings """
+        learned = Convergence()
+        device = Device(raw_data, convergence=learned)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperature": 20, "temperatureInside": 19}}
+        device.update_state(session, 60)
+        session.set_device.return_value = True
+        device.command(session, "temp_cmd", "22")
+        self.assertAlmostEqual(time.time() + 5, device.get_refresh_time(), delta=1)
+
+        session.get_device.return_value = {"parameters": {"temperature": 20, "temperatureInside": 21}}
+        device._target_refresh = 0
+        device.pop_changed()
+        device.update_state(session, 60)
+        self.assertEqual(22, device.get_target_temperature())
+        self.assertEqual({"temperature_inside"}, device.pop_changed())
+        self.assertAlmostEqual(time.time() + 2, device.get_refresh_time(), delta=1)
+
+        session.get_device.return_value = {"parameters": {"temperature": 22, "temperatureInside": 21}}
+        device._target_refresh = 0
+        device.update_state(session, 60)
+        self.assertEqual(22, device.get_target_temperature())
+        self.assertIsNotNone(learned.latency("model"))
+        self.assertAlmostEqual(time.time() + 60, device.get_refresh_time(), delta=1)
+
+        # Verified update is not held back anymore
+        session.get_device.return_value = {"parameters": {"temperature": 18, "temperatureInside": 21}}
+        device._target_refresh = 0
+        device.update_state(session, 60)
+        self.assertEqual(18, device.get_target_temperature())
+
+    def test_optimistic_command_reported_before_update(self):
+        device = Device(raw_data, optimistic=True)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperature": 20}}
+        device.update_state(session, 60)
+        device.pop_changed()
+        self.assertTrue(device.command(session, "temp_cmd", "22"))
+        session.set_device.assert_not_called()
+        self.assertEqual(22, device.get_target_temperature())
+        self.assertEqual({"temperature"}, device.pop_changed())
+        self.assertTrue(device.needs_refresh())
+
+        session.set_device.return_value = True
+        self.assertTrue(device.update_state(session, 60))
+        session.set_device.assert_called_once()
+        self.assertEqual(22, device.get_target_temperature())
+
+    def test_optimistic_command_reverted_on_failure(self):
+        device = Device(raw_data, optimistic=True)
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperature": 20}}
+        device.update_state(session, 60)
+        device.command(session, "temp_cmd", "22")
+        session.set_device.return_value = False
+        self.assertTrue(device.update_state(session, 60))
+        self.assertEqual(20, device.get_target_temperature())
+
 
 if __name__ == '__main__':
     unittest.main()
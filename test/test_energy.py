@@ -0,0 +1,79 @@
+""" Tests for the energy history collection """
+import datetime
+import os
+import tempfile
+import unittest
+from pcfmqtt import energy
+from pcfmqtt.energy import EnergyMeter
+
+
+def _epoch(day: int, hour: int, minute: int = 0) -> float:
+    return datetime.datetime(2024, 3, day, hour, minute).timestamp()
+
+
+def _buckets(hours: int, consumption: float = 0.5):
+    return [{"dataNumber": hour, "consumption": consumption if hour < hours else -255} for hour in range(24)]
+
+
+class TestEnergyMeter(unittest.TestCase):
+    """ Test the cursor and the cache of the hourly buckets """
+
+    def test_open_hours_are_merged(self):
+        meter = EnergyMeter()
+        now = _epoch(10, 12, 10)
+        self.assertEqual("20240310", meter.next_date(now))
+        meter.merge("20240310", _buckets(13, 0.5), now)
+        self.assertAlmostEqual(6.5, meter.total())
+        # Closed hours are kept from the cache even if the cloud reports them differently later
+        meter.merge("20240310", _buckets(14, 1.0), _epoch(10, 13, 10))
+        self.assertAlmostEqual(11 * 0.5 + 3 * 1.0, meter.total())
+
+    def test_closed_day_moves_cursor(self):
+        meter = EnergyMeter()
+        meter.next_date(_epoch(10, 23))
+        meter.merge("20240310", _buckets(24, 0.5), _epoch(11, 1))
+        self.assertEqual("20240311", meter.next_date(_epoch(11, 1)))
+        self.assertFalse(meter.behind(_epoch(11, 1)))
+        self.assertAlmostEqual(12, meter.total())
+        # Response for another day is ignored
+        meter.merge("20240310", _buckets(24, 0.5), _epoch(11, 1))
+        self.assertAlmostEqual(12, meter.total())
+
+    def test_missed_days_are_caught_up(self):
+        meter = EnergyMeter(day="20240301")
+        now = _epoch(20, 12)
+        self.assertTrue(meter.behind(now))
+        self.assertEqual("20240313", meter.next_date(now))
+
+    def test_total_never_decreases(self):
+        meter = EnergyMeter()
+        now = _epoch(10, 12, 10)
+        meter.next_date(now)
+        meter.merge("20240310", _buckets(13, 0.5), now)
+        meter.merge("20240310", _buckets(13, 0.1), now)
+        self.assertAlmostEqual(6.5, meter.total())
+
+    def test_round_trip(self):
+        meter = EnergyMeter()
+        now = _epoch(10, 12, 10)
+        meter.next_date(now)
+        meter.merge("20240310", _buckets(13, 0.5), now)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "energy.json")
+            energy.save(path, {"device": meter})
+            loaded = energy.load(path)["device"]
+            self.assertAlmostEqual(meter.total(), loaded.total())
+            self.assertEqual(meter.to_dict(), loaded.to_dict())
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{")
+            self.assertEqual({}, energy.load(path))
+
+    def test_stagger(self):
+        fractions = [energy.stagger(f"device{i}") for i in range(100)]
+        self.assertTrue(all(0 <= fraction < 1 for fraction in fractions))
+        self.assertEqual(fractions[0], energy.stagger("device0"))
+        self.assertGreater(len({int(fraction * 10) for fraction in fractions}), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
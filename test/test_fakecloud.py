@@ -0,0 +1,80 @@
+""" Tests for the fake Comfort Cloud server """
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from pcomfortcloud import constants
+from pcomfortcloud.authentication import Authentication
+from pcomfortcloud.exceptions import ResponseError
+from pcomfortcloud.session import Session
+from benchmarks.fakecloud import FakeCloud, start_server
+from pcfmqtt import tokens
+
+
+class TestFakeCloud(unittest.TestCase):
+    """ Drive the fake cloud with the real `pcomfortcloud` session """
+
+    def setUp(self):
+        self.cloud = FakeCloud(devices=3)
+        self.server = start_server(self.cloud, 0, "127.0.0.1")
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmp = tempfile.TemporaryDirectory()
+        for patch in (mock.patch.object(constants, "BASE_PATH_AUTH", url),
+                      mock.patch.object(constants, "BASE_PATH_ACC", url),
+                      mock.patch.object(Authentication, "_update_app_version")):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def _session(self) -> Session:
+        session = Session("user", "pass", tokenFileName=os.path.join(self.tmp.name, "token.json"))
+        session.login()
+        return session
+
+    def test_set_device_changes_state(self):
+        session = self._session()
+        devices = session.get_devices()
+        self.assertEqual(3, len(devices))
+        self.assertTrue(session.set_device(devices[0]["id"], temperature=24.5, mode=constants.OperationMode.Cool))
+        params = session.get_device(devices[0]["id"])["parameters"]
+        self.assertEqual(24.5, params["temperature"])
+        self.assertEqual(constants.OperationMode.Cool, params["mode"])
+        self.assertEqual(21.0, session.get_device(devices[1]["id"])["parameters"]["temperature"])
+
+    def test_history(self):
+        session = self._session()
+        device = session.get_devices()[0]
+        yesterday = time.strftime("%Y%m%d", time.localtime(time.time() - 24 * 60 * 60))
+        history = session.history(device["id"], "Day", yesterday)["parameters"]
+        self.assertEqual(24, len(history["historyDataList"]))
+        self.assertAlmostEqual(24 * 0.2, history["energyConsumption"])
+
+    def test_revoked_token_is_rejected(self):
+        session = self._session()
+        self.cloud.expire_tokens()
+        with self.assertRaises(ResponseError) as e:
+            session.get_devices()
+        self.assertTrue(tokens.is_token_rejected(e.exception))
+
+    def test_expired_token_is_refreshed(self):
+        self.cloud = FakeCloud(devices=1, token_ttl=1)
+        self.server.RequestHandlerClass.cloud = self.cloud
+        session = self._session()
+        time.sleep(2.1)
+        session.get_devices()
+        self.assertEqual(2, self.cloud.requests["token"])
+
+    def test_burst(self):
+        cloud = FakeCloud(devices=1, burst_every=10, burst_length=10)
+        status, headers, _ = cloud.handle("GET", "/device/group", {}, {})
+        self.assertEqual(429, status)
+        self.assertEqual("10", headers["Retry-After"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+""" Tests for bulk group state retrieval """
+import hashlib
+import unittest
+from unittest import mock
+from pcomfortcloud import constants
+from pcomfortcloud.apiclient import ApiClient
+from pcfmqtt.groups import get_group_states
+
+
+class TestGroups(unittest.TestCase):
+    """ Test group listing parsing """
+
+    def _session(self, devices):
+        session = mock.Mock()
+        session._api = ApiClient(session)
+        session.execute_get.return_value = {"groupList": [{"groupName": "home", "deviceList": devices}]}
+        return session
+
+    def test_states_from_group_listing(self):
+        """ Devices with the complete parameters are parsed, devices without are left out """
+        parameters = {"operate": 1, "operationMode": 2, "temperatureSet": 21.5, "insideTemperature": 19,
+                      "outTemperature": 5, "fanSpeed": 0, "airSwingLR": 2, "airSwingUD": 2, "ecoMode": 0,
+                      "nanoe": 2}
+        session = self._session([
+            {"deviceHashGuid": "hash", "parameters": parameters},
+            {"deviceGuid": "guid", "parameters": dict(parameters, operate=0)},
+            {"deviceHashGuid": "missing"},
+        ])
+        states = get_group_states(session)
+        self.assertEqual(1, session.execute_get.call_count)
+        self.assertEqual(21.5, states["hash"]["temperature"])
+        self.assertEqual(constants.Power.On, states["hash"]["power"])
+        self.assertEqual(constants.OperationMode.Cool, states["hash"]["mode"])
+        guid_id = hashlib.md5("guid".encode("utf-8")).hexdigest()
+        self.assertEqual(constants.Power.Off, states[guid_id]["power"])
+        self.assertNotIn("missing", states)
+
+    def test_partial_parameters_left_out(self):
+        """ Partial state would reset the missing settings, those devices are requested separately """
+        session = self._session([{"deviceHashGuid": "hash", "parameters": {"temperatureSet": 21.5, "operate": 1}}])
+        self.assertEqual({}, get_group_states(session))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+""" Tests for instrumentation hooks """
+import unittest
+from unittest import mock
+from paho.mqtt.client import Client
+from pcfmqtt import hooks
+from pcfmqtt.mqtt import Mqtt
+from pcfmqtt.device import Device
+
+raw_data = {"name": "name", "group": "group", "model": "model", "id": "id"}
+
+
+class TestHooks(unittest.TestCase):
+    """ Test hook registration and spans """
+
+    def setUp(self):
+        self.spans = []
+        self.hook = lambda name, started, duration, attributes: self.spans.append((name, attributes))
+        hooks.register(self.hook)
+
+    def tearDown(self):
+        hooks.unregister(self.hook)
+
+    def test_span_and_traced(self):
+        with hooks.span("block", device="a"):
+            pass
+        hooks.traced("function")(lambda: None)()
+        self.assertEqual([("block", {"device": "a"}), ("function", {})], self.spans)
+
+    def test_device_update_is_traced(self):
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {}}
+        Device(raw_data).update_state(session, 60)
+        self.assertIn(("device.update_state", {"device": "pcc_name_ac"}), self.spans)
+
+    def test_publish_is_traced_with_topic(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", mock.create_autospec(Client))
+        mqtt.join_cluster("cluster", "a", mock.Mock())
+        mqtt.send_heartbeat()
+        self.assertIn(("mqtt.publish", {"topic": "pcfmqtt/cluster/members/a", "kind": "cluster"}), self.spans)
+
+    def test_cycle_summary_resets_on_flush(self):
+        summary = hooks.CycleSummary()
+        summary("phase", 0, 0.5, {})
+        with self.assertLogs("pcfmqtt.hooks", "INFO") as logs:
+            summary.flush()
+        self.assertIn("phase 1x 500.0 ms", logs.output[0])
+        self.assertEqual({}, summary._totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+""" Tests for metrics """
+import unittest
+import urllib.request
+from unittest import mock
+from pcomfortcloud.exceptions import ResponseError
+from pcfmqtt import metrics
+from pcfmqtt.ratelimit import CircuitBreaker, GuardedSession, TokenBucket
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test metric types and export """
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram("test_seconds", "Test", ["call"], buckets=(1, 5))
+        histogram.observe(0.5, "a")
+        histogram.observe(3, "a")
+        text = histogram.render()
+        self.assertIn('test_seconds_bucket{call="a",le="1.0"} 1', text)
+        self.assertIn('test_seconds_bucket{call="a",le="5.0"} 2', text)
+        self.assertIn('test_seconds_bucket{call="a",le="+Inf"} 2', text)
+        self.assertIn('test_seconds_sum{call="a"} 3.5', text)
+        metrics.REGISTRY.remove(histogram)
+
+    def test_guarded_session_records_latency_and_errors(self):
+        session = mock.Mock()
+        session.get_device.side_effect = ResponseError("Bad gateway")
+        guarded = GuardedSession(session, TokenBucket(60), CircuitBreaker())
+        calls = metrics.CLOUD_REQUEST_SECONDS.count("get_device")
+        errors = metrics.ERRORS.get("ResponseError")
+        with self.assertRaises(ResponseError):
+            guarded.get_device("id")
+        self.assertEqual(calls + 1, metrics.CLOUD_REQUEST_SECONDS.count("get_device"))
+        self.assertEqual(errors + 1, metrics.ERRORS.get("ResponseError"))
+
+    def test_endpoint(self):
+        server = metrics.start_server(0, "127.0.0.1")
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                body = response.read().decode("utf-8")
+            self.assertIn("# TYPE pcfmqtt_cloud_request_seconds histogram", body)
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
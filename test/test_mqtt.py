@@ -0,0 +1,174 @@
+""" Tests for Mqtt """
+import unittest
+from unittest import mock
+
+from paho.mqtt.client import Client, MQTTMessageInfo
+from pcomfortcloud import constants
+from pcfmqtt.device import Device
+from pcfmqtt.mqtt import Mqtt
+
+raw_data = {"name": "name", "group": "group", "model": "model", "id": "id"}
+
+
+class TestMqtt(unittest.TestCase):
+    """ Test Mqtt class """
+
+    def setUp(self):
+        self.client_mock = mock.create_autospec(Client)
+        self.mid = 0
+        self.client_mock.return_value.publish.side_effect = self._publish
+        self.device = Device(raw_data)
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        """ Messages are published right away """
+        self.mid += 1
+        client = self.client_mock.return_value
+        client.on_publish(client, None, self.mid)
+        return MQTTMessageInfo(self.mid)
+
+    def test_unchanged_state_is_skipped(self):
+        """ Identical state is published only once within max age """
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock, state_max_age=300)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        self.assertEqual(1, self.client_mock.return_value.publish.call_count)
+
+        self.device.set_target_temperature(25)
+        self.device._state.refresh(self.device._desired_state)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        self.assertEqual(2, self.client_mock.return_value.publish.call_count)
+
+    def test_only_changed_attributes_are_published(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock, attribute_topics=True)
+        publish = self.client_mock.return_value.publish
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        self.assertEqual(10, publish.call_count)
+        publish.reset_mock()
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        publish.assert_not_called()
+
+        self.device.set_power(constants.Power.On)
+        self.device._changed.update(self.device._state.refresh(self.device._desired_state))
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        topic = f"homeassistant/climate/{self.device.get_id()}"
+        self.assertEqual({(f"{topic}/power", "on"), (f"{topic}/mode", "auto")},
+                         {c.args[:2] for c in publish.call_args_list})
+
+    def test_state_published_always_without_max_age(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock, state_max_age=0, retain_state=True)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        self.assertEqual(2, self.client_mock.return_value.publish.call_count)
+        self.assertTrue(self.client_mock.return_value.publish.call_args.kwargs["retain"])
+
+    def test_hass_online_resets_state_cache(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        mqtt._handle_hass_status("online")
+        mqtt.send_state_event(self.device)
+        mqtt.flush(1)
+        self.assertEqual(2, self.client_mock.return_value.publish.call_count)
+
+    def test_discovery_sent_only_when_changed(self):
+        """ Unchanged discovery configurations are not resent unless forced """
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        publish = self.client_mock.return_value.publish
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        sent = publish.call_count
+        self.assertGreater(sent, 0)
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        self.assertEqual(sent, publish.call_count)
+        mqtt.send_discovery_events([self.device], force=True)
+        mqtt.flush(1)
+        self.assertEqual(2 * sent, publish.call_count)
+
+    def test_undelivered_discovery_sent_again(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        publish = self.client_mock.return_value.publish
+        publish.side_effect = None
+        publish.return_value = MQTTMessageInfo(1)
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        sent = publish.call_count
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        self.assertEqual(2 * sent, publish.call_count)
+
+    def test_discovery_regenerated_on_metadata_change(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        publish = self.client_mock.return_value.publish
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        sent = publish.call_count
+        self.device._model = "other"
+        mqtt.send_discovery_events([self.device])
+        mqtt.flush(1)
+        self.assertEqual(2 * sent, publish.call_count)
+
+    def test_forgotten_device_is_unsubscribed(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        client = self.client_mock.return_value
+        mqtt.introduce_device(self.device)
+        client.subscribe.assert_called_once()
+        self.assertEqual(8, len(client.subscribe.call_args.args[0]))
+        mqtt.forget_device(self.device)
+        client.unsubscribe.assert_called_once()
+        self.assertEqual(8, len(client.unsubscribe.call_args.args[0]))
+        client.subscribe.reset_mock()
+        mqtt._on_connect(client, None, 0, 0)
+        client.subscribe.assert_called_once_with("homeassistant/status")
+
+    def test_subscriptions_are_batched(self):
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        client = self.client_mock.return_value
+        devices = [Device({"name": f"name{i}", "group": "group", "model": "model", "id": f"id{i}"})
+                   for i in range(30)]
+        mqtt.introduce_devices(devices)
+        self.assertEqual(3, client.subscribe.call_count)
+        self.assertEqual(240, sum(len(c.args[0]) for c in client.subscribe.call_args_list))
+        # Already subscribed topics are not subscribed again
+        mqtt.introduce_device(devices[0])
+        self.assertEqual(3, client.subscribe.call_count)
+
+    def test_messages_are_routed(self):
+        message_callback = mock.Mock()
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        mqtt.connect(message_callback)
+        client = self.client_mock.return_value
+        mqtt.introduce_device(self.device)
+        topic = f"homeassistant/climate/{self.device.get_id()}"
+        for suffix in ["temp_cmd", "state", "unknown_cmd"]:
+            mqtt._on_message(client, None, mock.Mock(topic=f"{topic}/{suffix}", payload=b"21"))
+        mqtt._on_message(client, None, mock.Mock(topic="homeassistant/climate/unknown/temp_cmd", payload=b"21"))
+        message_callback.assert_called_once_with(self.device.get_id(), "temp_cmd", "21")
+        mqtt.forget_device(self.device)
+        mqtt._on_message(client, None, mock.Mock(topic=f"{topic}/temp_cmd", payload=b"21"))
+        message_callback.assert_called_once()
+
+    def test_cluster_heartbeats(self):
+        callback = mock.Mock()
+        message_callback = mock.Mock()
+        mqtt = Mqtt("localhost", 1883, "homeassistant", self.client_mock)
+        mqtt.join_cluster("cluster", "a", callback)
+        mqtt.connect(message_callback)
+        client = self.client_mock.return_value
+        client.will_set.assert_called_once_with("pcfmqtt/cluster/members/a", "offline")
+        message = mock.Mock(topic="pcfmqtt/cluster/members/b", payload=b"online")
+        mqtt._on_message(client, None, message)
+        callback.assert_called_once_with("b", "online")
+        message_callback.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
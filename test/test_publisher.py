@@ -0,0 +1,147 @@
+""" Tests for the MQTT publish queue """
+import unittest
+from unittest import mock
+
+from paho.mqtt.client import Client, MQTTMessageInfo, MQTT_ERR_NO_CONN
+from pcfmqtt import publisher as publisher_module
+from pcfmqtt.publisher import Publisher
+
+
+class TestPublisher(unittest.TestCase):
+    """ Test queueing, in-flight window and drop policies without the thread """
+
+    def setUp(self):
+        self.client = mock.create_autospec(Client, instance=True)
+        self.mid = 0
+        self.client.publish.side_effect = self._publish
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        self.mid += 1
+        return MQTTMessageInfo(self.mid)
+
+    def _publisher(self, **kwargs) -> Publisher:
+        publisher = Publisher(threaded=False, **kwargs)
+        publisher.attach(self.client, mock.Mock())
+        return publisher
+
+    def test_qos_per_type(self):
+        publisher = self._publisher(qos={"discovery": 1})
+        publisher.submit("config", "{}", "discovery", retain=True)
+        publisher.submit("state", "{}", "state")
+        self.client.publish.assert_has_calls([mock.call("config", "{}", qos=1, retain=True),
+                                              mock.call("state", "{}", qos=0, retain=False)])
+
+    def test_window_is_released_on_publish(self):
+        publisher = self._publisher(max_inflight=2)
+        for i in range(4):
+            publisher.submit(f"topic{i}", "payload", "state")
+        self.assertEqual(2, self.client.publish.call_count)
+        self.assertEqual(2, publisher.inflight())
+        publisher.on_publish(self.client, None, 1)
+        self.assertEqual(3, self.client.publish.call_count)
+        # Published before the client returned the mid
+        publisher.on_publish(self.client, None, 4)
+        publisher.on_publish(self.client, None, 2)
+        self.assertEqual(4, self.client.publish.call_count)
+        self.assertEqual(1, publisher.inflight())
+
+    def test_queued_message_replaced_by_newer(self):
+        publisher = self._publisher(max_inflight=1)
+        publisher.submit("busy", "payload", "state")
+        publisher.submit("topic", "old", "state")
+        publisher.submit("topic", "new", "state")
+        self.assertEqual(1, publisher.queued())
+        publisher.on_publish(self.client, None, 1)
+        self.client.publish.assert_called_with("topic", "new", qos=0, retain=False)
+
+    def test_drop_policies(self):
+        self.client.is_connected.return_value = False
+        oldest = self._publisher(max_queue=2, drop_policy="oldest")
+        newest = self._publisher(max_queue=2, drop_policy="newest")
+        for publisher in (oldest, newest):
+            self.assertTrue(publisher.submit("a", "1", "state"))
+            self.assertTrue(publisher.submit("b", "2", "state"))
+        self.assertTrue(oldest.submit("c", "3", "state"))
+        self.assertFalse(newest.submit("c", "3", "state"))
+        self.client.is_connected.return_value = True
+        self.client.publish.reset_mock()
+        oldest.wake()
+        self.assertEqual(["b", "c"], [c.args[0] for c in self.client.publish.call_args_list])
+        self.client.publish.reset_mock()
+        newest.wake()
+        self.assertEqual(["a", "b"], [c.args[0] for c in self.client.publish.call_args_list])
+
+    def test_discovery_and_cluster_never_dropped(self):
+        self.client.is_connected.return_value = False
+        publisher = self._publisher(max_queue=2, drop_policy="oldest")
+        for i in range(3):
+            self.assertTrue(publisher.submit(f"config{i}", "{}", "discovery"))
+            self.assertTrue(publisher.submit(f"state{i}", "{}", "state"))
+        self.assertTrue(publisher.submit("members/a", "online", "cluster"))
+        self.assertEqual(6, publisher.queued())
+        self.client.is_connected.return_value = True
+        publisher.wake()
+        self.assertEqual(["config0", "config1", "state1", "config2", "state2", "members/a"],
+                         [c.args[0] for c in self.client.publish.call_args_list])
+
+    def test_replies_to_same_topic_all_delivered(self):
+        self.client.is_connected.return_value = False
+        publisher = self._publisher(max_queue=1, drop_policy="block")
+        self.assertTrue(publisher.submit("state", "{}", "state"))
+        for i in range(3):
+            self.assertTrue(publisher.submit("reply", str(i), "history"))
+        self.assertEqual(4, publisher.queued())
+        self.client.is_connected.return_value = True
+        publisher.wake()
+        self.assertEqual(["{}", "0", "1", "2"], [c.args[1] for c in self.client.publish.call_args_list])
+
+    def test_delivery_is_reported(self):
+        delivered = mock.Mock()
+        publisher = Publisher(threaded=False)
+        publisher.attach(self.client, mock.Mock(), delivered)
+        publisher.submit("config", "{}", "discovery")
+        delivered.assert_not_called()
+        publisher.on_publish(self.client, None, 1)
+        self.assertEqual("config", delivered.call_args.args[0].topic)
+
+    def test_failed_publish_is_retried(self):
+        publisher = self._publisher()
+        info = MQTTMessageInfo(1)
+        info.rc = MQTT_ERR_NO_CONN
+        self.client.publish.side_effect = [info]
+        publisher.submit("topic", "payload", "state")
+        self.assertEqual(1, publisher.queued())
+        self.client.publish.side_effect = self._publish
+        publisher.wake()
+        self.assertEqual(0, publisher.queued())
+
+    def test_thread_sends_in_background(self):
+        publisher = Publisher()
+        publisher.attach(self.client, mock.Mock())
+        publisher.submit("topic", "payload", "state")
+        self.assertTrue(publisher.flush(1))
+        self.client.publish.assert_called_once_with("topic", "payload", qos=0, retain=False)
+
+    def test_failed_recovery_is_retried(self):
+        """ Publish thread survives the broker being down while recovering """
+        results = [OSError("Broken pipe")]
+
+        def publish(topic, payload, qos=0, retain=False):
+            if results:
+                raise results.pop()
+            return self._publish(topic, payload, qos, retain)
+        self.client.publish.side_effect = publish
+        on_error = mock.Mock(side_effect=[ConnectionRefusedError(), None])
+        publisher = Publisher()
+        publisher.attach(self.client, on_error)
+        with mock.patch.object(publisher_module, "RECOVER_BACKOFF", 0.01):
+            publisher.submit("topic", "payload", "state")
+            self.assertTrue(publisher.flush(5))
+        self.assertEqual(2, on_error.call_count)
+        publisher.submit("other", "payload", "state")
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual(["topic", "other"], [c.args[0] for c in self.client.publish.call_args_list[1:]])
+
+
+if __name__ == '__main__':
+    unittest.main()
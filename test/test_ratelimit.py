@@ -0,0 +1,90 @@
+""" Tests for rate limiting and circuit breaking """
+import unittest
+from unittest import mock
+from pcomfortcloud.exceptions import ResponseError
+from pcfmqtt.ratelimit import CircuitBreaker, CircuitOpenError, GuardedSession, RateLimitedError, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    """ Test TokenBucket """
+
+    def test_reserve_is_kept(self):
+        bucket = TokenBucket(3)
+        self.assertTrue(bucket.try_acquire(reserve=1))
+        self.assertTrue(bucket.try_acquire(reserve=1))
+        self.assertFalse(bucket.try_acquire(reserve=1))
+        self.assertTrue(bucket.try_acquire())
+        self.assertGreater(bucket.available_at(), 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """ Test CircuitBreaker """
+
+    def test_opens_after_threshold_and_probes(self):
+        breaker = CircuitBreaker(threshold=2, base_delay=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        # Backoff is over immediately, single probe is allowed
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(0, breaker.retry_at())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(threshold=1, base_delay=100)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_at(), 0)
+
+
+class TestGuardedSession(unittest.TestCase):
+    """ Test GuardedSession """
+
+    def test_failures_open_circuit(self):
+        session = mock.Mock()
+        session.get_device.side_effect = ResponseError("Bad gateway")
+        guarded = GuardedSession(session, TokenBucket(60), CircuitBreaker(threshold=2, base_delay=100))
+        for device_id in ("a", "b"):
+            with self.assertRaises(ResponseError):
+                guarded.get_device(device_id)
+        with self.assertRaises(CircuitOpenError):
+            guarded.get_device("c")
+        self.assertEqual(2, session.get_device.call_count)
+
+    def test_single_failing_device_does_not_open_circuit(self):
+        session = mock.Mock()
+        session.get_device.side_effect = ResponseError("Bad gateway")
+        guarded = GuardedSession(session, TokenBucket(60), CircuitBreaker(threshold=2, base_delay=100))
+        for _ in range(3):
+            with self.assertRaises(ResponseError):
+                guarded.get_device("id")
+        guarded.get_devices()
+        session.get_devices.assert_called_once()
+
+    def test_probe_released_on_unexpected_error(self):
+        """ Probe failing with other than cloud error opens the circuit again instead of blocking for good """
+        session = mock.Mock()
+        breaker = CircuitBreaker(threshold=1, base_delay=0)
+        breaker.record_failure()
+        guarded = GuardedSession(session, TokenBucket(60), breaker)
+        session.get_device.side_effect = ConnectionError("Connection reset")
+        with self.assertRaises(ConnectionError):
+            guarded.get_device("id")
+        session.get_device.side_effect = None
+        guarded.get_device("id")
+        self.assertEqual(0, breaker.retry_at())
+
+    def test_polls_do_not_use_reserve(self):
+        session = mock.Mock()
+        guarded = GuardedSession(session, TokenBucket(2), CircuitBreaker(), reserve=1)
+        guarded.get_device("id")
+        with self.assertRaises(RateLimitedError):
+            guarded.get_device("id")
+        guarded.set_device("id", temperature=20)
+        session.set_device.assert_called_once_with("id", temperature=20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+""" Tests for the retry queue of failed updates """
+import os
+import tempfile
+import unittest
+from unittest import mock
+from pcomfortcloud import constants
+from pcfmqtt import retry
+from pcfmqtt.device import Device
+from pcfmqtt.retry import RetryQueue
+
+raw_data = {"name": "name", "group": "group", "model": "model", "id": "id"}
+
+
+class TestRetryQueue(unittest.TestCase):
+    """ Test RetryQueue class """
+
+    def test_latest_state_kept_in_place(self):
+        queue = RetryQueue()
+        queue.put("a", {"temperature": 20}, 100)
+        queue.put("b", {"temperature": 21}, 101)
+        queue.put("a", {"temperature": 22}, 102)
+        self.assertEqual(2, queue.depth())
+        self.assertEqual({"temperature": 22}, queue.get("a").params)
+        self.assertEqual(100, queue.get("a").queued)
+        # Oldest is retried first, the rest after it
+        self.assertLess(queue.retry_at("a"), queue.retry_at("b"))
+
+    def test_backoff_grows_until_done(self):
+        queue = RetryQueue()
+        self.assertEqual(105, queue.put("a", {}, 100))
+        self.assertEqual(110, queue.put("a", {}, 100))
+        for _ in range(10):
+            queue.put("a", {}, 100)
+        self.assertEqual(100 + retry.MAX_BACKOFF, queue.retry_at("a"))
+        queue.put("b", {}, 100)
+        queue.done("a")
+        self.assertIsNone(queue.retry_at("a"))
+        self.assertEqual(0, queue.retry_at("b"))
+
+    def test_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "retry.json")
+            queue = RetryQueue(path)
+            queue.put("b", {"power": constants.Power.On}, 100)
+            queue.put("a", {"power": constants.Power.Off}, 101)
+            restored = RetryQueue(path)
+            self.assertEqual(2, restored.depth())
+            self.assertEqual(constants.Power.On, restored.get("b").params["power"])
+            self.assertEqual(0, restored.retry_at("b"))
+            queue.done("b")
+            self.assertEqual(1, RetryQueue(path).depth())
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{broken")
+            self.assertEqual(0, RetryQueue(path).depth())
+
+    def test_failed_update_retried_after_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "retry.json")
+            device = Device(raw_data, retries=RetryQueue(path))
+            session = mock.Mock()
+            session.get_device.return_value = {"parameters": {"temperature": 20}}
+            device.update_state(session, 60)
+            session.set_device.side_effect = Exception("Cloud unavailable")
+            device.command(session, "temp_cmd", "22")
+            self.assertFalse(device.needs_refresh())
+            session.set_device.assert_called_once()
+
+            restarted = Device(raw_data, retries=RetryQueue(path))
+            restarted.restore_state({"temperature": 20}, 0)
+            self.assertTrue(restarted.needs_refresh())
+            session.set_device.reset_mock(side_effect=True)
+            session.set_device.return_value = True
+            restarted.update_state(session, 60)
+            self.assertEqual(22, session.set_device.call_args.kwargs["temperature"])
+            self.assertEqual(0, RetryQueue(path).depth())
+
+
+if __name__ == '__main__':
+    unittest.main()
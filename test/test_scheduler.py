@@ -0,0 +1,34 @@
+""" Tests for RefreshScheduler """
+import unittest
+from pcfmqtt.scheduler import RefreshScheduler
+
+
+class TestRefreshScheduler(unittest.TestCase):
+    """ Test RefreshScheduler """
+
+    def test_pop_due_in_deadline_order(self):
+        scheduler = RefreshScheduler()
+        scheduler.schedule("b", 20)
+        scheduler.schedule("a", 10)
+        scheduler.schedule("c", 30)
+        self.assertEqual(["a", "b"], scheduler.pop_due(25))
+        self.assertEqual(30, scheduler.next_deadline())
+
+    def test_reschedule_replaces_deadline(self):
+        """ Only the latest deadline counts for a key """
+        scheduler = RefreshScheduler()
+        scheduler.schedule("a", 10)
+        scheduler.schedule("a", 50)
+        self.assertEqual([], scheduler.pop_due(20))
+        self.assertEqual(["a"], scheduler.pop_due(50))
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_wait_returns_on_passed_deadline(self):
+        scheduler = RefreshScheduler()
+        scheduler.schedule("a", 0)
+        scheduler.wait(float("inf"))
+        self.assertEqual(["a"], scheduler.pop_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
+import json
+import tempfile
+import time
 import unittest
 from unittest import mock
 
+from pcomfortcloud import constants
+from pcomfortcloud.apiclient import ApiClient
+from pcomfortcloud.exceptions import ResponseError
 from pcomfortcloud.session import Session
+from pcfmqtt.accounts import Account
+from pcfmqtt.cluster import Cluster
+from pcfmqtt.device import Device
 from pcfmqtt.mqtt import Mqtt
 from pcfmqtt.service import Service
 
@@ -13,3 +22,221 @@ class TestService(unittest.TestCase):
         self.session_mock = mock.create_autospec(Session)
         Service("username", "password", self.mqtt_mock, 60, self.session_mock)
 
+
+    def test_parallel_polling_sends_state_for_updated_devices(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock, poll_workers=4)
+        updated = self._device_mock(service, "updated", True)
+        self._device_mock(service, "idle", False)
+        service._update_devices()
+        mqtt_mock.send_state_event.assert_called_once_with(updated)
+
+    def test_only_due_devices_are_updated(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock)
+        due = self._device_mock(service, "due", True)
+        later = self._device_mock(service, "later", True, time.time() + 60)
+        service._update_devices()
+        due.update_state.assert_called_once()
+        later.update_state.assert_not_called()
+
+    def test_command_is_queued_to_device(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock)
+        device = self._device_mock(service, "device", False)
+        device.command.return_value = True
+        service.handle_message("device", "temp_cmd", "21")
+        service._actors.submit("device", lambda: None).result(1)
+        device.command.assert_called_once_with(service._accounts[0].session, "temp_cmd", "21", mock.ANY)
+        mqtt_mock.send_state_event.assert_called_once_with(device)
+
+    def test_session_kept_on_transient_error(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        with tempfile.TemporaryDirectory() as tmp:
+            service = Service("username", "password", mqtt_mock, 60, session_mock, token_dir=tmp)
+            session_mock.assert_called_once_with("username", "password", tokenFileName=mock.ANY)
+            account = service._accounts[0]
+            session = account.session
+            account.handle_session_error(ResponseError("Expected status code 200, received: 502"))
+            self.assertIs(session, account.session)
+            account.handle_session_error(ResponseError("Expected status code 200, received: 401"))
+            self.assertIsNot(session, account.session)
+
+    def test_known_devices_kept_on_connect(self):
+        """ Devices restored from snapshot keep their state and are refreshed in background """
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock)
+        raw = {"name": "name", "group": "group", "model": "model", "id": "id"}
+        restored = Device(raw)
+        restored.restore_state({"temperature": 21}, 0)
+        service._register(service._accounts[0], restored)
+        session_mock.return_value.get_devices.return_value = [raw]
+        self.assertTrue(service.connect_to_cc())
+        self.assertIs(restored, service._devices[restored.get_id()])
+        session_mock.return_value.get_device.assert_not_called()
+        self.assertEqual([restored.get_id()], service._scheduler.pop_due())
+
+    def test_partial_bulk_listing_falls_back_to_device_request(self):
+        """ Settings missing from the group listing are not reset to their defaults """
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        session = session_mock.return_value
+        session._api = ApiClient(session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock, bulk_refresh=True)
+        raw = {"name": "name", "group": "group", "model": "model", "id": "id"}
+        params = {"temperature": 24, "power": constants.Power.On, "mode": constants.OperationMode.Cool,
+                  "fanSpeed": constants.FanSpeed.High}
+        device = Device(raw)
+        device.restore_state(params, 0)
+        service._accounts[0].listed = True
+        service._register(service._accounts[0], device)
+        service._scheduler.schedule(device.get_id(), 0)
+        session.execute_get.return_value = {"groupList": [{"deviceList": [
+            {"deviceHashGuid": "id", "parameters": {"temperatureSet": 24, "operate": 1}}]}]}
+        session.get_device.return_value = {"parameters": dict(params, temperatureInside=21)}
+        service._update_devices()
+        session.get_device.assert_called_once_with("id")
+        self.assertEqual("cool", device.get_mode_str())
+        self.assertEqual("high", device.get_fanmode_str())
+        self.assertEqual(21, device.get_temperature())
+
+    def test_accounts_have_own_sessions_and_namespaced_devices(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        accounts = [Account("user1", "pass1", "home", session_mock), Account("user2", "pass2", "cabin", session_mock)]
+        service = Service("", "", mqtt_mock, 60, session_mock, accounts=accounts)
+        raw = {"name": "Living Room", "group": "group", "model": "model", "id": "id"}
+        session_mock.return_value.get_devices.side_effect = [[raw], [dict(raw, id="id2")]]
+        self.assertTrue(service.connect_to_cc())
+        self.assertEqual(["home_pcc_living_room_ac", "cabin_pcc_living_room_ac"], list(service._devices))
+        self.assertEqual(["home_pcc_living_room_ac"], list(accounts[0].devices))
+        self.assertIsNot(accounts[0].session, accounts[1].session)
+
+    def test_failing_account_does_not_stop_others(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        accounts = [Account("user1", "pass1", "home", session_mock), Account("user2", "pass2", "cabin", session_mock)]
+        service = Service("", "", mqtt_mock, 60, session_mock, accounts=accounts)
+        accounts[0].session = mock.Mock(wraps=accounts[0].session)
+        accounts[0].session.login.side_effect = ResponseError("Expected status code 200, received: 502")
+        session_mock.return_value.get_devices.return_value = [
+            {"name": "name", "group": "group", "model": "model", "id": "id"}]
+        self.assertTrue(service._check_connections())
+        self.assertFalse(accounts[0].listed)
+        self.assertGreater(accounts[0].retry_at, time.time())
+        self.assertTrue(accounts[1].listed)
+        self.assertEqual(["cabin_pcc_name_ac"], list(service._devices))
+
+    def test_devices_of_unlisted_account_not_polled(self):
+        """ Devices wait for their account to be listed again, commands are queued for retry """
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock)
+        raw = {"name": "name", "group": "group", "model": "model", "id": "id"}
+        session_mock.return_value.get_devices.return_value = [raw]
+        session_mock.return_value.get_device.return_value = {"parameters": {"temperature": 20}}
+        self.assertTrue(service.connect_to_cc())
+        device = service._devices["pcc_name_ac"]
+        service._accounts[0].listed = False
+        service._scheduler.schedule(device.get_id(), 0)
+        service._update_devices()
+        session_mock.return_value.get_device.assert_called_once()
+        self.assertIsNone(service._scheduler.next_deadline())
+        session_mock.return_value.set_device.return_value = False
+        service._command(device, "temp_cmd", "22", time.time())
+        self.assertIsNotNone(service._retries.retry_at(device.get_id()))
+        self.assertIsNone(service._scheduler.next_deadline())
+        # Listing the account again schedules the retry
+        self.assertTrue(service.connect_to_cc())
+        self.assertLessEqual(service._scheduler.next_deadline(), service._retries.retry_at(device.get_id()))
+
+    def test_devices_partitioned_in_cluster(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        session_mock.return_value.get_devices.return_value = [
+            {"name": f"name{i}", "group": "group", "model": "model", "id": f"id{i}"} for i in range(20)]
+        cluster = Cluster("cluster", "a")
+        service = Service("username", "password", mqtt_mock, 60, session_mock, cluster=cluster)
+        cluster.heartbeat("b", "online")
+        cluster.refresh()
+        self.assertTrue(service.connect_to_cc())
+        owned = set(service._owned)
+        self.assertTrue(0 < len(owned) < 20)
+        introduced = mqtt_mock.introduce_devices.call_args.args[0]
+        self.assertEqual(owned, {device.get_id() for device in introduced})
+        # Peer going offline hands its devices over
+        service._on_heartbeat("b", "offline")
+        service._rebalance()
+        self.assertEqual(set(service._devices), service._owned)
+        mqtt_mock.forget_device.assert_not_called()
+        introduced = mqtt_mock.introduce_devices.call_args.args[0]
+        self.assertEqual(set(service._devices) - owned, {device.get_id() for device in introduced})
+
+    def test_energy_history_collected(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        session_mock.return_value.history.return_value = {
+            "id": "id", "parameters": {"historyDataList": [{"dataNumber": 0, "consumption": 0.5}]}}
+        service = Service("username", "password", mqtt_mock, 60, session_mock, energy_interval=3600)
+        device = Device({"name": "name", "group": "group", "model": "model", "id": "id"})
+        service._register(service._accounts[0], device)
+        service._take([device])
+        self.assertGreater(service._energy_scheduler.next_deadline(), time.time())
+        service._energy_scheduler.schedule(device.get_id(), 0)
+        service._update_energy()
+        service._actors.submit(device.get_id(), lambda: None).result(5)
+        session_mock.return_value.history.assert_called_once_with("id", "Day", time.strftime("%Y%m%d"), mock.ANY)
+        mqtt_mock.send_energy_event.assert_called_once_with(device, 0.5)
+        self.assertGreater(service._energy_scheduler.next_deadline(), time.time() + 3000)
+
+    def test_missing_energy_history_not_merged(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        session_mock.return_value.history.return_value = None
+        service = Service("username", "password", mqtt_mock, 60, session_mock, energy_interval=3600)
+        device = Device({"name": "name", "group": "group", "model": "model", "id": "id"})
+        service._register(service._accounts[0], device)
+        service._collect_energy(device)
+        mqtt_mock.send_energy_event.assert_not_called()
+        self.assertEqual(0, service._meters[device.get_id()].to_dict()["closed"])
+        self.assertGreater(service._energy_scheduler.next_deadline(), time.time() + 3000)
+
+    def test_history_request_answered(self):
+        mqtt_mock = mock.create_autospec(Mqtt, instance=True)
+        session_mock = mock.create_autospec(Session)
+        service = Service("username", "password", mqtt_mock, 60, session_mock, history=True)
+        mqtt_mock.serve_history.assert_called_once_with(service._on_history_request)
+        device = Device({"name": "name", "group": "group", "model": "model", "id": "id"})
+        service._register(service._accounts[0], device)
+        service._take([device])
+        session = mock.Mock()
+        session.get_device.return_value = {"parameters": {"temperatureInside": 19}}
+        device.update_state(session, 0)
+        service._on_history_request(json.dumps({"id": "1", "device": device.get_id(),
+                                                "metric": "inside_temperature", "reply_to": "reply"}))
+        topic, payload = mqtt_mock.send_history_response.call_args.args
+        self.assertEqual("reply", topic)
+        response = json.loads(payload)
+        self.assertEqual(["1", 19, 1, 0], [response["id"], response["avg"], response["samples"],
+                                           response["resolution"]])
+        service._on_history_request(json.dumps({"device": "unknown"}))
+        topic, payload = mqtt_mock.send_history_response.call_args.args
+        self.assertEqual("pcfmqtt/history/response", topic)
+        self.assertEqual("Unknown device", json.loads(payload)["error"])
+
+    @staticmethod
+    def _device_mock(service, device_id, updated, refresh_time=0):
+        device = mock.Mock()
+        device.get_id.return_value = device_id
+        device.get_refresh_time.return_value = refresh_time
+        device.update_state.return_value = updated
+        service._accounts[0].listed = True
+        service._register(service._accounts[0], device)
+        service._take([device])
+        service._scheduler.schedule(device_id, refresh_time)
+        return device
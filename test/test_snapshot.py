@@ -0,0 +1,45 @@
+""" Tests for device snapshots """
+import os
+import tempfile
+import unittest
+from pcomfortcloud import constants
+from pcfmqtt import snapshot
+from pcfmqtt.device import Device
+
+raw_data = {"name": "name", "group": "group", "model": "model", "id": "id"}
+
+
+class TestSnapshot(unittest.TestCase):
+    """ Test snapshot save and load """
+
+    def test_round_trip(self):
+        device = Device(raw_data, namespace="home")
+        device.restore_state({"temperature": 22.5, "power": constants.Power.On,
+                              "mode": constants.OperationMode.Heat, "temperatureInside": 20}, 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.json")
+            snapshot.save(path, [device])
+            entries = snapshot.load(path)
+        self.assertEqual(1, len(entries))
+        self.assertEqual("home", entries[0].account)
+        restored = Device(entries[0].raw, namespace=entries[0].account)
+        restored.restore_state(entries[0].params, entries[0].epoch)
+        self.assertEqual(raw_data, restored.get_raw())
+        self.assertEqual(device.get_id(), restored.get_id())
+        self.assertEqual("heat", restored.get_mode_str())
+        self.assertEqual(22.5, restored.get_target_temperature())
+        self.assertEqual(20, restored.get_temperature())
+        self.assertEqual(1000, restored.get_update_epoch())
+        self.assertTrue(restored.needs_refresh())
+
+    def test_missing_or_broken_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.json")
+            self.assertEqual([], snapshot.load(path))
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{broken")
+            self.assertEqual([], snapshot.load(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
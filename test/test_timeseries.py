@@ -0,0 +1,54 @@
+""" Tests for the time series of the device readings """
+import unittest
+from pcfmqtt.timeseries import Series, summary
+
+
+def _readings(value: float):
+    return {"inside_temperature": value, "outside_temperature": -value, "target_temperature": 21}
+
+
+class TestSeries(unittest.TestCase):
+    """ Test ring buffers, downsampling and queries """
+
+    def test_raw_samples_within_window(self):
+        series = Series()
+        for i in range(10):
+            series.append(1000 + i * 60, _readings(20 + i))
+        resolution, points = series.query("inside_temperature", 1000 + 5 * 60, 1000 + 9 * 60)
+        self.assertEqual(0, resolution)
+        self.assertEqual([25, 26, 27, 28, 29], [point.avg for point in points])
+        self.assertEqual({"min": 25, "max": 29, "avg": 27, "samples": 5}, summary(points))
+
+    def test_older_window_from_downsampled_tier(self):
+        series = Series(tiers=((0, 10), (300, 10), (3600, 10)))
+        for i in range(60):
+            series.append(i * 60, _readings(i % 5))
+        resolution, points = series.query("outside_temperature", 600, 3600)
+        self.assertEqual(300, resolution)
+        self.assertEqual(10, len(points))
+        self.assertEqual([0, -2, -4, 5], [points[-1].max, points[-1].avg, points[-1].min, points[-1].count])
+        # Beyond the 5 minute buckets
+        resolution, points = series.query("outside_temperature", -3600, 3600)
+        self.assertEqual(3600, resolution)
+        self.assertEqual(60, points[0].count)
+
+    def test_memory_is_bounded(self):
+        series = Series(tiers=((0, 5),))
+        for i in range(20):
+            series.append(i, _readings(i))
+        _, points = series.query("inside_temperature", 0, 20)
+        self.assertEqual([15, 16, 17, 18, 19], [point.avg for point in points])
+
+    def test_old_samples_and_unknown_metric(self):
+        series = Series()
+        series.append(100, _readings(1))
+        series.append(100, _readings(2))
+        series.append(50, _readings(3))
+        _, points = series.query("inside_temperature", 0, 200)
+        self.assertEqual([1], [point.avg for point in points])
+        with self.assertRaises(KeyError):
+            series.query("humidity", 0, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
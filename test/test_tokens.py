@@ -0,0 +1,61 @@
+""" Tests for token storage """
+import json
+import os
+import stat
+import tempfile
+import unittest
+from pcomfortcloud.exceptions import LoginError, ResponseError
+from pcfmqtt import tokens
+
+
+class TestTokens(unittest.TestCase):
+    """ Test token storage helpers """
+
+    def test_token_file_per_account(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = os.path.join(tmp, "tokens")
+            first = tokens.token_file(directory, "First@dev.null")
+            self.assertEqual(first, tokens.token_file(directory, "first@dev.null "))
+            self.assertNotEqual(first, tokens.token_file(directory, "second@dev.null"))
+            self.assertEqual(0o700, stat.S_IMODE(os.stat(directory).st_mode))
+
+    def test_existing_directory_restricted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = os.path.join(tmp, "tokens")
+            os.makedirs(directory, mode=0o755)
+            os.chmod(directory, 0o755)
+            tokens.token_file(directory, "first@dev.null")
+            self.assertEqual(0o700, stat.S_IMODE(os.stat(directory).st_mode))
+
+    def test_prepare_before_login(self):
+        """ Token file is owner only before the session writes to it and holds no token """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "token.json")
+            tokens.prepare(path)
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+            with open(path, "r", encoding="utf-8") as f:
+                self.assertIsNone(json.load(f))
+            os.chmod(path, 0o644)
+            tokens.prepare(path)
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_restrict_and_discard(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "token.json")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{}")
+            tokens.restrict(path)
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+            tokens.discard(path)
+            self.assertFalse(os.path.exists(path))
+
+    def test_token_rejected(self):
+        self.assertTrue(tokens.is_token_rejected(LoginError("failed")))
+        self.assertTrue(tokens.is_token_rejected(
+            ResponseError("(get_device: Expected status code 200, received: 401: ")))
+        self.assertFalse(tokens.is_token_rejected(
+            ResponseError("(get_device: Expected status code 200, received: 502: ")))
+
+
+if __name__ == '__main__':
+    unittest.main()